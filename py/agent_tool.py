@@ -1,6 +1,34 @@
 import json
-from py.get_setting import HOST,PORT
-from openai import AsyncOpenAI
+import os
+import threading
+from py.get_setting import freeze, get_host, get_port
+from py.llm_client_pool import get_llm_client
+
+# 智能体配置缓存：按 (路径, mtime, 大小) 缓存解析后的只读配置，文件未变化时不再重复读取/解析
+_agent_config_cache = {}
+_agent_config_lock = threading.Lock()
+
+def load_agent_config(config_path: str):
+    """返回智能体配置的只读快照（FrozenDict），文件修改后自动重新加载"""
+    st = os.stat(config_path)
+    signature = (st.st_mtime_ns, st.st_size)
+    with _agent_config_lock:
+        cached = _agent_config_cache.get(config_path)
+        if cached and cached[0] == signature:
+            return cached[1]
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = freeze(json.load(f))
+    with _agent_config_lock:
+        _agent_config_cache[config_path] = (signature, config)
+    return config
+
+def invalidate_agent_config(config_path: str = None):
+    with _agent_config_lock:
+        if config_path is None:
+            _agent_config_cache.clear()
+        else:
+            _agent_config_cache.pop(config_path, None)
+
 async def get_agent_tool(settings):
     tool_agent_list = []
     for agent_id,agent_config in settings['agents'].items():
@@ -35,10 +63,8 @@ async def get_agent_tool(settings):
 
 async def agent_tool_call(agent_id, query):
     try:
-        client = AsyncOpenAI(
-            api_key="super-secret-key",
-            base_url=f"http://{HOST}:{PORT}/v1"
-        )
+        # 复用指向本服务的客户端，多跳调用时不再重复建立连接
+        client = get_llm_client("OpenAI", f"http://{get_host()}:{get_port()}/v1", "super-secret-key")
         response = await client.chat.completions.create(
             model=agent_id,
             messages=[
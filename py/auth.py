@@ -1,11 +1,15 @@
-import sqlite3
 import os
 import time
+import asyncio
 import hashlib
 import secrets
+import threading
+from collections import OrderedDict
 from typing import Optional, List
 from pathlib import Path
 
+from py.sqlite_pool import get_pool
+
 # Try to import bcrypt; if not available we'll fall back to PBKDF2
 try:
     import bcrypt
@@ -21,41 +25,44 @@ def get_db_path(user_data_dir: str):
     return os.path.join(user_data_dir, DB_FILENAME)
 
 
+def _connection(user_data_dir: str):
+    """Borrow a pooled connection (WAL mode, cached prepared statements)."""
+    return get_pool(get_db_path(user_data_dir)).connection()
+
+
 def init_user_db(user_data_dir: str):
     """Create users DB and sessions table if not exists."""
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY,
-        email TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL,
-        salt TEXT NOT NULL,
-        iterations INTEGER NOT NULL,
-        is_admin INTEGER NOT NULL DEFAULT 0,
-        created_at INTEGER NOT NULL
-    )
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS sessions (
-        token TEXT PRIMARY KEY,
-        user_id INTEGER NOT NULL,
-        expires_at INTEGER NOT NULL,
-        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-    )
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS tokens (
-        token TEXT PRIMARY KEY,
-        user_id INTEGER NOT NULL,
-        type TEXT NOT NULL,
-        expires_at INTEGER NOT NULL,
-        consumed INTEGER NOT NULL DEFAULT 0
-    )
-    """)
-    conn.commit()
-    conn.close()
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            salt TEXT NOT NULL,
+            iterations INTEGER NOT NULL,
+            is_admin INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL
+        )
+        """)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS tokens (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            consumed INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+        conn.commit()
 
 
 def _hash_password(password: str, salt: Optional[bytes] = None, iterations: int = 200000):
@@ -73,12 +80,10 @@ def _hash_password(password: str, salt: Optional[bytes] = None, iterations: int
 
 
 def create_user(user_data_dir: str, email: str, password: str, is_admin: bool = False) -> int:
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
     password_hash, salt, iterations, algo = _hash_password(password)
     now = int(time.time())
-    try:
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
         # store algorithm in password_hash column for bcrypt (string starting with $2)
         if algo == 'bcrypt':
             c.execute("INSERT INTO users (email, password_hash, salt, iterations, is_admin, created_at) VALUES (?,?,?,?,?,?)",
@@ -88,8 +93,6 @@ def create_user(user_data_dir: str, email: str, password: str, is_admin: bool =
                       (email, password_hash, salt, iterations, 1 if is_admin else 0, now))
         conn.commit()
         user_id = c.lastrowid
-    finally:
-        conn.close()
     # create per-user data folders
     base = Path(user_data_dir) / "users" / str(user_id)
     for sub in ["chats", "history", "memory", "characters", "settings"]:
@@ -98,23 +101,21 @@ def create_user(user_data_dir: str, email: str, password: str, is_admin: bool =
 
 
 def get_user_by_email(user_data_dir: str, email: str):
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("SELECT id, email, password_hash, salt, iterations, is_admin, created_at FROM users WHERE email = ?", (email,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
-        return None
-    return {
-        'id': row[0],
-        'email': row[1],
-        'password_hash': row[2],
-        'salt': row[3],
-        'iterations': row[4],
-        'is_admin': bool(row[5]),
-        'created_at': row[6]
-    }
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, email, password_hash, salt, iterations, is_admin, created_at FROM users WHERE email = ?", (email,))
+        row = c.fetchone()
+        if not row:
+            return None
+        return {
+            'id': row[0],
+            'email': row[1],
+            'password_hash': row[2],
+            'salt': row[3],
+            'iterations': row[4],
+            'is_admin': bool(row[5]),
+            'created_at': row[6]
+        }
 
 
 def verify_password(user_record: dict, password: str) -> bool:
@@ -138,137 +139,202 @@ def verify_password(user_record: dict, password: str) -> bool:
 def create_session(user_data_dir: str, user_id: int, max_age_days: int = 30) -> str:
     token = secrets.token_hex(32)
     expires_at = int(time.time()) + max_age_days * 24 * 3600
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("INSERT INTO sessions (token, user_id, expires_at) VALUES (?,?,?)", (token, user_id, expires_at))
-    conn.commit()
-    conn.close()
-    return token
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO sessions (token, user_id, expires_at) VALUES (?,?,?)", (token, user_id, expires_at))
+        conn.commit()
+        return token
+
+
+def _lookup_session(user_data_dir: str, token: str):
+    """Return (user, session_expires_at) or (None, None)."""
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("SELECT user_id, expires_at FROM sessions WHERE token = ?", (token,))
+        row = c.fetchone()
+        if not row:
+            return None, None
+        user_id, expires_at = row
+        if int(time.time()) > expires_at:
+            # expired
+            c.execute("DELETE FROM sessions WHERE token = ?", (token,))
+            conn.commit()
+            return None, None
+        c.execute("SELECT id, email, is_admin, created_at FROM users WHERE id = ?", (user_id,))
+        u = c.fetchone()
+        if not u:
+            return None, None
+        return {'id': u[0], 'email': u[1], 'is_admin': bool(u[2]), 'created_at': u[3]}, expires_at
 
 
 def get_user_by_session(user_data_dir: str, token: str):
     if not token:
         return None
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("SELECT user_id, expires_at FROM sessions WHERE token = ?", (token,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return None
-    user_id, expires_at = row
-    if int(time.time()) > expires_at:
-        # expired
-        c.execute("DELETE FROM sessions WHERE token = ?", (token,))
-        conn.commit()
-        conn.close()
-        return None
-    c.execute("SELECT id, email, is_admin, created_at FROM users WHERE id = ?", (user_id,))
-    u = c.fetchone()
-    conn.close()
-    if not u:
+    user, _ = _lookup_session(user_data_dir, token)
+    return user
+
+
+class SessionCache:
+    """
+    In-memory cache of session token -> user, used by the auth middleware.
+    Valid sessions are cached for `ttl` seconds (never beyond the session's own
+    expiry); unknown/expired tokens are cached for `negative_ttl` seconds so
+    repeated bad cookies don't hit the database either.
+    """
+    def __init__(self, ttl: float = 30.0, negative_ttl: float = 5.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # token -> (valid_until, user or None)
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; a lookup that started before one must not re-populate the cache.
+        self.generation = 0
+
+    def get(self, token: str):
+        """Return (hit, user)."""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return False, None
+            valid_until, user = entry
+            if time.time() >= valid_until:
+                del self._entries[token]
+                return False, None
+            self._entries.move_to_end(token)
+            return True, user
+
+    def put(self, token: str, user, session_expires_at=None, generation=None):
+        """Cache a lookup result; skipped if `generation` (read before the DB query) is no longer current."""
+        now = time.time()
+        valid_until = now + (self.ttl if user else self.negative_ttl)
+        if session_expires_at is not None:
+            valid_until = min(valid_until, session_expires_at)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[token] = (valid_until, user)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_token(self, token: str):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(token, None)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            self.generation += 1
+            stale = [t for t, (_, u) in self._entries.items() if u and u.get('id') == user_id]
+            for t in stale:
+                del self._entries[t]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+session_cache = SessionCache(
+    ttl=float(os.environ.get('SAP_SESSION_CACHE_TTL', '30')),
+    negative_ttl=float(os.environ.get('SAP_SESSION_NEGATIVE_TTL', '5')),
+)
+
+
+async def get_user_by_session_cached(user_data_dir: str, token: str):
+    """Async session lookup: a dict hit in the common case, a pooled query in a worker thread otherwise."""
+    if not token:
         return None
-    return {'id': u[0], 'email': u[1], 'is_admin': bool(u[2]), 'created_at': u[3]}
+    hit, user = session_cache.get(token)
+    if hit:
+        return user
+    generation = session_cache.generation
+    user, expires_at = await asyncio.to_thread(_lookup_session, user_data_dir, token)
+    session_cache.put(token, user, expires_at, generation=generation)
+    return user
 
 
 def delete_session(user_data_dir: str, token: str):
     if not token:
         return
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("DELETE FROM sessions WHERE token = ?", (token,))
-    conn.commit()
-    conn.close()
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM sessions WHERE token = ?", (token,))
+        conn.commit()
+    session_cache.invalidate_token(token)
 
 
 def list_users(user_data_dir: str) -> List[dict]:
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("SELECT id, email, is_admin, created_at FROM users")
-    rows = c.fetchall()
-    conn.close()
-    return [{'id': r[0], 'email': r[1], 'is_admin': bool(r[2]), 'created_at': r[3]} for r in rows]
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, email, is_admin, created_at FROM users")
+        rows = c.fetchall()
+        return [{'id': r[0], 'email': r[1], 'is_admin': bool(r[2]), 'created_at': r[3]} for r in rows]
 
 
 def delete_user(user_data_dir: str, user_id: int):
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        conn.commit()
+    session_cache.invalidate_user(user_id)
 
 
 def set_user_admin(user_data_dir: str, user_id: int, is_admin: bool):
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("UPDATE users SET is_admin = ? WHERE id = ?", (1 if is_admin else 0, user_id))
-    conn.commit()
-    conn.close()
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE users SET is_admin = ? WHERE id = ?", (1 if is_admin else 0, user_id))
+        conn.commit()
+    session_cache.invalidate_user(user_id)
 
 
 def create_token(user_data_dir: str, user_id: int, token_type: str, ttl_seconds: int = 3600) -> str:
     tok = secrets.token_urlsafe(32)
     expires_at = int(time.time()) + ttl_seconds
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("INSERT INTO tokens (token, user_id, type, expires_at, consumed) VALUES (?,?,?,?,0)", (tok, user_id, token_type, expires_at))
-    conn.commit()
-    conn.close()
-    return tok
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO tokens (token, user_id, type, expires_at, consumed) VALUES (?,?,?,?,0)", (tok, user_id, token_type, expires_at))
+        conn.commit()
+        return tok
 
 
 def get_token_record(user_data_dir: str, token: str):
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("SELECT token, user_id, type, expires_at, consumed FROM tokens WHERE token = ?", (token,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
-        return None
-    return {'token': row[0], 'user_id': row[1], 'type': row[2], 'expires_at': row[3], 'consumed': bool(row[4])}
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("SELECT token, user_id, type, expires_at, consumed FROM tokens WHERE token = ?", (token,))
+        row = c.fetchone()
+        if not row:
+            return None
+        return {'token': row[0], 'user_id': row[1], 'type': row[2], 'expires_at': row[3], 'consumed': bool(row[4])}
 
 
 def consume_token(user_data_dir: str, token: str):
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("UPDATE tokens SET consumed = 1 WHERE token = ?", (token,))
-    conn.commit()
-    conn.close()
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE tokens SET consumed = 1 WHERE token = ?", (token,))
+        conn.commit()
 
 
 def set_password_by_userid(user_data_dir: str, user_id: int, new_password: str):
     password_hash, salt, iterations, algo = _hash_password(new_password)
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    if algo == 'bcrypt':
-        c.execute("UPDATE users SET password_hash = ?, salt = NULL, iterations = NULL WHERE id = ?", (password_hash, user_id))
-    else:
-        c.execute("UPDATE users SET password_hash = ?, salt = ?, iterations = ? WHERE id = ?", (password_hash, salt, iterations, user_id))
-    conn.commit()
-    conn.close()
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        if algo == 'bcrypt':
+            c.execute("UPDATE users SET password_hash = ?, salt = NULL, iterations = NULL WHERE id = ?", (password_hash, user_id))
+        else:
+            c.execute("UPDATE users SET password_hash = ?, salt = ?, iterations = ? WHERE id = ?", (password_hash, salt, iterations, user_id))
+        conn.commit()
 
 
 def set_user_verified(user_data_dir: str, user_id: int):
-    db_path = get_db_path(user_data_dir)
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    try:
-        c.execute("UPDATE users SET is_verified = 1 WHERE id = ?", (user_id,))
-        conn.commit()
-    except Exception:
-        # older schema may not have is_verified; ignore
-        pass
-    conn.close()
+    with _connection(user_data_dir) as conn:
+        c = conn.cursor()
+        try:
+            c.execute("UPDATE users SET is_verified = 1 WHERE id = ?", (user_id,))
+            conn.commit()
+        except Exception:
+            # older schema may not have is_verified; ignore
+            pass
 
 
 def ensure_root_admin(user_data_dir: str):
@@ -0,0 +1,323 @@
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# 磁盘格式版本，格式变化时递增
+BM25_FORMAT_VERSION = 1
+BM25_DIR_NAME = "bm25"
+
+# postings 超过该大小时使用内存映射，小索引直接读入内存（避免 Windows 下文件被占用无法删除）
+MMAP_THRESHOLD_BYTES = 64 * 1024 * 1024
+
+# 英文/数字按词切分，中日韩文字按单字切分
+_TOKEN_RE = re.compile(r"[\u4e00-\u9fff\u3400-\u4dbf\u3040-\u30ff\uac00-\ud7af]|[^\W_]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    """
+    预计算的 BM25 倒排索引。
+
+    目录结构:
+        meta.json         版本、文档数、平均长度、k1/b
+        vocab.json        词表（列表下标即 term_id）
+        idf.npy           float32[V]
+        offsets.npy       int64[V+1]，term_id 对应的 postings 区间
+        postings_doc.npy  int32[nnz]
+        postings_tf.npy   float32[nnz]
+        doc_len.npy       float32[N]
+        docs.jsonl        每行一个分块（page_content + metadata）
+        doc_offsets.npy   int64[N+1]，docs.jsonl 中每行的字节偏移
+        chunk_ids.npy     int64[N]，与 FAISS 索引共用的分块 ID
+    """
+
+    def __init__(self, path: Optional[Path], meta: Dict, vocab: Dict[str, int],
+                 idf: np.ndarray, offsets: np.ndarray, postings_doc: np.ndarray,
+                 postings_tf: np.ndarray, doc_len: np.ndarray, doc_offsets: np.ndarray,
+                 chunk_ids: np.ndarray):
+        self.path = path
+        self.meta = meta
+        self.vocab = vocab
+        self.idf = idf
+        self.offsets = offsets
+        self.postings_doc = postings_doc
+        self.postings_tf = postings_tf
+        self.doc_len = doc_len
+        self.doc_offsets = doc_offsets
+        self.chunk_ids = chunk_ids
+        self.n_docs = meta["n_docs"]
+        self.avgdl = meta["avgdl"]
+        self.k1 = meta["k1"]
+        self.b = meta["b"]
+
+    # ---------- 构建 ----------
+    @staticmethod
+    def _tokenize_docs(docs: List[Document], vocab: Dict[str, int], first_doc: int, f):
+        """分词并写出 docs.jsonl，返回 (term, doc, tf) 三元组、文档长度与行长度"""
+        coo_term, coo_doc, coo_tf = [], [], []
+        doc_len = np.zeros(len(docs), dtype=np.float32)
+        line_len = np.zeros(len(docs), dtype=np.int64)
+        for i, doc in enumerate(docs):
+            tokens = tokenize(doc.page_content)
+            doc_len[i] = len(tokens)
+            counts: Dict[str, int] = {}
+            for tok in tokens:
+                counts[tok] = counts.get(tok, 0) + 1
+            for tok, tf in counts.items():
+                term_id = vocab.get(tok)
+                if term_id is None:
+                    term_id = vocab[tok] = len(vocab)
+                coo_term.append(term_id)
+                coo_doc.append(first_doc + i)
+                coo_tf.append(tf)
+
+            line = json.dumps(
+                {"page_content": doc.page_content, "metadata": doc.metadata},
+                ensure_ascii=False,
+            ).encode("utf-8", "ignore") + b"\n"
+            f.write(line)
+            line_len[i] = len(line)
+        return (
+            np.asarray(coo_term, dtype=np.int64),
+            np.asarray(coo_doc, dtype=np.int32),
+            np.asarray(coo_tf, dtype=np.float32),
+            doc_len,
+            line_len,
+        )
+
+    @staticmethod
+    def _write_arrays(tmp: Path, vocab: Dict[str, int], coo_term: np.ndarray, coo_doc: np.ndarray,
+                      coo_tf: np.ndarray, doc_len: np.ndarray, line_len: np.ndarray,
+                      chunk_ids: np.ndarray, k1: float, b: float):
+        n_docs = len(doc_len)
+        # 按 term 排序得到 CSR 形式的 postings
+        order = np.argsort(coo_term, kind="stable")
+        df = np.bincount(coo_term, minlength=len(vocab)).astype(np.float64)
+        # Lucene 风格的 idf，始终为正
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(df).astype(np.int64)
+        doc_offsets = np.zeros(n_docs + 1, dtype=np.int64)
+        doc_offsets[1:] = np.cumsum(line_len)
+
+        np.save(tmp / "idf.npy", idf)
+        np.save(tmp / "offsets.npy", offsets)
+        np.save(tmp / "postings_doc.npy", coo_doc[order])
+        np.save(tmp / "postings_tf.npy", coo_tf[order])
+        np.save(tmp / "doc_len.npy", doc_len)
+        np.save(tmp / "doc_offsets.npy", doc_offsets)
+        np.save(tmp / "chunk_ids.npy", chunk_ids.astype(np.int64))
+        terms = [None] * len(vocab)
+        for tok, term_id in vocab.items():
+            terms[term_id] = tok
+        with open(tmp / "vocab.json", "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        # meta.json 最后写入，作为索引完整的标志
+        with open(tmp / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "version": BM25_FORMAT_VERSION,
+                "n_docs": n_docs,
+                "avgdl": float(doc_len.mean()) if n_docs else 0.0,
+                "k1": k1,
+                "b": b,
+            }, f)
+
+    @staticmethod
+    def _swap_in(tmp: Path, target: Path):
+        if target.exists():
+            shutil.rmtree(target)
+        os.replace(tmp, target)
+
+    @staticmethod
+    def _make_tmp(save_dir: Path) -> Path:
+        tmp = Path(save_dir) / (BM25_DIR_NAME + ".tmp")
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir(parents=True)
+        return tmp
+
+    @staticmethod
+    def build_and_save(docs: List[Document], save_dir: Path, chunk_ids: Optional[List[int]] = None,
+                       k1: float = 1.5, b: float = 0.75) -> Path:
+        """对分块做一次分词并写出倒排索引，先写入临时目录再整体替换"""
+        target = Path(save_dir) / BM25_DIR_NAME
+        tmp = BM25Index._make_tmp(save_dir)
+        vocab: Dict[str, int] = {}
+        with open(tmp / "docs.jsonl", "wb") as f:
+            coo_term, coo_doc, coo_tf, doc_len, line_len = BM25Index._tokenize_docs(docs, vocab, 0, f)
+        if chunk_ids is None:
+            chunk_ids = range(len(docs))
+        BM25Index._write_arrays(tmp, vocab, coo_term, coo_doc, coo_tf, doc_len, line_len,
+                                np.asarray(chunk_ids, dtype=np.int64), k1, b)
+        BM25Index._swap_in(tmp, target)
+        return target
+
+    @staticmethod
+    def apply_changes(save_dir: Path, remove_chunk_ids: List[int], new_docs: List[Document],
+                      new_chunk_ids: List[int]) -> Path:
+        """
+        增量更新：删除指定分块的 postings，只对新增分块分词后追加。
+        未变化的分块不会重新分词，docs.jsonl 中的原始行按字节拷贝。
+        """
+        old = BM25Index.load(save_dir, mmap=False)
+        if old is None:
+            raise FileNotFoundError("BM25 index not found")
+        target = Path(save_dir) / BM25_DIR_NAME
+        tmp = BM25Index._make_tmp(save_dir)
+
+        keep = ~np.isin(old.chunk_ids, np.asarray(remove_chunk_ids, dtype=np.int64))
+        new_pos = np.cumsum(keep) - 1
+        n_kept = int(keep.sum())
+
+        # 旧 postings 展开为 (term, doc, tf) 后过滤并重新编号
+        old_term = np.repeat(np.arange(len(old.vocab), dtype=np.int64), np.diff(old.offsets))
+        mask = keep[old.postings_doc]
+        old_term = old_term[mask]
+        old_doc = new_pos[old.postings_doc[mask]].astype(np.int32)
+        old_tf = np.asarray(old.postings_tf)[mask]
+
+        vocab = dict(old.vocab)
+        line_len_old = np.diff(old.doc_offsets)[keep]
+        with open(tmp / "docs.jsonl", "wb") as out:
+            with open(old.path / "docs.jsonl", "rb") as src:
+                for pos in np.flatnonzero(keep):
+                    start, end = int(old.doc_offsets[pos]), int(old.doc_offsets[pos + 1])
+                    src.seek(start)
+                    out.write(src.read(end - start))
+            coo_term, coo_doc, coo_tf, doc_len, line_len = BM25Index._tokenize_docs(new_docs, vocab, n_kept, out)
+
+        BM25Index._write_arrays(
+            tmp, vocab,
+            np.concatenate([old_term, coo_term]),
+            np.concatenate([old_doc, coo_doc]),
+            np.concatenate([old_tf, coo_tf]),
+            np.concatenate([old.doc_len[keep], doc_len]),
+            np.concatenate([line_len_old, line_len]),
+            np.concatenate([old.chunk_ids[keep], np.asarray(new_chunk_ids, dtype=np.int64)]),
+            old.k1, old.b,
+        )
+        BM25Index._swap_in(tmp, target)
+        return target
+
+    # ---------- 加载 ----------
+    @classmethod
+    def load(cls, save_dir: Path, mmap: bool = True) -> Optional["BM25Index"]:
+        path = Path(save_dir) / BM25_DIR_NAME
+        meta_path = path / "meta.json"
+        if not meta_path.exists():
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != BM25_FORMAT_VERSION:
+            return None
+        with open(path / "vocab.json", "r", encoding="utf-8") as f:
+            vocab = {tok: i for i, tok in enumerate(json.load(f))}
+
+        big = os.path.getsize(path / "postings_doc.npy") > MMAP_THRESHOLD_BYTES
+        mmap_mode = "r" if mmap and big else None
+        chunk_ids_path = path / "chunk_ids.npy"
+        chunk_ids = np.load(chunk_ids_path) if chunk_ids_path.exists() else np.arange(meta["n_docs"], dtype=np.int64)
+        return cls(
+            path=path,
+            meta=meta,
+            vocab=vocab,
+            idf=np.load(path / "idf.npy"),
+            offsets=np.load(path / "offsets.npy", mmap_mode=mmap_mode),
+            postings_doc=np.load(path / "postings_doc.npy", mmap_mode=mmap_mode),
+            postings_tf=np.load(path / "postings_tf.npy", mmap_mode=mmap_mode),
+            doc_len=np.load(path / "doc_len.npy"),
+            doc_offsets=np.load(path / "doc_offsets.npy", mmap_mode=mmap_mode),
+            chunk_ids=chunk_ids,
+        )
+
+    @staticmethod
+    def signature_file(save_dir: Path) -> Path:
+        return Path(save_dir) / BM25_DIR_NAME / "meta.json"
+
+    @property
+    def nbytes(self) -> int:
+        size = len(self.vocab) * 64
+        for arr in (self.idf, self.offsets, self.postings_doc, self.postings_tf, self.doc_len,
+                    self.doc_offsets, self.chunk_ids):
+            if not isinstance(arr, np.memmap):
+                size += arr.nbytes
+        return size
+
+    # ---------- 查询 ----------
+    def score(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        if self.n_docs == 0:
+            return scores
+        k1, b = self.k1, self.b
+        norm = k1 * (1 - b + b * self.doc_len / max(self.avgdl, 1e-9))
+        for tok in set(tokenize(query)):
+            term_id = self.vocab.get(tok)
+            if term_id is None:
+                continue
+            start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+            docs = self.postings_doc[start:end]
+            tf = self.postings_tf[start:end]
+            # 同一 term 的 postings 中 doc_id 唯一，可直接按下标累加
+            scores[docs] += self.idf[term_id] * tf * (k1 + 1) / (tf + norm[docs])
+        return scores
+
+    def top_k(self, query: str, k: int) -> List[int]:
+        scores = self.score(query)
+        k = min(k, self.n_docs)
+        if k <= 0:
+            return []
+        idx = np.argpartition(-scores, k - 1)[:k]
+        idx = idx[np.argsort(-scores[idx], kind="stable")]
+        # 不含任何查询词的文档不返回
+        return [int(i) for i in idx if scores[i] > 0]
+
+    def get_documents(self, doc_ids: List[int]) -> List[Document]:
+        docs = []
+        with open(self.path / "docs.jsonl", "rb") as f:
+            for doc_id in doc_ids:
+                start, end = int(self.doc_offsets[doc_id]), int(self.doc_offsets[doc_id + 1])
+                f.seek(start)
+                data = json.loads(f.read(end - start))
+                docs.append(Document(page_content=data["page_content"], metadata=data["metadata"]))
+        return docs
+
+    def search(self, query: str, k: int) -> List[Document]:
+        return self.get_documents(self.top_k(query, k))
+
+
+class BM25IndexRetriever(BaseRetriever):
+    """基于 BM25Index 的 LangChain 检索器，可直接放入 EnsembleRetriever"""
+    index: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.index.search(query, self.k)
+
+
+def migrate_legacy_json(save_dir: Path) -> Optional[BM25Index]:
+    """旧版知识库只有 bm25_index.json，首次加载时转换为倒排索引格式"""
+    legacy_path = Path(save_dir) / "bm25_index.json"
+    if not legacy_path.exists():
+        return None
+    with open(legacy_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    docs = [
+        Document(page_content=doc["page_content"], metadata=doc["metadata"])
+        for doc in data.get("docs", [])
+    ]
+    if not docs:
+        return None
+    BM25Index.build_and_save(docs, save_dir)
+    os.remove(legacy_path)
+    return BM25Index.load(save_dir)
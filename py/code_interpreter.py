@@ -1,10 +1,10 @@
 from e2b_code_interpreter import Sandbox
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-from py.get_setting import load_settings
+from py.get_setting import get_settings_snapshot
 
 async def e2b_code_async(code: str, language: str = "Python") -> str:
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     e2b_api_key = settings["codeSettings"]["e2b_api_key"]
     executor = ThreadPoolExecutor()
     def run_in_sandbox():
@@ -22,7 +22,7 @@ from aiohttp import ClientSession
 
 
 async def local_run_code_async(code: str, language: str = "python") -> str:
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     url = settings["codeSettings"]["sandbox_url"].strip("/") + "/run_code"
     headers = {
         "Content-Type": "application/json"
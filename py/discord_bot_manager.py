@@ -11,7 +11,7 @@ from typing import Dict, List, Optional, Any
 import aiohttp
 import discord
 from discord.ext import commands, tasks
-from openai import AsyncOpenAI
+from py.llm_client_pool import get_llm_client
 from pydantic import BaseModel
 
 from py.get_setting import get_port, load_settings
@@ -196,7 +196,7 @@ class DiscordClient(discord.Client):
 
         # 3. 请求 LLM
         settings = await load_settings()
-        client = AsyncOpenAI(api_key="super-secret-key", base_url=f"http://127.0.0.1:{get_port()}/v1")
+        client = get_llm_client("OpenAI", f"http://127.0.0.1:{get_port()}/v1", "super-secret-key")
 
         # —— 与飞书完全对齐：取上下文工具 & 文件链接 —— #
         async_tools = self.async_tools.get(cid, [])
@@ -341,8 +341,8 @@ class DiscordClient(discord.Client):
             await msg.channel.send(seg)
 
     async def _send_voice(self, msg: discord.Message, text: str):
-        from py.get_setting import load_settings
-        settings = await load_settings()
+        from py.get_setting import get_settings_snapshot
+        settings = await get_settings_snapshot()
         tts_settings = settings.get("ttsSettings", {})
         index = 0
         text = self.clean_markdown(text)
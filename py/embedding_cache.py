@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from py.get_setting import USER_DATA_DIR
+
+# 查询向量缓存：同一 (模型, 接口地址, 文本) 在 TTL 内只请求一次上游嵌入接口。
+# 知识库检索在事件循环中调用，mem0 在线程池中同步调用，因此缓存本身是线程安全的，
+# 并发的相同请求通过 concurrent.futures.Future 合并为一次上游调用（跨线程/跨事件循环均可等待）。
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("SAP_EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_TTL = float(os.environ.get("SAP_EMBEDDING_CACHE_TTL", "86400"))
+# 设置为 1 时同时持久化到 sqlite，重启后仍可命中
+EMBEDDING_CACHE_PERSIST = os.environ.get("SAP_EMBEDDING_CACHE_PERSIST", "0") == "1"
+EMBEDDING_CACHE_DB = os.path.join(USER_DATA_DIR, "embedding_cache.db")
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(str(text).split())
+
+
+class EmbeddingCache:
+    """有界 LRU + TTL 的查询向量缓存，可选 sqlite 持久化"""
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES, ttl: float = EMBEDDING_CACHE_TTL,
+                 persist_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self._entries: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        # 正在执行的上游请求任务（保持强引用，避免被回收）
+        self._tasks: set = set()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    @staticmethod
+    def make_key(model: str, base_url: str, text: str) -> str:
+        raw = f"{model}\x00{(base_url or '').rstrip('/')}\x00{normalize_text(text)}"
+        return hashlib.sha1(raw.encode("utf-8", "ignore")).hexdigest()
+
+    # ---------- sqlite 持久化 ----------
+    def _get_db(self) -> Optional[sqlite3.Connection]:
+        if not self.persist_path:
+            return None
+        if self._db is None:
+            self._db = sqlite3.connect(self.persist_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, created REAL NOT NULL, vector BLOB NOT NULL)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _db_get(self, key: str) -> Optional[Tuple[float, np.ndarray]]:
+        db = self._get_db()
+        if db is None:
+            return None
+        row = db.execute("SELECT created, vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], np.frombuffer(row[1], dtype=np.float32)
+
+    def _db_put(self, key: str, created: float, vector: np.ndarray):
+        db = self._get_db()
+        if db is None:
+            return
+        db.execute(
+            "INSERT OR REPLACE INTO embeddings (key, created, vector) VALUES (?, ?, ?)",
+            (key, created, vector.astype(np.float32).tobytes()),
+        )
+        db.commit()
+
+    # ---------- 读写 ----------
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                try:
+                    entry = self._db_get(key)
+                except Exception as e:
+                    print(f"Embedding cache read failed: {e}")
+                    entry = None
+                if entry is not None:
+                    self._entries[key] = entry
+            if entry is None:
+                return None
+            created, vector = entry
+            if time.time() - created > self.ttl:
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return vector.tolist()
+
+    def put(self, key: str, vector: List[float]):
+        created = time.time()
+        arr = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._entries[key] = (created, arr)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            try:
+                self._db_put(key, created, arr)
+            except Exception as e:
+                print(f"Embedding cache write failed: {e}")
+
+    def _claim(self, key: str) -> Tuple[Optional[List[float]], Future, bool]:
+        """返回 (命中的向量, 在途 Future, 是否由当前调用方负责计算)"""
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached, None, False
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.shared += 1
+                return None, fut, False
+            self.misses += 1
+            fut = Future()
+            self._inflight[key] = fut
+            return None, fut, True
+
+    def _finish(self, key: str, fut: Future, vector: Optional[List[float]], error: Optional[BaseException]):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            self.put(key, vector)
+            fut.set_result(vector)
+
+    def _finish_task(self, key: str, fut: Future, task: "asyncio.Task"):
+        self._tasks.discard(task)
+        if task.cancelled():
+            self._finish(key, fut, None, asyncio.CancelledError())
+        elif task.exception() is not None:
+            self._finish(key, fut, None, task.exception())
+        else:
+            self._finish(key, fut, task.result(), None)
+
+    async def aget_or_compute(self, key: str, compute: Callable[[], Awaitable[List[float]]]) -> List[float]:
+        cached, fut, owner = self._claim(key)
+        if cached is not None:
+            return cached
+        if owner:
+            # 上游请求放在独立任务中执行：发起者被取消（客户端断开）时，
+            # 等待同一结果的其他请求不会跟着收到 CancelledError
+            task = asyncio.ensure_future(compute())
+            self._tasks.add(task)
+            task.add_done_callback(lambda t: self._finish_task(key, fut, t))
+        # shield：某个等待者被取消时不会连带取消共享的 Future
+        return await asyncio.shield(asyncio.wrap_future(fut))
+
+    def get_or_compute(self, key: str, compute: Callable[[], List[float]]) -> List[float]:
+        cached, fut, owner = self._claim(key)
+        if cached is not None:
+            return cached
+        if not owner:
+            return fut.result()
+        try:
+            vector = compute()
+        except BaseException as e:
+            self._finish(key, fut, None, e)
+            raise
+        self._finish(key, fut, vector, None)
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "persist": bool(self.persist_path),
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+        }
+
+
+embedding_cache = EmbeddingCache(persist_path=EMBEDDING_CACHE_DB if EMBEDDING_CACHE_PERSIST else None)
+
+
+def attach_embedding_cache(memory, model: str, base_url: str):
+    """
+    包装 mem0 Memory 的嵌入器：检索时的查询向量走共享缓存，写入记忆时仍直接请求。
+    """
+    embedder = memory.embedding_model
+    if getattr(embedder, "_sap_cached", False):
+        return memory
+    raw_embed = embedder.embed
+
+    def cached_embed(text, memory_action=None):
+        if memory_action != "search" or not isinstance(text, str):
+            return raw_embed(text, memory_action)
+        key = EmbeddingCache.make_key(model, base_url, text)
+        return embedding_cache.get_or_compute(key, lambda: raw_embed(text, memory_action))
+
+    embedder.embed = cached_embed
+    embedder._sap_cached = True
+    return memory
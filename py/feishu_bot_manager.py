@@ -14,7 +14,7 @@ import time
 from pydantic import BaseModel
 import requests
 from PIL import Image
-from openai import AsyncOpenAI
+from py.llm_client_pool import get_llm_client
 
 import lark_oapi as lark
 from lark_oapi.api.im.v1 import *
@@ -434,10 +434,7 @@ class FeishuClient:
         
         # 准备OpenAI客户端
         settings = await load_settings()
-        client = AsyncOpenAI(
-            api_key="super-secret-key",
-            base_url=f"http://127.0.0.1:{self.port}/v1"
-        )
+        client = get_llm_client("OpenAI", f"http://127.0.0.1:{self.port}/v1", "super-secret-key")
         
         # 处理消息内容
         user_content = []  # 这是一个列表，用于多模态内容
@@ -903,8 +900,8 @@ class FeishuClient:
     async def _send_voice(self, original_msg, text):
         """发送语音消息（opus专用版本）"""
         try:
-            from py.get_setting import load_settings
-            settings = await load_settings()
+            from py.get_setting import get_settings_snapshot
+            settings = await get_settings_snapshot()
             tts_settings = settings.get("ttsSettings", {})
             index = 0
             text = self.clean_markdown(text)
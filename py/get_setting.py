@@ -1,11 +1,12 @@
+import copy
 import json
 import os
 import sys
 import time
 import asyncio
-import aiosqlite
 from pathlib import Path
 from appdirs import user_data_dir
+from py.sqlite_pool import get_async_pool
 
 # ----------------- 1. 基础环境检测 (优化版) -----------------
 APP_NAME = "Super-Agent-Party"
@@ -151,88 +152,414 @@ async def init_db():
         return
     
     Path(USER_DATA_DIR).mkdir(parents=True, exist_ok=True)
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with get_async_pool(DATABASE_PATH).acquire() as db:
         await db.execute('''
             CREATE TABLE IF NOT EXISTS settings (
                 id INTEGER PRIMARY KEY,
                 data TEXT NOT NULL
             )
         ''')
+        # 设置版本号，每次保存递增；多进程时用于判断本地缓存是否过期
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS settings_version (
+                id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL
+            )
+        ''')
+        await db.execute('INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0)')
         await db.commit()
     _db_init_done = True
 
-async def load_settings():
+# ----------------- 5.1 设置内存缓存 -----------------
+# 热路径上不再访问磁盘：
+#   load_settings()         -> 从内存中的 JSON 解析出一份调用方私有的可变副本
+#   get_settings_snapshot() -> 返回全进程共享的只读快照（零拷贝，修改会抛 TypeError）
+# save_settings() 写库后直接刷新缓存（write-through）。
+
+class FrozenDict(dict):
+    """只读 dict，仍是 dict 子类，json.dumps / isinstance 检查照常工作"""
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("settings snapshot is read-only, use load_settings() for a mutable copy")
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __deepcopy__(self, memo):
+        return _thaw(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+class FrozenList(list):
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("settings snapshot is read-only, use load_settings() for a mutable copy")
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = _readonly
+
+    def __deepcopy__(self, memo):
+        return _thaw(self)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return FrozenDict((k, _freeze(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return FrozenList(_freeze(v) for v in obj)
+    return obj
+
+def freeze(obj):
+    """把 JSON 数据转换为只读快照（FrozenDict / FrozenList）"""
+    return _freeze(obj)
+
+def _thaw(obj):
+    if isinstance(obj, dict):
+        return {k: _thaw(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_thaw(v) for v in obj]
+    return obj
+
+_settings_json = None       # 合并默认值后的设置 JSON（紧凑格式）
+_settings_snapshot = None   # 对应的只读快照
+_settings_version = -1      # 缓存对应的数据库版本号
+_settings_cache_lock = asyncio.Lock()
+
+def _merge_defaults(default_dict, target_dict):
+    """递归合并默认值（默认值会被深拷贝，避免与模板缓存共享引用）"""
+    for key, value in default_dict.items():
+        if key not in target_dict:
+            target_dict[key] = copy.deepcopy(value)
+        elif isinstance(value, dict) and isinstance(target_dict.get(key), dict):
+            _merge_defaults(value, target_dict[key])
+
+def _set_settings_cache(settings: dict, version: int):
+    global _settings_json, _settings_snapshot, _settings_version
+    # 并发的刷新与保存可能乱序完成：较旧版本的数据不能覆盖已缓存的较新版本
+    if version < _settings_version:
+        return
+    _settings_json = json.dumps(settings, ensure_ascii=False)
+    _settings_snapshot = _freeze(json.loads(_settings_json))
+    _settings_version = version
+
+async def _read_settings_version(db) -> int:
+    async with db.execute('SELECT version FROM settings_version WHERE id = 1') as cursor:
+        row = await cursor.fetchone()
+        return row[0] if row else 0
+
+async def _refresh_settings_cache():
     await init_db() # 调用优化后的 init_db
-    
-    defaults = get_default_settings_sync().copy()
-    
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with get_async_pool(DATABASE_PATH).acquire() as db:
+        # 同一个读事务内读取版本号与数据，保证两者对应
+        await db.execute('BEGIN')
+        version = await _read_settings_version(db)
         async with db.execute('SELECT data FROM settings WHERE id = 1') as cursor:
             row = await cursor.fetchone()
-            if row:
-                user_settings = json.loads(row[0])
-                # 递归合并
-                def merge_defaults(default_dict, target_dict):
-                    for key, value in default_dict.items():
-                        if key not in target_dict:
-                            target_dict[key] = value
-                        elif isinstance(value, dict) and isinstance(target_dict.get(key), dict):
-                            merge_defaults(value, target_dict[key])
-                
-                merge_defaults(defaults, user_settings)
-                return user_settings
-            else:
-                if IS_DOCKER:
-                    defaults["isdocker"] = True
-                await save_settings(defaults)
-                return defaults
+        await db.rollback()
+    if row:
+        user_settings = json.loads(row[0])
+        _merge_defaults(get_default_settings_sync(), user_settings)
+        _set_settings_cache(user_settings, version)
+    else:
+        defaults = copy.deepcopy(get_default_settings_sync())
+        if IS_DOCKER:
+            defaults["isdocker"] = True
+        await save_settings(defaults)
+
+async def _ensure_settings_cache():
+    if _settings_json is not None:
+        return
+    async with _settings_cache_lock:
+        if _settings_json is None:
+            await _refresh_settings_cache()
+
+async def load_settings():
+    """返回调用方私有的可变设置副本（不访问磁盘）"""
+    await _ensure_settings_cache()
+    return json.loads(_settings_json)
+
+async def get_settings_snapshot():
+    """返回共享的只读设置快照，适合只读取配置的热路径"""
+    await _ensure_settings_cache()
+    return _settings_snapshot
+
+def overlay_settings(base, overrides: dict):
+    """
+    写时复制的覆盖视图：只复制被覆盖路径上的节点，其余子树与 base 共享。
+    例：overlay_settings(snapshot, {"ttsSettings": {"enabled": False}})
+    返回只读的 FrozenDict，不会修改 base。
+    """
+    merged = dict(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = overlay_settings(merged[key], value)
+        else:
+            merged[key] = _freeze(value)
+    return FrozenDict(merged)
+
+def get_settings_version() -> int:
+    """当前缓存对应的设置版本号"""
+    return _settings_version
+
+async def check_settings_version() -> bool:
+    """
+    读取数据库中的版本号（单行查询），其他进程保存过设置时刷新本地缓存。
+    返回是否发生了刷新。
+    """
+    if _settings_json is None:
+        await _ensure_settings_cache()
+        return True
+    await init_db()
+    async with get_async_pool(DATABASE_PATH).acquire() as db:
+        version = await _read_settings_version(db)
+    if version == _settings_version:
+        return False
+    async with _settings_cache_lock:
+        await _refresh_settings_cache()
+    return True
+
+async def watch_settings_version(interval: float = 2.0):
+    """后台任务：多进程部署时定期检查设置版本"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await check_settings_version()
+        except Exception as e:
+            print(f"[Warning] Settings version check failed: {e}")
 
 async def save_settings(settings):
+    await init_db()
+    if isinstance(settings, FrozenDict):
+        settings = _thaw(settings)
     data = json.dumps(settings, ensure_ascii=False, indent=2)
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with get_async_pool(DATABASE_PATH).acquire() as db:
         await db.execute('INSERT OR REPLACE INTO settings (id, data) VALUES (1, ?)', (data,))
+        await db.execute('UPDATE settings_version SET version = version + 1 WHERE id = 1')
+        version = await _read_settings_version(db)
         await db.commit()
+    # write-through：缓存与 load_settings 的结果保持一致（同样合并默认值）
+    merged = json.loads(data)
+    _merge_defaults(get_default_settings_sync(), merged)
+    _set_settings_cache(merged, version)
 
 # ----------------- 6. 对话存储优化 -----------------
 
-# --- 关键修复：恢复 init_covs_db 函数名 ---
+# 每个对话一行（conversations），消息逐条存储（conversation_messages），
+# 保存时只写入发生变化的对话与消息，而不是整体序列化全部历史。
 _covs_db_init_done = False
 
+def _conv_meta(conv: dict) -> dict:
+    return {k: v for k, v in conv.items() if k != "messages"}
+
+def _conv_timestamp(conv: dict) -> float:
+    try:
+        return float(conv.get("timestamp") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _dump(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
 async def init_covs_db():
-    """初始化对话数据库，增加状态位"""
+    """初始化对话数据库，并把旧版单行 JSON 迁移为逐行存储"""
     global _covs_db_init_done
     if _covs_db_init_done:
         return
         
     Path(USER_DATA_DIR).mkdir(parents=True, exist_ok=True)
-    async with aiosqlite.connect(COVS_PATH) as db:
+    async with get_async_pool(COVS_PATH).acquire() as db:
         await db.execute('''
             CREATE TABLE IF NOT EXISTS settings (
                 id INTEGER PRIMARY KEY,
                 data TEXT NOT NULL
             )
         ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                title TEXT,
+                updated_at REAL NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                meta TEXT NOT NULL
+            )
+        ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_messages (
+                conv_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (conv_id, seq)
+            )
+        ''')
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at DESC)')
         await db.commit()
+
+        # 旧版：全部对话以一个 JSON 存在 settings 表 id=1
+        async with db.execute('SELECT data FROM settings WHERE id = 1') as cursor:
+            row = await cursor.fetchone()
+        if row:
+            try:
+                legacy = json.loads(row[0]).get("conversations", [])
+            except Exception as e:
+                print(f"Error parsing legacy conversations: {e}")
+                legacy = None
+            if legacy is not None:
+                for conv in legacy:
+                    if isinstance(conv, dict) and conv.get("id") is not None:
+                        await _write_conversation(db, conv)
+                await db.execute('DELETE FROM settings WHERE id = 1')
+                await db.commit()
+                print(f"Migrated {len(legacy)} conversations to row storage")
     _covs_db_init_done = True
 
+async def _stored_messages(db, conv_id: str) -> list:
+    async with db.execute(
+        'SELECT data FROM conversation_messages WHERE conv_id = ? ORDER BY seq', (conv_id,)
+    ) as cursor:
+        return [r[0] for r in await cursor.fetchall()]
+
+async def _write_meta(db, conv: dict, message_count: int):
+    await db.execute(
+        'INSERT OR REPLACE INTO conversations (id, title, updated_at, message_count, meta) VALUES (?, ?, ?, ?, ?)',
+        (str(conv["id"]), conv.get("title"), _conv_timestamp(conv), message_count, _dump(_conv_meta(conv))),
+    )
+
+async def _write_messages(db, conv_id: str, messages: list, start: int, stored: list):
+    """从 start 开始用 messages 覆盖尾部；与已存内容相同的前缀不重写"""
+    rows = [_dump(m) for m in messages]
+    first_diff = 0
+    while (first_diff < len(rows) and start + first_diff < len(stored)
+           and stored[start + first_diff] == rows[first_diff]):
+        first_diff += 1
+    cut = start + first_diff
+    if cut < len(stored):
+        await db.execute('DELETE FROM conversation_messages WHERE conv_id = ? AND seq >= ?', (conv_id, cut))
+    if first_diff < len(rows):
+        await db.executemany(
+            'INSERT OR REPLACE INTO conversation_messages (conv_id, seq, data) VALUES (?, ?, ?)',
+            [(conv_id, cut + i, r) for i, r in enumerate(rows[first_diff:])],
+        )
+    return start + len(rows)
+
+async def _write_conversation(db, conv: dict):
+    conv_id = str(conv["id"])
+    stored = await _stored_messages(db, conv_id)
+    count = await _write_messages(db, conv_id, conv.get("messages") or [], 0, stored)
+    await _write_meta(db, conv, count)
+
+async def _read_conversation(db, conv_id: str, meta: str) -> dict:
+    conv = json.loads(meta)
+    conv["messages"] = [json.loads(m) for m in await _stored_messages(db, conv_id)]
+    return conv
+
 async def load_covs():
     try:
-        await init_covs_db() # 调用优化后的 init_covs_db
-        async with aiosqlite.connect(COVS_PATH) as db:
-            async with db.execute('SELECT data FROM settings WHERE id = 1') as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return json.loads(row[0])
-                else:
-                    default_covs = {"conversations": []}
-                    await save_covs(default_covs)
-                    return default_covs
+        await init_covs_db()
+        async with get_async_pool(COVS_PATH).acquire() as db:
+            async with db.execute('SELECT id, meta FROM conversations ORDER BY updated_at DESC') as cursor:
+                metas = await cursor.fetchall()
+            messages = {}
+            async with db.execute(
+                'SELECT conv_id, data FROM conversation_messages ORDER BY conv_id, seq'
+            ) as cursor:
+                async for conv_id, data in cursor:
+                    messages.setdefault(conv_id, []).append(json.loads(data))
+        conversations = []
+        for conv_id, meta in metas:
+            conv = json.loads(meta)
+            conv["messages"] = messages.get(conv_id, [])
+            conversations.append(conv)
+        return {"conversations": conversations}
     except Exception as e:
         print(f"Error loading conversations: {e}")
         return {"conversations": []}
 
 async def save_covs(settings):
-    data = json.dumps(settings, ensure_ascii=False, indent=2)
-    async with aiosqlite.connect(COVS_PATH) as db:
-        await db.execute('INSERT OR REPLACE INTO settings (id, data) VALUES (1, ?)', (data,))
-        await db.commit()
\ No newline at end of file
+    """整体保存（兼容旧协议）：按对话比对，只写入变化的行并删除已移除的对话"""
+    await init_covs_db()
+    conversations = [c for c in (settings or {}).get("conversations", []) if isinstance(c, dict) and c.get("id") is not None]
+    keep = {str(c["id"]) for c in conversations}
+    async with get_async_pool(COVS_PATH).acquire() as db:
+        async with db.execute('SELECT id, meta FROM conversations') as cursor:
+            existing = {r[0]: r[1] for r in await cursor.fetchall()}
+        removed = [cid for cid in existing if cid not in keep]
+        if removed:
+            await db.executemany('DELETE FROM conversations WHERE id = ?', [(cid,) for cid in removed])
+            await db.executemany('DELETE FROM conversation_messages WHERE conv_id = ?', [(cid,) for cid in removed])
+        for conv in conversations:
+            await _write_conversation(db, conv)
+        await db.commit()
+
+async def save_conversation(conv: dict):
+    """保存单个对话（元数据 + 变化的消息）"""
+    await init_covs_db()
+    async with get_async_pool(COVS_PATH).acquire() as db:
+        await _write_conversation(db, conv)
+        await db.commit()
+
+async def append_messages(conv_id: str, messages: list, start: int = None, meta: dict = None):
+    """
+    追加消息：start 为空时接在末尾，否则从 start 起覆盖（用于流式更新最后一条消息）。
+    meta 可选，用于同时更新标题、时间戳等字段。
+    """
+    await init_covs_db()
+    conv_id = str(conv_id)
+    async with get_async_pool(COVS_PATH).acquire() as db:
+        async with db.execute('SELECT meta, message_count FROM conversations WHERE id = ?', (conv_id,)) as cursor:
+            row = await cursor.fetchone()
+        current = json.loads(row[0]) if row else {"id": conv_id}
+        count = row[1] if row else 0
+        if start is None or start > count:
+            start = count
+        if start < count:
+            async with db.execute(
+                'SELECT data FROM conversation_messages WHERE conv_id = ? AND seq >= ? ORDER BY seq', (conv_id, start)
+            ) as cursor:
+                tail = [r[0] for r in await cursor.fetchall()]
+            stored = [None] * start + tail
+        else:
+            stored = [None] * count
+        count = await _write_messages(db, conv_id, messages or [], start, stored)
+        if meta:
+            current.update(_conv_meta(meta))
+        current["id"] = conv_id
+        await _write_meta(db, current, count)
+        await db.commit()
+    return count
+
+async def delete_conversation(conv_id: str):
+    await init_covs_db()
+    async with get_async_pool(COVS_PATH).acquire() as db:
+        await db.execute('DELETE FROM conversations WHERE id = ?', (str(conv_id),))
+        await db.execute('DELETE FROM conversation_messages WHERE conv_id = ?', (str(conv_id),))
+        await db.commit()
+
+async def list_conversations(offset: int = 0, limit: int = 50, keyword: str = None):
+    """分页列出对话摘要（不含消息），按更新时间倒序"""
+    await init_covs_db()
+    where, params = "", []
+    if keyword:
+        where = ('WHERE title LIKE ? OR id IN (SELECT conv_id FROM conversation_messages WHERE data LIKE ?)')
+        params = [f"%{keyword}%", f"%{keyword}%"]
+    async with get_async_pool(COVS_PATH).acquire() as db:
+        async with db.execute(f'SELECT COUNT(*) FROM conversations {where}', params) as cursor:
+            total = (await cursor.fetchone())[0]
+        async with db.execute(
+            f'SELECT meta, message_count FROM conversations {where} ORDER BY updated_at DESC LIMIT ? OFFSET ?',
+            params + [limit, offset],
+        ) as cursor:
+            rows = await cursor.fetchall()
+    items = []
+    for meta, count in rows:
+        item = json.loads(meta)
+        item["message_count"] = count
+        items.append(item)
+    return {"total": total, "offset": offset, "limit": limit, "conversations": items}
+
+async def get_conversation(conv_id: str):
+    await init_covs_db()
+    async with get_async_pool(COVS_PATH).acquire() as db:
+        async with db.execute('SELECT meta FROM conversations WHERE id = ?', (str(conv_id),)) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        return await _read_conversation(db, str(conv_id), row[0])
@@ -7,11 +7,11 @@ import tempfile
 import time
 
 import requests
-from py.get_setting import UPLOAD_FILES_DIR, load_settings
+from py.get_setting import UPLOAD_FILES_DIR, get_settings_snapshot
 
 
 async def upload_image_host(url):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     # 检查图床功能是否开启
     if not settings["BotConfig"]["imgHost_enabled"]:
         return url
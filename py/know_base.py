@@ -1,18 +1,27 @@
 import asyncio
+import base64
+import hashlib
 import httpx # 核心修复：使用异步 HTTP 客户端
-from typing import List, Dict, Union
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Union
 import json
 import os
+import shutil
+import time
 from pathlib import Path
+import faiss
+import numpy as np
 from langchain_core.embeddings import Embeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.retrievers import EnsembleRetriever
-from langchain_community.retrievers import BM25Retriever
 from langchain_core.documents import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
 
+from py.embedding_cache import EmbeddingCache, embedding_cache
+from py.bm25_index import BM25_DIR_NAME, BM25Index, BM25IndexRetriever, migrate_legacy_json
 from py.load_files import get_files_json
-from py.get_setting import load_settings, base_path, KB_DIR
+from py.get_setting import get_settings_snapshot, base_path, KB_DIR
     
 # --- Tiktoken 缓存设置（保留）---
 def get_tiktoken_cache_path():
@@ -35,45 +44,99 @@ def clean_text(text: str) -> str:
     return text.encode('utf-8', 'ignore').decode('utf-8')
 
 
+# 拒绝 encoding_format=base64 的嵌入接口 -> 到期时间；期间直接请求 float 列表，到期后重新尝试 base64
+_BASE64_UNSUPPORTED_ENDPOINTS: Dict[str, float] = {}
+BASE64_FALLBACK_TTL = float(os.environ.get("SAP_EMBEDDING_BASE64_FALLBACK_TTL", "3600"))
+
+
+def _base64_allowed(endpoint: str) -> bool:
+    expires = _BASE64_UNSUPPORTED_ENDPOINTS.get(endpoint)
+    if expires is None:
+        return True
+    if time.monotonic() >= expires:
+        _BASE64_UNSUPPORTED_ENDPOINTS.pop(endpoint, None)
+        return True
+    return False
+
+
+class _EncodingFormatRejected(Exception):
+    pass
+
+
+def _as_list(embedding) -> List[float]:
+    return embedding.tolist() if isinstance(embedding, np.ndarray) else embedding
+
+
 class MyOpenAICompatibleEmbeddings(Embeddings):
     """
     OpenAI 兼容的词嵌入类，使用 httpx 异步客户端进行非阻塞网络请求。
     """
-    def __init__(self, base_url: str, model: str, api_key: str = "empty"):
+    def __init__(self, base_url: str, model: str, api_key: str = "empty", client: httpx.AsyncClient = None):
         self.base_url = base_url
         self.model = model
         self.api_key = api_key
         # 假设 base_url 已经是 http://127.0.0.1:8000/minilm
         self.endpoint = f"{self.base_url}/embeddings"
+        # 可选的共享连接池（批量构建时复用同一个 client）
+        self.client = client
 
     # --- 异步核心方法 ---
     async def _aembed(self, texts: Union[str, List[str]]) -> List[Dict]:
-        """异步发送嵌入请求并处理响应"""
+        """异步发送嵌入请求并处理响应，base64 编码的向量解码为 float32 数组"""
         
         headers = {"Authorization": f"Bearer {self.api_key}"}
         json_data = {"model": self.model, "input": texts}
+        # 优先请求 base64 编码，省去逐个浮点数的 JSON 编解码
+        if _base64_allowed(self.endpoint):
+            json_data["encoding_format"] = "base64"
         
-        # 使用 httpx.AsyncClient 发送请求
-        async with httpx.AsyncClient(timeout=None) as client:
-            try:
-                # 调用词嵌入接口
-                response = await client.post(self.endpoint, headers=headers, json=json_data)
-                
-                # 检查 HTTP 状态码
-                response.raise_for_status() 
-                
-                return response.json()["data"]
-                
-            except httpx.HTTPStatusError as e:
-                detail = e.response.json().get('detail', e.response.text) if e.response.text else 'Unknown error'
-                raise RuntimeError(f"Embedding API HTTP Error {e.response.status_code}: {detail}")
-            except Exception as e:
-                raise ConnectionError(f"Embedding API connection failed: {e.__class__.__name__}: {e}")
+        if self.client is not None:
+            data = await self._request(self.client, headers, json_data)
+        else:
+            # 使用 httpx.AsyncClient 发送请求
+            async with httpx.AsyncClient(timeout=None) as client:
+                data = await self._request(client, headers, json_data)
+        for r in data:
+            if isinstance(r.get("embedding"), str):
+                r["embedding"] = np.frombuffer(base64.b64decode(r["embedding"]), dtype="<f4")
+        return data
+
+    async def _request(self, client: httpx.AsyncClient, headers: Dict, json_data: Dict) -> List[Dict]:
+        try:
+            return await self._post(client, headers, json_data)
+        except _EncodingFormatRejected as e:
+            # 400/422 不一定是 encoding_format 导致的（输入或模型名错误也会如此）：
+            # 去掉 encoding_format 重试一次，只有重试成功才认定接口不支持 base64
+            json_data.pop("encoding_format", None)
+            data = await self._post(client, headers, json_data)
+            _BASE64_UNSUPPORTED_ENDPOINTS[self.endpoint] = time.monotonic() + BASE64_FALLBACK_TTL
+            print(f"Embedding API {self.endpoint} rejected encoding_format=base64 ({e}), "
+                  f"using float lists for {BASE64_FALLBACK_TTL:g}s")
+            return data
+
+    async def _post(self, client: httpx.AsyncClient, headers: Dict, json_data: Dict) -> List[Dict]:
+        try:
+            # 调用词嵌入接口
+            response = await client.post(self.endpoint, headers=headers, json=json_data)
+            
+            # 检查 HTTP 状态码
+            response.raise_for_status() 
+            
+            return response.json()["data"]
+            
+        except httpx.HTTPStatusError as e:
+            if "encoding_format" in json_data and e.response.status_code in (400, 422):
+                raise _EncodingFormatRejected(f"HTTP {e.response.status_code}")
+            detail = e.response.json().get('detail', e.response.text) if e.response.text else 'Unknown error'
+            raise RuntimeError(f"Embedding API HTTP Error {e.response.status_code}: {detail}")
+        except Exception as e:
+            raise ConnectionError(f"Embedding API connection failed: {e.__class__.__name__}: {e}")
 
     # --- LangChain 兼容的同步方法 ---
     def embed_query(self, text: str) -> List[float]:
-        data = asyncio.run(self.aembed_query(text))
-        return data
+        # EnsembleRetriever 在线程中同步调用，命中缓存时不再创建事件循环
+        key = EmbeddingCache.make_key(self.model, self.base_url, text)
+        return embedding_cache.get_or_compute(key, lambda: asyncio.run(self._aembed_query_uncached(text)))
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         data = asyncio.run(self.aembed_documents(texts))
@@ -81,12 +144,22 @@ class MyOpenAICompatibleEmbeddings(Embeddings):
 
     # --- 暴露异步 LangChain 方法 ---
     async def aembed_query(self, text: str) -> List[float]:
+        key = EmbeddingCache.make_key(self.model, self.base_url, text)
+        return await embedding_cache.aget_or_compute(key, lambda: self._aembed_query_uncached(text))
+
+    async def _aembed_query_uncached(self, text: str) -> List[float]:
         data = await self._aembed(text)
-        return data[0]["embedding"]
+        return _as_list(data[0]["embedding"])
 
     async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
         data = await self._aembed(texts)
-        return [r["embedding"] for r in data]
+        return [_as_list(r["embedding"]) for r in data]
+
+    async def aembed_array(self, texts: List[str]) -> np.ndarray:
+        """返回 float32 矩阵，供构建索引时直接写入 FAISS"""
+        data = await self._aembed(texts)
+        data = sorted(data, key=lambda r: r.get("index", 0))
+        return np.stack([np.asarray(r["embedding"], dtype=np.float32) for r in data])
 
 
 def chunk_documents(results: List[Dict], cur_kb) -> List[Document]:
@@ -114,7 +187,7 @@ def chunk_documents(results: List[Dict], cur_kb) -> List[Document]:
     return all_docs
 
 # 核心修改：增加容错和数据清洗
-async def build_vector_store(docs: List[Document], kb_id, cur_kb: Dict, cur_vendor: str):
+async def build_vector_store(docs: List[Document], kb_id, cur_kb: Dict, cur_vendor: str, chunk_ids: List[int] = None):
     """构建并保存双索引"""
     if not isinstance(docs, list) or not all(isinstance(d, Document) for d in docs):
         raise ValueError("Input must be a list of Document objects")
@@ -123,67 +196,44 @@ async def build_vector_store(docs: List[Document], kb_id, cur_kb: Dict, cur_vend
     kb_dir.mkdir(parents=True, exist_ok=True)
     save_dir = kb_dir / str(kb_id)
     save_dir.mkdir(parents=True, exist_ok=True)
+    if chunk_ids is None:
+        chunk_ids = list(range(len(docs)))
 
     # ========== BM25索引构建 (容错版) ==========
     try:
-        bm25_path = save_dir / "bm25_index.json"
-        
         if not docs:
             print("Warning: No documents provided for BM25.")
         else:
             # 1. 清洗数据，防止 Unicode 错误
-            clean_docs_data = []
+            clean_docs = []
             for doc in docs:
                 clean_metadata = {
                     k: clean_text(v) if isinstance(v, str) else v 
                     for k, v in doc.metadata.items()
                 }
-                clean_docs_data.append({
-                    "page_content": clean_text(doc.page_content),
-                    "metadata": clean_metadata
-                })
-
-            # 2. 保存 (使用 clean_docs_data)
-            await asyncio.to_thread(
-                lambda: json.dump(
-                    {"docs": clean_docs_data}, 
-                    open(bm25_path, "w", encoding="utf-8", errors="ignore"), 
-                    ensure_ascii=False
-                )
-            )
+                clean_docs.append(Document(
+                    page_content=clean_text(doc.page_content),
+                    metadata=clean_metadata
+                ))
+
+            # 2. 构建时完成分词与词频统计，保存为倒排索引
+            await asyncio.to_thread(BM25Index.build_and_save, clean_docs, save_dir, chunk_ids)
+            legacy_path = save_dir / "bm25_index.json"
+            if legacy_path.exists():
+                os.remove(legacy_path)
             print(f"BM25 index saved successfully for KB {kb_id}")
 
     except Exception as e:
         # 即使 BM25 失败，也只打印警告，不中断程序
         print(f"⚠️ BM25 Index failed (Skipping): {str(e)}")
         # 尝试清理可能损坏的文件
-        if 'bm25_path' in locals() and bm25_path.exists():
-            try:
-                os.remove(bm25_path)
-            except:
-                pass
+        for broken in (save_dir / BM25_DIR_NAME, save_dir / (BM25_DIR_NAME + ".tmp")):
+            if broken.exists():
+                shutil.rmtree(broken, ignore_errors=True)
 
-    # ========== 向量索引构建 (使用异步客户端) ==========
+    # ========== 向量索引构建 (并发流水线) ==========
     try:
-        embeddings = MyOpenAICompatibleEmbeddings(
-            model=cur_kb["model"],
-            api_key=cur_kb["api_key"],
-            base_url=cur_kb["base_url"],
-        )
-        
-        batch_size = 20 
-        vector_db = None
-        
-        for i in range(0, len(docs), batch_size):
-            batch = docs[i:i+batch_size]
-            
-            # 使用 asyncio.to_thread 运行同步的 FAISS 方法
-            if vector_db is None:
-                vector_db = await asyncio.to_thread(FAISS.from_documents, batch, embeddings)
-            else:
-                await asyncio.to_thread(vector_db.add_documents, batch)
-            
-            print(f"Processed {min(i+batch_size, len(docs))}/{len(docs)} documents")
+        vector_db = await embed_documents_to_faiss(docs, cur_kb, chunk_ids)
         
         # 最终保存
         if vector_db:
@@ -194,27 +244,313 @@ async def build_vector_store(docs: List[Document], kb_id, cur_kb: Dict, cur_vend
         raise RuntimeError(f"Vector store build failed: {str(e)}")
 
 
-async def load_retrievers(kb_id, cur_kb, cur_vendor):
-    """加载双检索器 (带 BM25 缺失的回退机制)"""
+# 构建时每批分块数与同时在途的嵌入请求数，可在知识库配置中覆盖
+DEFAULT_EMBED_BATCH_SIZE = 20
+DEFAULT_EMBED_CONCURRENCY = 4
+
+
+async def embed_documents_array(docs: List[Document], cur_kb: Dict) -> np.ndarray:
+    """
+    分批并发请求嵌入接口，向量直接写入预分配的 float32 矩阵。
+    所有批次共用一个 httpx 连接池，并发数由信号量限制。
+    """
+    batch_size = max(1, int(cur_kb.get("embed_batch_size") or DEFAULT_EMBED_BATCH_SIZE))
+    concurrency = max(1, int(cur_kb.get("embed_concurrency") or DEFAULT_EMBED_CONCURRENCY))
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        embeddings = MyOpenAICompatibleEmbeddings(
+            model=cur_kb["model"],
+            api_key=cur_kb["api_key"],
+            base_url=cur_kb["base_url"],
+            client=client,
+        )
+        vectors = None
+        done = 0
+
+        async def embed_batch(start: int):
+            async with semaphore:
+                batch = docs[start:start + batch_size]
+                return start, await embeddings.aembed_array([d.page_content for d in batch])
+
+        tasks = [asyncio.create_task(embed_batch(i)) for i in range(0, len(docs), batch_size)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                start, batch_vectors = await finished
+                if vectors is None:
+                    vectors = np.empty((len(docs), batch_vectors.shape[1]), dtype=np.float32)
+                vectors[start:start + len(batch_vectors)] = batch_vectors
+                done += len(batch_vectors)
+                print(f"Processed {done}/{len(docs)} documents")
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+    return vectors
+
+
+async def embed_documents_to_faiss(docs: List[Document], cur_kb: Dict, chunk_ids: List[int]):
+    """嵌入全部分块并组装为以分块 ID 寻址的 FAISS 索引 (IndexIDMap2 + IndexFlatL2)"""
+    if not docs:
+        return None
+    vectors = await embed_documents_array(docs, cur_kb)
+    embeddings = MyOpenAICompatibleEmbeddings(
+        model=cur_kb["model"],
+        api_key=cur_kb["api_key"],
+        base_url=cur_kb["base_url"],
+    )
+
+    def assemble():
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(vectors.shape[1]))
+        index.add_with_ids(vectors, np.asarray(chunk_ids, dtype=np.int64))
+        # FAISS 检索返回的是分块 ID，index_to_docstore_id 直接以 ID 为键
+        docstore = InMemoryDocstore({str(cid): doc for cid, doc in zip(chunk_ids, docs)})
+        return FAISS(
+            embedding_function=embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id={int(cid): str(cid) for cid in chunk_ids},
+        )
+
+    return await asyncio.to_thread(assemble)
+
+
+async def update_vector_store(kb_id, cur_kb: Dict, remove_ids: List[int], new_docs: List[Document], new_ids: List[int]):
+    """增量更新双索引：按分块 ID 删除旧向量/postings，只嵌入新增分块"""
+    save_dir = Path(KB_DIR) / str(kb_id)
+    embeddings = MyOpenAICompatibleEmbeddings(
+        model=cur_kb["model"],
+        api_key=cur_kb["api_key"],
+        base_url=cur_kb["base_url"],
+    )
+    vector_db = await asyncio.to_thread(
+        FAISS.load_local,
+        folder_path=str(save_dir),
+        embeddings=embeddings,
+        allow_dangerous_deserialization=True,
+        index_name="index"
+    )
+    vectors = await embed_documents_array(new_docs, cur_kb) if new_docs else None
+
+    def patch_faiss():
+        if remove_ids:
+            vector_db.index.remove_ids(np.asarray(remove_ids, dtype=np.int64))
+            doc_ids = [vector_db.index_to_docstore_id.pop(int(cid), None) for cid in remove_ids]
+            doc_ids = [d for d in doc_ids if d is not None]
+            if doc_ids:
+                vector_db.docstore.delete(doc_ids)
+        if vectors is not None:
+            vector_db.index.add_with_ids(vectors, np.asarray(new_ids, dtype=np.int64))
+            vector_db.docstore.add({str(cid): doc for cid, doc in zip(new_ids, new_docs)})
+            vector_db.index_to_docstore_id.update({int(cid): str(cid) for cid in new_ids})
+        vector_db.save_local(folder_path=str(save_dir), index_name="index")
+
+    await asyncio.to_thread(patch_faiss)
+
+    clean_docs = [
+        Document(
+            page_content=clean_text(doc.page_content),
+            metadata={k: clean_text(v) if isinstance(v, str) else v for k, v in doc.metadata.items()},
+        )
+        for doc in new_docs
+    ]
+    try:
+        await asyncio.to_thread(BM25Index.apply_changes, save_dir, remove_ids, clean_docs, new_ids)
+    except Exception as e:
+        # BM25 缺失时查询会回退到向量检索，不中断更新；删除不一致的旧索引
+        print(f"⚠️ BM25 incremental update failed (Skipping): {str(e)}")
+        for broken in (save_dir / BM25_DIR_NAME, save_dir / (BM25_DIR_NAME + ".tmp")):
+            if broken.exists():
+                shutil.rmtree(broken, ignore_errors=True)
+
+
+# ========== 增量构建清单 ==========
+# manifest.json 记录每个文件的内容哈希与其分块 ID 区间 [start, end)，
+# 分块 ID 单调递增、不复用，同时作为 FAISS 与 BM25 中的文档 ID。
+MANIFEST_VERSION = 1
+
+
+def _manifest_path(kb_id) -> Path:
+    return Path(KB_DIR) / str(kb_id) / "manifest.json"
+
+
+def _manifest_config(cur_kb: Dict) -> Dict:
+    """这些配置变化时已有分块/向量全部失效，必须全量重建"""
+    return {
+        "chunk_size": cur_kb["chunk_size"],
+        "chunk_overlap": cur_kb["chunk_overlap"],
+        "model": cur_kb["model"],
+        "base_url": cur_kb["base_url"],
+    }
+
+
+def load_manifest(kb_id, cur_kb: Dict) -> Union[Dict, None]:
+    path = _manifest_path(kb_id)
+    kb_path = path.parent
+    if not path.exists() or not (kb_path / "index.faiss").exists():
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except Exception:
+        return None
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("config") != _manifest_config(cur_kb):
+        return None
+    return manifest
+
+
+def save_manifest(kb_id, manifest: Dict):
+    path = _manifest_path(kb_id)
+    tmp = path.with_suffix(".json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8", "ignore")).hexdigest()
+
+
+def chunk_files_with_ids(results: List[Dict], cur_kb: Dict, next_id: int):
+    """逐文件分块并分配连续的分块 ID，返回 (分块, ID 列表, {file_path: 清单条目}, next_id)"""
+    docs, ids, entries = [], [], {}
+    for result in results:
+        file_docs = chunk_documents([result], cur_kb)
+        start = next_id
+        next_id += len(file_docs)
+        docs.extend(file_docs)
+        ids.extend(range(start, next_id))
+        entries[result["file_path"]] = {
+            "hash": _content_hash(result["content"]),
+            "ids": [start, next_id],
+        }
+    return docs, ids, entries, next_id
+
+
+# ========== 常驻索引缓存 ==========
+# 知识库索引（FAISS + BM25）加载一次后常驻内存，按 kb_id + 索引文件 mtime 判定是否过期，
+# 超出内存预算时按 LRU 淘汰。
+KB_CACHE_MAX_BYTES = int(os.environ.get("SAP_KB_CACHE_MB", "512")) * 1024 * 1024
+
+
+class KBIndexCache:
+    """进程级知识库索引缓存（LRU + 内存预算）"""
+    def __init__(self, max_bytes: int = KB_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def signature(kb_id, cur_kb) -> Tuple:
+        """索引文件 mtime + 嵌入配置，任一变化即视为过期"""
+        kb_path = Path(KB_DIR) / str(kb_id)
+        mtimes = []
+        for f in (kb_path / "index.faiss", kb_path / "index.pkl", BM25Index.signature_file(kb_path)):
+            mtimes.append(f.stat().st_mtime_ns if f.exists() else None)
+        return (tuple(mtimes), cur_kb.get("model"), cur_kb.get("base_url"), cur_kb.get("api_key"))
+
+    @staticmethod
+    def _estimate_size(vector_db, bm25_index) -> int:
+        size = 0
+        if vector_db is not None:
+            index = vector_db.index
+            size += index.ntotal * index.d * 4
+            for doc in vector_db.docstore._dict.values():
+                size += len(doc.page_content) * 2
+        if bm25_index is not None:
+            size += bm25_index.nbytes
+        return size
+
+    async def get(self, kb_id, cur_kb):
+        key = str(kb_id)
+        sig = self.signature(kb_id, cur_kb)
+        entry = self._entries.get(key)
+        if entry is not None and entry["sig"] == sig:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["bm25"], entry["vector_db"]
+        self.misses += 1
+
+        # 同一知识库的并发加载只执行一次
+        fut = self._loading.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[key] = fut
+
+        try:
+            bm25_index, vector_db = await _load_indexes(kb_id, cur_kb)
+            size = await asyncio.to_thread(self._estimate_size, vector_db, bm25_index)
+        except BaseException as e:
+            self._loading.pop(key, None)
+            if isinstance(e, asyncio.CancelledError):
+                fut.cancel()
+            else:
+                fut.set_exception(e)
+                # 避免 "Future exception was never retrieved" 警告
+                fut.exception()
+            raise
+
+        self._loading.pop(key, None)
+        self._entries[key] = {
+            "sig": sig,
+            "bm25": bm25_index,
+            "vector_db": vector_db,
+            "size": size,
+        }
+        self._entries.move_to_end(key)
+        self._evict()
+        fut.set_result((bm25_index, vector_db))
+        return bm25_index, vector_db
+
+    def _evict(self):
+        total = sum(e["size"] for e in self._entries.values())
+        # 至少保留最近使用的一个
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry["size"]
+            self.evictions += 1
+
+    def invalidate(self, kb_id=None):
+        """kb_id 为 None 时清空全部缓存"""
+        if kb_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(str(kb_id), None)
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": sum(e["size"] for e in self._entries.values()),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "kb_ids": list(self._entries.keys()),
+        }
+
+
+kb_index_cache = KBIndexCache()
+
+
+async def _load_indexes(kb_id, cur_kb):
+    """从磁盘加载 BM25 与 FAISS 索引 (带 BM25 缺失的回退机制)"""
     kb_path = Path(KB_DIR) / str(kb_id)
-    bm25_path = kb_path / "bm25_index.json"
     
-    # 1. 尝试加载 BM25
-    bm25_retriever = None
+    # 1. 尝试加载 BM25 倒排索引（旧版 json 格式自动迁移）
+    bm25_index = None
     try:
-        if bm25_path.exists():
-            bm25_data = await asyncio.to_thread(json.load, open(bm25_path, "r", encoding="utf-8"))
-            bm25_docs = [
-                Document(page_content=doc["page_content"], metadata=doc["metadata"]) 
-                for doc in bm25_data["docs"]
-            ]
-            if bm25_docs:
-                bm25_retriever = await asyncio.to_thread(BM25Retriever.from_documents, bm25_docs)
-                bm25_retriever.k = cur_kb["chunk_k"]
+        bm25_index = await asyncio.to_thread(BM25Index.load, kb_path)
+        if bm25_index is None:
+            bm25_index = await asyncio.to_thread(migrate_legacy_json, kb_path)
     except Exception as e:
         print(f"Error loading BM25 (will fallback): {e}")
 
-    # 2. 加载向量检索器
+    # 2. 加载向量索引
     embeddings = MyOpenAICompatibleEmbeddings(
         model=cur_kb["model"],
         api_key=cur_kb["api_key"],
@@ -228,10 +564,21 @@ async def load_retrievers(kb_id, cur_kb, cur_vendor):
         allow_dangerous_deserialization=True,
         index_name="index"
     )
+    return bm25_index, vector_db
+
+
+async def load_retrievers(kb_id, cur_kb, cur_vendor):
+    """从常驻缓存获取双检索器"""
+    bm25_index, vector_db = await kb_index_cache.get(kb_id, cur_kb)
     vector_retriever = vector_db.as_retriever(
         search_kwargs={"k": cur_kb["chunk_k"]}
     )
 
+    # 缓存中的索引是共享且只读的，检索器按本次请求的 k 创建
+    bm25_retriever = None
+    if bm25_index is not None:
+        bm25_retriever = BM25IndexRetriever(index=bm25_index, k=cur_kb["chunk_k"])
+
     # 3. 如果 BM25 加载失败（比如之前构建时跳过了），使用向量检索器顶替
     # 这样 EnsembleRetriever 相当于用了两个 VectorRetriever，不会报错
     if bm25_retriever is None:
@@ -243,12 +590,12 @@ async def load_retrievers(kb_id, cur_kb, cur_vendor):
 async def query_vector_store(query: str, kb_id, cur_kb, cur_vendor):
     """使用EnsembleRetriever的混合查询"""
     bm25_retriever, vector_retriever = await load_retrievers(kb_id, cur_kb, cur_vendor)
-    if "weight" not in cur_kb:
-        cur_kb["weight"] = 0.5
+    # cur_kb 来自只读设置快照，缺省权重不回写
+    weight = cur_kb.get("weight", 0.5)
         
     ensemble_retriever = EnsembleRetriever(
         retrievers=[bm25_retriever, vector_retriever],
-        weights=[1 - cur_kb["weight"], cur_kb["weight"]],
+        weights=[1 - weight, weight],
     )
     
     # EnsembleRetriever.invoke 是同步阻塞的，需要放在线程中运行
@@ -263,7 +610,7 @@ async def query_vector_store(query: str, kb_id, cur_kb, cur_vendor):
 
 async def process_knowledge_base(kb_id):
     """异步处理知识库的完整流程"""
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     cur_kb = None
     providerId = None
     for kb in settings["knowledgeBases"]:
@@ -281,17 +628,49 @@ async def process_knowledge_base(kb_id):
         raise ValueError(f"Knowledge base {kb_id} not found in settings")
         
     processed_results = await get_files_json(cur_kb["files"])
-    
-    chunks = chunk_documents(processed_results, cur_kb)
-    
-    # 调用异步版本的 build_vector_store
-    await build_vector_store(chunks, kb_id, cur_kb, cur_vendor)
+    manifest = load_manifest(kb_id, cur_kb)
+
+    if manifest is None:
+        # 没有可用清单（首次构建、旧版索引或分块/嵌入配置变化）时全量构建
+        # 先删除旧清单，避免构建中途失败后留下与索引不一致的清单
+        if _manifest_path(kb_id).exists():
+            os.remove(_manifest_path(kb_id))
+        chunks, chunk_ids, entries, next_id = chunk_files_with_ids(processed_results, cur_kb, 0)
+        # 调用异步版本的 build_vector_store
+        await build_vector_store(chunks, kb_id, cur_kb, cur_vendor, chunk_ids)
+    else:
+        # 按内容哈希比对，只处理新增/删除/修改的文件
+        old_entries = manifest["files"]
+        current = {r["file_path"]: r for r in processed_results}
+        changed = [
+            r for path, r in current.items()
+            if path not in old_entries or old_entries[path]["hash"] != _content_hash(r["content"])
+        ]
+        changed_paths = {r["file_path"] for r in changed}
+        stale = [path for path in old_entries if path not in current or path in changed_paths]
+        if not changed and not stale:
+            return "知识库处理完成"
+
+        remove_ids = [cid for path in stale for cid in range(*old_entries[path]["ids"])]
+        chunks, chunk_ids, new_entries, next_id = chunk_files_with_ids(changed, cur_kb, manifest["next_id"])
+        print(f"Incremental KB update {kb_id}: -{len(remove_ids)} / +{len(chunks)} chunks")
+        await update_vector_store(kb_id, cur_kb, remove_ids, chunks, chunk_ids)
+        entries = {path: e for path, e in old_entries.items() if path not in stale}
+        entries.update(new_entries)
+
+    save_manifest(kb_id, {
+        "version": MANIFEST_VERSION,
+        "config": _manifest_config(cur_kb),
+        "next_id": next_id,
+        "files": entries,
+    })
+    kb_index_cache.invalidate(kb_id)
 
     return "知识库处理完成"
 
 async def query_knowledge_base(kb_id, query: str):
     """查询知识库"""
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     cur_kb = None
     providerId = None
     for kb in settings["knowledgeBases"]:
@@ -312,8 +691,48 @@ async def query_knowledge_base(kb_id, query: str):
     results = await query_vector_store(query, kb_id, cur_kb, cur_vendor)
     return results
 
+# 倒数排名融合 (Reciprocal Rank Fusion) 的平滑常数
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Dict]]) -> List[Dict]:
+    """按各列表中的排名融合多个知识库的结果，内容相同的分块只保留一次"""
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Dict] = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = doc.get("content", "")
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+            docs.setdefault(key, doc)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+async def query_knowledge_bases(kb_ids: List, query: str, rerank: bool = False):
+    """
+    并发查询多个知识库，RRF 融合后（可选）统一 rerank 一次。
+    返回 (结果列表, {kb_id: 耗时毫秒})，查询失败的知识库耗时记为 None。
+    """
+    latencies: Dict = {}
+
+    async def timed_query(kb_id):
+        start = time.perf_counter()
+        try:
+            results = await query_knowledge_base(kb_id, query)
+        except Exception as e:
+            print(f"Knowledge base {kb_id} query failed: {e}")
+            latencies[kb_id] = None
+            return []
+        latencies[kb_id] = round((time.perf_counter() - start) * 1000)
+        return results if isinstance(results, list) else []
+
+    result_lists = await asyncio.gather(*(timed_query(kb_id) for kb_id in kb_ids))
+    merged = reciprocal_rank_fusion(result_lists)
+    if rerank and merged:
+        merged = await rerank_knowledge_base(query, merged)
+    return merged, latencies
+
 async def rerank_knowledge_base(query: str , docs: List[Dict]) -> List[Dict]:
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     providerId = settings["KBSettings"]["selectedProvider"]
     cur_vendor = None
     for provider in settings["modelProviders"]:
@@ -0,0 +1,156 @@
+import asyncio
+import importlib.util
+import os
+import threading
+import time
+import weakref
+from typing import Dict, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from py.dify_openai_async import DifyOpenAIAsync
+
+# 按 (vendor, base_url, api_key) 复用 LLM 客户端：同一端点的请求共享底层 httpx 连接池，
+# 避免每次请求新建客户端导致的 TCP/TLS 握手。
+# httpx 的连接池绑定事件循环，机器人等运行在独立线程/事件循环中的调用方各自拥有一份客户端；
+# 客户端按事件循环弱引用分组存放，循环被回收后其客户端随之丢弃，循环关闭后也会被清理。
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+LLM_MAX_CONNECTIONS = int(os.environ.get("SAP_LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.environ.get("SAP_LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("SAP_LLM_KEEPALIVE_EXPIRY", "60"))
+# 超过该时长未被取用的客户端会被移出池并在同样的宽限期后关闭
+LLM_CLIENT_IDLE_TTL = float(os.environ.get("SAP_LLM_CLIENT_IDLE_TTL", "600"))
+# 安装了 h2 时对 https 端点启用 HTTP/2（多路复用，流式响应共享一条连接）
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+LLM_HTTP2 = os.environ.get("SAP_LLM_HTTP2", "1") == "1" and HTTP2_AVAILABLE
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class LLMClientPool:
+    def __init__(self, idle_ttl: float = LLM_CLIENT_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        # loop -> {key: [client, last_used]}；不在事件循环中的调用方放在 _loopless
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, list]]" = weakref.WeakKeyDictionary()
+        self._loopless: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    @staticmethod
+    def make_key(vendor: str, base_url: str, api_key: str) -> Tuple[str, str, str]:
+        vendor = "Dify" if vendor == "Dify" else "OpenAI"
+        return vendor, (base_url or DEFAULT_BASE_URL).rstrip("/"), api_key or ""
+
+    @staticmethod
+    def _http_client(base_url: str) -> httpx.AsyncClient:
+        return DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+            ),
+            http2=LLM_HTTP2 and base_url.startswith("https://"),
+        )
+
+    def _create(self, vendor: str, base_url: str, api_key: str):
+        if vendor == "Dify":
+            return DifyOpenAIAsync(api_key=api_key, base_url=base_url)
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self._http_client(base_url))
+
+    def _bucket_locked(self, loop: Optional[asyncio.AbstractEventLoop]) -> Dict[Tuple, list]:
+        if loop is None:
+            return self._loopless
+        bucket = self._clients.get(loop)
+        if bucket is None:
+            bucket = self._clients[loop] = {}
+        return bucket
+
+    def get(self, vendor: str, base_url: str, api_key: str):
+        key = self.make_key(vendor, base_url, api_key)
+        loop = _running_loop()
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket_locked(loop)
+            entry = bucket.get(key)
+            if entry is None:
+                entry = bucket[key] = [self._create(*key), now]
+                self.created += 1
+            entry[1] = now
+            stale = self._collect_idle_locked(now)
+        for client, stale_loop in stale:
+            self._schedule_close(client, stale_loop)
+        return entry[0]
+
+    def _collect_idle_locked(self, now: float):
+        stale = []
+        buckets = list(self._clients.items())
+        buckets.append((None, self._loopless))
+        for loop, bucket in buckets:
+            if loop is not None and loop.is_closed():
+                # 循环已关闭，客户端无法再使用也无法在其中关闭，直接丢弃
+                self.evicted += len(bucket)
+                del self._clients[loop]
+                continue
+            for key, (client, last_used) in list(bucket.items()):
+                if now - last_used > self.idle_ttl:
+                    del bucket[key]
+                    stale.append((client, loop))
+            if loop is not None and not bucket:
+                del self._clients[loop]
+        self.evicted += len(stale)
+        return stale
+
+    def _schedule_close(self, client, loop: Optional[asyncio.AbstractEventLoop]):
+        """移出池后再等一个宽限期才关闭，给仍在读取流式响应的请求留出时间"""
+        if loop is None or loop.is_closed():
+            return
+
+        def _close():
+            asyncio.ensure_future(self._close_client(client))
+
+        try:
+            loop.call_soon_threadsafe(loop.call_later, self.idle_ttl, _close)
+        except RuntimeError:
+            pass
+
+    @staticmethod
+    async def _close_client(client):
+        try:
+            await client.close()
+        except Exception as e:
+            print(f"Failed to close LLM client: {e}")
+
+    async def aclose(self):
+        loop = _running_loop()
+        with self._lock:
+            bucket = self._clients.pop(loop, {}) if loop is not None else {}
+            self._clients.clear()
+            self._loopless.clear()
+        for client, _ in bucket.values():
+            await self._close_client(client)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "clients": sum(len(b) for b in self._clients.values()) + len(self._loopless),
+                "loops": len(self._clients),
+                "created": self.created,
+                "evicted": self.evicted,
+                "http2": LLM_HTTP2,
+                "max_connections": LLM_MAX_CONNECTIONS,
+                "idle_ttl": self.idle_ttl,
+            }
+
+
+llm_client_pool = LLMClientPool()
+
+
+def get_llm_client(vendor: str, base_url: str, api_key: str):
+    return llm_client_pool.get(vendor, base_url, api_key)
@@ -6,8 +6,8 @@ import aiohttp
 import os
 from urllib.parse import urlparse, urlunparse, urljoin
 from urllib.robotparser import RobotFileParser
-from py.get_setting import load_settings, get_host, get_port # 确保导入了这两个函数
-from openai import AsyncOpenAI
+from py.get_setting import get_settings_snapshot, get_host, get_port # 确保导入了这两个函数
+from py.llm_client_pool import get_llm_client
 from ollama import AsyncClient as OllamaClient
 
 from py.load_files import check_robots_txt, is_private_ip, sanitize_url
@@ -127,7 +127,7 @@ async def get_image_media_type(image_url: str) -> str:
 
 async def custom_llm_tool(tool_name, query, image_url=None):
     print(f"调用LLM工具：{tool_name}")
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     llmTools = settings['llmTools']
     for llmTool in llmTools:
         if llmTool['enabled'] and llmTool['name'] == tool_name:
@@ -161,7 +161,7 @@ async def custom_llm_tool(tool_name, query, image_url=None):
                 except Exception as e:
                     return str(e)
             else:
-                client = AsyncOpenAI(api_key=llmTool['api_key'],base_url=llmTool['base_url'])
+                client = get_llm_client('OpenAI', llmTool['base_url'], llmTool['api_key'])
                 try:
                     if image_url:
                         base64_image = await get_image_base64(image_url)
@@ -0,0 +1,169 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from py.get_setting import FrozenList
+
+# 角色设定书（characterBook）触发词匹配：把所有条目的关键词编译成一个 Aho-Corasick 自动机，
+# 一次扫描文本即可找出全部被触发的条目，不再对每个条目的每个关键词分别做子串查找。
+# 自动机按 memoryId 缓存，设定书的关键词或匹配选项变化时才重建。
+# 条目可用 caseSensitive / matchWholeWords 覆盖下面的默认值。
+LORE_CASE_SENSITIVE = os.environ.get("SAP_LORE_CASE_SENSITIVE", "1") == "1"
+LORE_WHOLE_WORDS = os.environ.get("SAP_LORE_WHOLE_WORDS", "0") == "1"
+LORE_MATCHER_MAX = int(os.environ.get("SAP_LORE_MATCHER_MAX", "32"))
+
+
+def _is_word_char(c: str) -> bool:
+    # 与 JS 正则 \b 一致，只把 ASCII 字母数字和下划线当作单词字符，中文等不受整词匹配影响
+    return c.isascii() and (c.isalnum() or c == "_")
+
+
+class AhoCorasick:
+    """多模式子串匹配；输出为 (模式长度, 负载) 列表"""
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[int, object]]] = [[]]
+
+    def add(self, pattern: str, value):
+        node = 0
+        for c in pattern:
+            nxt = self._goto[node].get(c)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][c] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append((len(pattern), value))
+
+    def build(self):
+        """广度优先计算失败指针，并把失败链上的输出合并到各节点"""
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for c, child in self._goto[node].items():
+                queue.append(child)
+                f = self._fail[node]
+                while f and c not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(c, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+        return self
+
+    def __bool__(self) -> bool:
+        return len(self._goto) > 1
+
+    def iter(self, text: str):
+        """逐字符扫描一次，产出 (结束位置, 模式长度, 负载)"""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for end, c in enumerate(text):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            for length, value in out[node]:
+                yield end, length, value
+
+
+class LoreMatcher:
+    def __init__(self, character_book):
+        # 区分大小写与不区分大小写的关键词各一个自动机；负载为 (条目序号, 是否整词匹配)
+        self.sensitive = AhoCorasick()
+        self.folded = AhoCorasick()
+        self.size = 0
+        for i, lore in enumerate(character_book or []):
+            case_sensitive = lore.get("caseSensitive", LORE_CASE_SENSITIVE)
+            whole_words = lore.get("matchWholeWords", LORE_WHOLE_WORDS)
+            for key in (lore.get("keysRaw") or "").split("\n"):
+                if key == "":
+                    continue
+                if case_sensitive:
+                    self.sensitive.add(key, (i, whole_words))
+                else:
+                    self.folded.add(key.lower(), (i, whole_words))
+                self.size += 1
+        self.sensitive.build()
+        self.folded.build()
+
+    @staticmethod
+    def _scan(automaton: AhoCorasick, text: str, hits: set):
+        for end, length, (i, whole_words) in automaton.iter(text):
+            if i in hits:
+                continue
+            if whole_words:
+                start = end - length + 1
+                if start > 0 and _is_word_char(text[start - 1]) and _is_word_char(text[start]):
+                    continue
+                if end + 1 < len(text) and _is_word_char(text[end + 1]) and _is_word_char(text[end]):
+                    continue
+            hits.add(i)
+
+    def match(self, *texts: str) -> List[int]:
+        """返回被任一文本触发的条目序号（按设定书中的顺序）"""
+        hits = set()
+        for text in texts:
+            if not text or not isinstance(text, str):
+                continue
+            if self.sensitive:
+                self._scan(self.sensitive, text, hits)
+            if self.folded:
+                self._scan(self.folded, text.lower(), hits)
+        return sorted(hits)
+
+
+def _book_key(character_book) -> Tuple:
+    # 只有关键词与匹配选项决定自动机，条目内容在匹配后按序号从当前设定书读取
+    return tuple(
+        (lore.get("keysRaw") or "", lore.get("caseSensitive"), lore.get("matchWholeWords"))
+        for lore in character_book or []
+    )
+
+
+class LoreMatcherCache:
+    """memoryId → (设定书对象, 关键词指纹, LoreMatcher)"""
+    def __init__(self, max_entries: int = LORE_MATCHER_MAX):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.builds = 0
+
+    def get(self, memory_id: str, character_book) -> LoreMatcher:
+        with self._lock:
+            entry = self._entries.get(memory_id)
+            # 设置快照只读：同一个设定书对象可以直接复用，免去计算指纹
+            if entry is not None and isinstance(character_book, FrozenList) and entry[0] is character_book:
+                self._entries.move_to_end(memory_id)
+                return entry[2]
+        key = _book_key(character_book)
+        if entry is not None and entry[1] == key:
+            matcher = entry[2]
+        else:
+            matcher = LoreMatcher(character_book)
+            self.builds += 1
+        with self._lock:
+            self._entries[memory_id] = (character_book, key, matcher)
+            self._entries.move_to_end(memory_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return matcher
+
+    def invalidate(self, memory_id: Optional[str] = None):
+        with self._lock:
+            if memory_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(memory_id, None)
+
+
+lore_matchers = LoreMatcherCache()
+
+
+def match_lore(memory_id: str, character_book, *texts: str) -> List[dict]:
+    """返回被文本触发的设定书条目（按设定书中的顺序）"""
+    if not character_book:
+        return []
+    matcher = lore_matchers.get(memory_id, character_book)
+    return [character_book[i] for i in matcher.match(*texts)]
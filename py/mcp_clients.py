@@ -2,17 +2,26 @@
 import json
 import asyncio
 import logging
+import os
 import shutil
+import time
 from typing import Dict, Any, AsyncIterator, Optional
 
 import anyio
-from mcp import ClientSession
+import anyio.lowlevel
+from mcp import ClientSession, types
 from mcp.client.stdio   import stdio_client
 from mcp.client.sse     import sse_client
 from mcp.client.websocket import websocket_client
 from mcp.client.streamable_http import streamablehttp_client
 from contextlib import AsyncExitStack, asynccontextmanager
 
+# 工具 schema 缓存有效期（秒）；服务器发送 tools/list_changed 时立即失效
+MCP_TOOLS_TTL = float(os.environ.get("SAP_MCP_TOOLS_TTL", "300"))
+# 单个 MCP 服务器上同时进行的工具调用数，以及单次调用超时（秒）
+MCP_MAX_CONCURRENT_CALLS = int(os.environ.get("SAP_MCP_MAX_CONCURRENT_CALLS", "8"))
+MCP_CALL_TIMEOUT = float(os.environ.get("SAP_MCP_CALL_TIMEOUT", "120"))
+
 # ---------- 工具 ----------
 def get_command_path(command_name: str, default_command: str = "uv") -> str:
     path = shutil.which(command_name) or shutil.which(default_command)
@@ -22,9 +31,19 @@ def get_command_path(command_name: str, default_command: str = "uv") -> str:
 
 # ---------- 连接管理 ----------
 class ConnectionManager:
-    def __init__(self) -> None:
+    def __init__(self, on_tools_changed: Optional[callable] = None) -> None:
         self.session: Optional[ClientSession] = None
         self.tools: list[str] = []
+        self.tool_defs: list = []
+        self._on_tools_changed = on_tools_changed
+
+    async def _handle_message(self, message) -> None:
+        """接收服务器通知：工具列表变化时让客户端的 schema 缓存失效"""
+        if isinstance(message, types.ServerNotification) and isinstance(message.root, types.ToolListChangedNotification):
+            logging.info("MCP server reported tools/list_changed")
+            if self._on_tools_changed:
+                self._on_tools_changed()
+        await anyio.lowlevel.checkpoint()
 
     @asynccontextmanager
     async def connect(self, config: dict) -> AsyncIterator["ConnectionManager"]:
@@ -72,9 +91,12 @@ class ConnectionManager:
                     except Exception as e:
                         raise RuntimeError(f"SSE initial handshake failed: {e}") from e
             # 2. 建立会话
-            self.session = await stack.enter_async_context(ClientSession(read, write))
+            self.session = await stack.enter_async_context(
+                ClientSession(read, write, message_handler=self._handle_message)
+            )
             await self.session.initialize()
-            self.tools = [t.name for t in (await self.session.list_tools()).tools]
+            self.tool_defs = (await self.session.list_tools()).tools
+            self.tools = [t.name for t in self.tool_defs]
             logging.info("Connected to MCP server. Tools: %s", self.tools)
 
             yield self
@@ -82,6 +104,10 @@ class ConnectionManager:
 
 # ---------- 客户端 ----------
 class McpClient:
+    """
+    _lock 只保护连接的替换；工具调用在同一个 session 上并发进行（受信号量限制），
+    工具 schema 缓存在本地，收到 tools/list_changed 或超过 TTL 后才重新 list_tools。
+    """
     def __init__(self) -> None:
         self._conn: Optional[ConnectionManager] = None
         self._config: Optional[dict] = None
@@ -91,6 +117,12 @@ class McpClient:
         self._on_failure_callback: Optional[callable] = None  # 新增：失败回调
         self._tools: list[str] = []
         self._tools_list = []
+        self._generation = 0  # 连接或工具列表变化时递增，工具注册表据此判断是否需要重建
+        self._tool_defs: list = []
+        self._tools_fetched_at = 0.0
+        self._tools_stale = True
+        self._refresh_lock = asyncio.Lock()
+        self._call_semaphore = asyncio.Semaphore(MCP_MAX_CONCURRENT_CALLS)
 
     async def initialize(self, server_name: str, server_config: dict, on_failure_callback: Optional[callable] = None) -> None:
         """非阻塞初始化：拉起连接监控协程"""
@@ -108,19 +140,44 @@ class McpClient:
             except asyncio.CancelledError:
                 pass
 
+    def _mark_tools_stale(self) -> None:
+        self._tools_stale = True
+
+    def _set_tools(self, tool_defs: list) -> None:
+        changed = [
+            (t.name, t.description, t.inputSchema) for t in tool_defs
+        ] != [
+            (t.name, t.description, t.inputSchema) for t in self._tool_defs
+        ]
+        self._tool_defs = tool_defs
+        self._tools = [t.name for t in tool_defs]
+        self._tools_list = [{"name": t.name, "description": t.description,"enabled":True} for t in tool_defs]
+        self._tools_fetched_at = time.monotonic()
+        if changed:
+            self._generation += 1
+
     async def _connection_monitor(self) -> None:
         """持续重连逻辑：仅在一个协程里管理 AsyncExitStack"""
         while not self._shutdown:
             try:
-                async with ConnectionManager().connect(self._config) as conn:
+                async with ConnectionManager(on_tools_changed=self._mark_tools_stale).connect(self._config) as conn:
                     async with self._lock:
                         self._conn = conn
+                        self._tools_stale = False
+                        self._set_tools(conn.tool_defs)
+                        self._generation += 1
                     # 心跳检测
                     while not self._shutdown:
                         try:
-                            await asyncio.wait_for(self._conn.session.send_ping(), timeout=3)
+                            await asyncio.wait_for(conn.session.send_ping(), timeout=3)
                         except Exception:
                             break  # 断线，跳出 inner loop
+                        # 顺带刷新过期的工具列表，使工具注册表能感知变化
+                        if self._tools_expired():
+                            try:
+                                await self._refresh_tools(conn)
+                            except Exception as e:
+                                logging.warning("Failed to refresh MCP tools: %s", e)
                         await asyncio.sleep(30)
             except Exception as e:
                 logging.exception("Connection failed, will retry: %s", e)
@@ -129,39 +186,62 @@ class McpClient:
             finally:
                 async with self._lock:
                     self._conn = None
+                    self._generation += 1
             if not self._shutdown:
                 await asyncio.sleep(5)
 
+    def _tools_expired(self) -> bool:
+        return self._tools_stale or time.monotonic() - self._tools_fetched_at > MCP_TOOLS_TTL
+
+    async def _refresh_tools(self, conn: ConnectionManager) -> None:
+        async with self._refresh_lock:
+            # 等锁期间可能已被其他协程刷新
+            if not self._tools_expired():
+                return
+            # 先清除标记：刷新期间再收到 list_changed 会重新置位，下次再刷
+            self._tools_stale = False
+            try:
+                tools = (await conn.session.list_tools()).tools
+            except BaseException:
+                self._tools_stale = True
+                raise
+            if conn is self._conn:
+                self._set_tools(tools)
+
     # ---------- 外部 API ----------
     async def get_openai_functions(self,disable_tools=[]):
-        async with self._lock:
-            if not self._conn or not self._conn.session:
-                return []
-            tools = (await self._conn.session.list_tools()).tools
-            self._tools = [t.name for t in tools]
-            self._tools_list = [{"name": t.name, "description": t.description,"enabled":True} for t in tools]
-            tools_list = []
-            for t in tools:
-                if t.name not in disable_tools:
-                    tools_list.append(
-                        {
-                            "type": "function",
-                            "function": {
-                                "name": t.name,
-                                "description": t.description,
-                                "parameters": t.inputSchema,
-                            },
-                        }
-                    )
-
-            return tools_list
-
-    async def call_tool(self, tool_name: str, tool_params: Dict[str, Any]) -> Any:
-        async with self._lock:
-            if not self._conn or not self._conn.session:
-                return None
+        conn = self._conn
+        if not conn or not conn.session:
+            return []
+        if self._tools_expired():
+            await self._refresh_tools(conn)
+        tools_list = []
+        for t in self._tool_defs:
+            if t.name not in disable_tools:
+                tools_list.append(
+                    {
+                        "type": "function",
+                        "function": {
+                            "name": t.name,
+                            "description": t.description,
+                            "parameters": t.inputSchema,
+                        },
+                    }
+                )
+
+        return tools_list
+
+    async def call_tool(self, tool_name: str, tool_params: Dict[str, Any], timeout: Optional[float] = None) -> Any:
+        conn = self._conn
+        if not conn or not conn.session:
+            return None
+        timeout = MCP_CALL_TIMEOUT if timeout is None else timeout
+        async with self._call_semaphore:
             try:
-                return await self._conn.session.call_tool(tool_name, tool_params)
+                return await asyncio.wait_for(conn.session.call_tool(tool_name, tool_params), timeout=timeout)
+            except asyncio.TimeoutError:
+                logging.error("Tool %s timed out after %ss", tool_name, timeout)
+                return "Tool %s timed out after %ss" % (tool_name, timeout)
             except Exception as e:
                 logging.error("Failed to call tool %s: %s", tool_name, e)
                 return "Failed to call tool %s: %s" % (tool_name, e)
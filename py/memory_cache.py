@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from py.get_setting import MEMORY_CACHE_DIR
+
+# mem0 Memory 实例缓存：Memory.from_config 会创建嵌入客户端、LLM 客户端并从磁盘加载 FAISS 索引，
+# 按 (memoryId, 配置哈希) 复用实例后，每次检索只剩一次查询嵌入 + 一次 FAISS 查找。
+# 主对话、智能体、/memory 搜索等调用方的 LLM 设置可能不同，每种配置各占一个槽位，交替调用时不会互相挤掉；
+# 同一 memoryId 的实例共享同一份常驻存储（py.memory_store），因此可以并存。
+# 嵌入模型或向量库配置变化时，该 memoryId 的旧实例全部丢弃（旧向量与新模型不兼容）。
+MEMORY_INSTANCE_IDLE_TTL = float(os.environ.get("SAP_MEMORY_INSTANCE_IDLE_TTL", "1800"))
+MEMORY_INSTANCE_MAX = int(os.environ.get("SAP_MEMORY_INSTANCE_MAX", "8"))
+
+
+def build_memory_config(cur_memory, settings) -> dict:
+    """由记忆配置与主模型设置生成 mem0 配置（流式与非流式路径共用）"""
+    return {
+        "embedder": {
+            "provider": 'openai',
+            "config": {
+                "model": cur_memory['model'],
+                "api_key": cur_memory['api_key'],
+                "openai_base_url":cur_memory["base_url"],
+                "embedding_dims":cur_memory.get("embedding_dims", 1024)
+            },
+        },
+        "llm": {
+            "provider": 'openai',
+            "config": {
+                "model": settings['model'],
+                "api_key": settings['api_key'],
+                "openai_base_url":settings["base_url"]
+            }
+        },
+        "vector_store": {
+            "provider": "faiss",
+            "config": {
+                "collection_name": "agent-party",
+                "path": os.path.join(MEMORY_CACHE_DIR,cur_memory["id"]),
+                "distance_strategy": "euclidean",
+                "embedding_model_dims": cur_memory.get("embedding_dims", 1024)
+            }
+        }
+    }
+
+
+def _config_hash(config: dict) -> str:
+    raw = json.dumps(config, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _store_hash(config: dict) -> str:
+    """只由嵌入模型与向量库决定的哈希（与调用方的 LLM 设置无关）"""
+    return _config_hash({"embedder": config["embedder"], "vector_store": config["vector_store"]})
+
+
+class MemoryInstanceCache:
+    def __init__(self, idle_ttl: float = MEMORY_INSTANCE_IDLE_TTL, max_entries: int = MEMORY_INSTANCE_MAX):
+        self.idle_ttl = idle_ttl
+        self.max_entries = max_entries
+        # (memory_id, config_hash) -> [store_hash, memory, last_used]
+        self._entries: "OrderedDict[tuple, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 同一 memoryId 只允许一个线程在构建实例
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _build_lock(self, memory_id: str) -> threading.Lock:
+        with self._lock:
+            return self._build_locks.setdefault(memory_id, threading.Lock())
+
+    def _lookup(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry[2] = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _evict_locked(self, now: float):
+        for key, (_, _, last_used) in list(self._entries.items()):
+            if now - last_used > self.idle_ttl:
+                del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, cur_memory, settings):
+        """返回可复用的 Memory 实例（阻塞调用，应在线程池中执行）"""
+        from mem0 import Memory
+        from py.embedding_cache import attach_embedding_cache
+        from py.memory_store import attach_memory_store, memory_stores
+        memory_id = cur_memory["id"]
+        config = build_memory_config(cur_memory, settings)
+        key = (memory_id, _config_hash(config))
+        memory = self._lookup(key)
+        if memory is not None:
+            self.hits += 1
+            return memory
+        with self._build_lock(memory_id):
+            memory = self._lookup(key)
+            if memory is not None:
+                self.hits += 1
+                return memory
+            self.misses += 1
+            store_hash = _store_hash(config)
+            with self._lock:
+                # 嵌入模型或向量库配置已变化：丢弃该 memoryId 的旧实例
+                for stale in [k for k, e in self._entries.items() if k[0] == memory_id and e[0] != store_hash]:
+                    del self._entries[stale]
+            # 先加载常驻存储：旧版 pkl 在这里迁移到 SQLite，mem0 随后只会读到空的 pkl
+            memory_stores.get(memory_id)
+            memory = Memory.from_config(config)
+            attach_embedding_cache(memory, cur_memory['model'], cur_memory["base_url"])
+            # 与 /memory 接口共享同一份常驻 FAISS 存储
+            attach_memory_store(memory, memory_id)
+            now = time.monotonic()
+            with self._lock:
+                self._entries[key] = [store_hash, memory, now]
+                self._entries.move_to_end(key)
+                self._evict_locked(now)
+            return memory
+
+    def invalidate(self, memory_id: Optional[str] = None):
+        with self._lock:
+            if memory_id is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == memory_id]:
+                    del self._entries[key]
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_locked(time.monotonic())
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "instances": [memory_id for memory_id, _ in self._entries],
+                "max_entries": self.max_entries,
+                "idle_ttl": self.idle_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+memory_instances = MemoryInstanceCache()
+
+
+async def get_memory_instance(cur_memory, settings):
+    return await asyncio.to_thread(memory_instances.get, cur_memory, settings)
+
+
+async def memory_evict_task(interval: float = 60):
+    """后台定期释放长时间未使用的 Memory 实例与常驻存储"""
+    from py.memory_store import memory_stores
+    while True:
+        await asyncio.sleep(interval)
+        memory_instances.evict_idle()
+        # 存储被释放后，仍引用它的 Memory 实例也一并丢弃，下次使用时重新接管
+        for memory_id in await asyncio.to_thread(memory_stores.evict_idle):
+            memory_instances.invalidate(memory_id)
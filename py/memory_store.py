@@ -0,0 +1,645 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections.abc import ItemsView, Mapping, MutableMapping
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from py.get_setting import MEMORY_CACHE_DIR
+from py.sqlite_pool import close_pool, get_pool
+
+# 长期记忆的存储（目录与 mem0 的 faiss 向量库相同）：
+#   agent-party.faiss  IndexIDMap2 索引，向量 id 与 memories.vid 一致
+#   agent-party.db     SQLite 元数据库（uuid、文本、创建时间、payload），取代原来的 pkl
+#   agent-party.pkl    只保留空的 ({}, {})，让 mem0 加载时不再读入全部记录
+# 向量索引常驻内存并由 mem0 实例与 /memory 接口共享；删除用 remove_ids，不再重建索引；
+# 索引修改后延迟合并写盘（线程中执行，先写临时文件再原子替换），元数据按事务直接写入 SQLite。
+# 浏览、分页、关键字搜索只查 SQLite，不需要加载向量索引。
+COLLECTION_NAME = "agent-party"
+MEMORY_SAVE_DELAY = float(os.environ.get("SAP_MEMORY_SAVE_DELAY", "1.0"))
+MEMORY_STORE_IDLE_TTL = float(os.environ.get("SAP_MEMORY_STORE_IDLE_TTL", "1800"))
+# 遍历整个元数据库时每批读取的行数
+MEMORY_SCAN_BATCH = 1000
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS memories (
+        vid        INTEGER PRIMARY KEY,
+        uuid       TEXT NOT NULL UNIQUE,
+        data       TEXT NOT NULL DEFAULT '',
+        created_at TEXT NOT NULL DEFAULT '',
+        payload    TEXT NOT NULL DEFAULT '{}'
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_memories_created ON memories(created_at, vid)",
+)
+
+
+def get_dir(mid: str) -> str:
+    return os.path.join(MEMORY_CACHE_DIR, mid)
+
+def get_faiss_path(mid: str) -> str:
+    return os.path.join(get_dir(mid), f"{COLLECTION_NAME}.faiss")
+
+def get_pkl_path(mid: str) -> str:
+    return os.path.join(get_dir(mid), f"{COLLECTION_NAME}.pkl")
+
+def get_db_path(mid: str) -> str:
+    return os.path.join(get_dir(mid), f"{COLLECTION_NAME}.db")
+
+
+def _row(vid: Optional[int], uuid: str, payload: Optional[dict]) -> tuple:
+    payload = payload or {}
+    return (
+        vid,
+        uuid,
+        str(payload.get("data") or ""),
+        str(payload.get("created_at") or ""),
+        json.dumps(payload, ensure_ascii=False, default=str),
+    )
+
+
+def _escape_like(keyword: str) -> str:
+    return keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class SqliteDocstore(MutableMapping):
+    """
+    uuid → payload 的字典接口（mem0 的 FAISS 向量库直接使用），数据落在 SQLite。
+    另外提供按向量 id 的操作以及分页/搜索查询。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.pool = get_pool(path)
+        with self.pool.connection() as conn:
+            for sql in _SCHEMA:
+                conn.execute(sql)
+            conn.commit()
+
+    # ---------- 字典接口 ----------
+    def __getitem__(self, uuid: str) -> dict:
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT payload FROM memories WHERE uuid = ?", (uuid,)).fetchone()
+        if row is None:
+            raise KeyError(uuid)
+        return json.loads(row[0])
+
+    def __setitem__(self, uuid: str, payload: dict):
+        # 只更新已有记录：新记录必须经 MemoryStore.insert 写入，才能带上与索引一致的向量 id
+        _, _, data, created_at, payload_json = _row(None, uuid, payload)
+        with self.pool.connection() as conn:
+            cur = conn.execute(
+                "UPDATE memories SET data = ?, created_at = ?, payload = ? WHERE uuid = ?",
+                (data, created_at, payload_json, uuid),
+            )
+            conn.commit()
+        if cur.rowcount == 0:
+            raise KeyError(uuid)
+
+    def __delitem__(self, uuid: str):
+        with self.pool.connection() as conn:
+            cur = conn.execute("DELETE FROM memories WHERE uuid = ?", (uuid,))
+            conn.commit()
+        if cur.rowcount == 0:
+            raise KeyError(uuid)
+
+    def __contains__(self, uuid) -> bool:
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT 1 FROM memories WHERE uuid = ?", (uuid,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+
+    def _scan(self, columns: str) -> Iterable[tuple]:
+        """按 vid 分批遍历，不一次性读入全部记录，也不长时间占用连接"""
+        last = -1
+        while True:
+            with self.pool.connection() as conn:
+                rows = conn.execute(
+                    f"SELECT vid, {columns} FROM memories WHERE vid > ? ORDER BY vid LIMIT ?",
+                    (last, MEMORY_SCAN_BATCH),
+                ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last = rows[-1][0]
+
+    def __iter__(self):
+        for _, uuid in self._scan("uuid"):
+            yield uuid
+
+    def items(self):
+        return _DocstoreItems(self)
+
+    # ---------- 按向量 id ----------
+    def max_vid(self) -> int:
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT MAX(vid) FROM memories").fetchone()
+        return -1 if row[0] is None else row[0]
+
+    def uuid_of(self, vid: int) -> Optional[str]:
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT uuid FROM memories WHERE vid = ?", (vid,)).fetchone()
+        return None if row is None else row[0]
+
+    def vid_of(self, uuid: str) -> Optional[int]:
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT vid FROM memories WHERE uuid = ?", (uuid,)).fetchone()
+        return None if row is None else row[0]
+
+    def put_many(self, rows: Iterable[Tuple[int, str, dict]]):
+        with self.pool.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO memories (vid, uuid, data, created_at, payload) VALUES (?, ?, ?, ?, ?)",
+                (_row(vid, uuid, payload) for vid, uuid, payload in rows),
+            )
+            conn.commit()
+
+    def pop_vid(self, vid: int) -> Optional[str]:
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT uuid FROM memories WHERE vid = ?", (vid,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM memories WHERE vid = ?", (vid,))
+                conn.commit()
+        return None if row is None else row[0]
+
+    def merge_payload(self, uuid: str, fields: dict) -> bool:
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT vid, payload FROM memories WHERE uuid = ?", (uuid,)).fetchone()
+            if row is None:
+                return False
+            conn.execute(
+                "UPDATE memories SET data = ?, created_at = ?, payload = ? WHERE vid = ?",
+                _row(None, uuid, {**json.loads(row[1]), **fields})[2:] + (row[0],),
+            )
+            conn.commit()
+        return True
+
+    def update_text(self, vid: int, text: str) -> bool:
+        uuid = self.uuid_of(vid)
+        return uuid is not None and self.merge_payload(uuid, {"data": text})
+
+    # ---------- 浏览 ----------
+    def page(self, offset: int = 0, limit: int = 50, keyword: str = "", order: str = "desc") -> Tuple[int, List[tuple]]:
+        """按创建时间排序的一页记录，返回 (总数, [(vid, uuid, payload)])"""
+        where, params = "", []
+        if keyword:
+            where, params = "WHERE data LIKE ? ESCAPE '\\'", [f"%{_escape_like(keyword)}%"]
+        direction = "ASC" if order == "asc" else "DESC"
+        with self.pool.connection() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM memories {where}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT vid, uuid, payload FROM memories {where} "
+                f"ORDER BY created_at {direction}, vid {direction} LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return total, [(vid, uuid, json.loads(payload)) for vid, uuid, payload in rows]
+
+    def by_uuids(self, uuids: List[str]) -> List[tuple]:
+        """按给定 uuid 的顺序返回 [(vid, uuid, payload)]，不存在的跳过"""
+        if not uuids:
+            return []
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                f"SELECT vid, uuid, payload FROM memories WHERE uuid IN ({','.join('?' * len(uuids))})",
+                list(uuids),
+            ).fetchall()
+        found = {uuid: (vid, uuid, json.loads(payload)) for vid, uuid, payload in rows}
+        return [found[uuid] for uuid in uuids if uuid in found]
+
+
+class _DocstoreItems(ItemsView):
+    """mem0 的 list() 会遍历 docstore.items()，这里一次查询一批，避免逐条 __getitem__"""
+    def __iter__(self):
+        for _, uuid, payload in self._mapping._scan("uuid, payload"):
+            yield uuid, json.loads(payload)
+
+
+class VidMap(Mapping):
+    """向量 id → uuid 的只读映射（mem0 检索时用 index_to_id.get 把 FAISS 结果映射回记录）"""
+    def __init__(self, docstore: SqliteDocstore):
+        self.docstore = docstore
+
+    def __getitem__(self, vid) -> str:
+        uuid = self.docstore.uuid_of(int(vid))
+        if uuid is None:
+            raise KeyError(vid)
+        return uuid
+
+    def __iter__(self):
+        for vid, _ in self.docstore._scan("uuid"):
+            yield vid
+
+    def __len__(self) -> int:
+        return len(self.docstore)
+
+
+def _to_id_map(index, alive_ids: Mapping):
+    """把旧的按位置编号的 Flat 索引转换为 IndexIDMap2（只在首次加载旧数据时执行一次）"""
+    import faiss
+    if isinstance(index, faiss.IndexIDMap2):
+        return index
+    id_index = faiss.IndexIDMap2(faiss.IndexFlat(index.d, index.metric_type))
+    if index.ntotal:
+        vectors = index.reconstruct_n(0, index.ntotal)
+        positions = np.arange(index.ntotal, dtype=np.int64)
+        # mem0 删除记忆时只去掉映射、不动索引，这些残留向量在转换时一并丢弃
+        alive = np.array([int(i) in alive_ids for i in positions], dtype=bool)
+        if alive.any():
+            id_index.add_with_ids(vectors[alive], positions[alive])
+    return id_index
+
+
+def _write_index(index, path: str):
+    import faiss
+    faiss.write_index(index, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def _write_index_bytes(data, path: str):
+    """写入 faiss.serialize_index 的结果，与 _write_index 一样先写临时文件再原子替换"""
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def _write_stub_pkl(path: str):
+    """mem0 初始化时仍会读 pkl，只留空结构，真正的数据在 SQLite 中"""
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(({}, {}), f)
+    os.replace(path + ".tmp", path)
+
+
+def _migrate_legacy(memory_id: str):
+    """
+    把旧版 pkl 中的记录一次性导入 SQLite（先写临时库再原子替换，中途失败不会留下半个库），
+    随后把索引转换为 IndexIDMap2，并把 pkl 换成空结构。
+    """
+    import faiss
+    fpath, ppath, dbpath = get_faiss_path(memory_id), get_pkl_path(memory_id), get_db_path(memory_id)
+    with open(ppath, "rb") as f:
+        raw = pickle.load(f)
+    if isinstance(raw, tuple):
+        docstore, index_to_id = raw[0], {int(k): v for k, v in raw[1].items()}
+    else:
+        # 兼容旧版接口写出的纯 dict（只有 docstore，顺序即向量位置）
+        docstore = raw
+        index_to_id = {i: uuid for i, uuid in enumerate(raw)}
+    tmp = dbpath + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        for sql in _SCHEMA:
+            conn.execute(sql)
+        conn.executemany(
+            "INSERT OR REPLACE INTO memories (vid, uuid, data, created_at, payload) VALUES (?, ?, ?, ?, ?)",
+            (_row(vid, uuid, docstore.get(uuid, {})) for vid, uuid in sorted(index_to_id.items())),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp, dbpath)
+    if os.path.exists(fpath):
+        index = faiss.read_index(fpath)
+        if not isinstance(index, faiss.IndexIDMap2):
+            _write_index(_to_id_map(index, index_to_id), fpath)
+    _write_stub_pkl(ppath)
+    print(f"Memory {memory_id}: migrated {len(index_to_id)} records to SQLite")
+
+
+def _ensure_db(memory_id: str) -> bool:
+    """元数据库存在（必要时先从旧 pkl 迁移）时返回 True"""
+    if os.path.exists(get_db_path(memory_id)):
+        return True
+    if os.path.exists(get_pkl_path(memory_id)):
+        _migrate_legacy(memory_id)
+        return True
+    return False
+
+
+def _max_index_id(index) -> int:
+    import faiss
+    if index.ntotal == 0:
+        return -1
+    return int(faiss.vector_to_array(index.id_map).max())
+
+
+class MemoryStore:
+    def __init__(self, memory_id: str, index, docstore: SqliteDocstore):
+        import faiss
+        self.memory_id = memory_id
+        self.docstore = docstore
+        self.index_to_id = VidMap(docstore)
+        # 按位置编号的旧索引转换后需要写回一次
+        self.converted = not isinstance(index, faiss.IndexIDMap2)
+        self.index = _to_id_map(index, self.index_to_id)
+        # 索引可能比元数据库多出未写盘的已删除向量，新 id 取两者最大值之后，避免复用
+        self.next_id = max(docstore.max_vid(), _max_index_id(self.index)) + 1
+        self.lock = threading.RLock()
+        # 串行化写盘：快照在 self.lock 内取，写文件在锁外，按取快照的顺序落盘
+        self._save_lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self._save_timer: Optional[threading.Timer] = None
+        # 被释放后置为 True：仍持有旧实例的 mem0 请求写入时转交给注册表中当前的存储
+        self._closed = False
+        # 记忆已被删除：关闭后的写入直接丢弃
+        self._discarded = False
+
+    # ---------- 加载 ----------
+    @classmethod
+    def load(cls, memory_id: str) -> Optional["MemoryStore"]:
+        import faiss
+        if not _ensure_db(memory_id):
+            return None
+        fpath = get_faiss_path(memory_id)
+        if not os.path.exists(fpath):
+            return None
+        store = cls(memory_id, faiss.read_index(fpath), SqliteDocstore(get_db_path(memory_id)))
+        if store.converted:
+            store.save()
+        return store
+
+    @classmethod
+    def create(cls, memory_id: str, vector_store) -> "MemoryStore":
+        """新记忆：接管 mem0 刚建好的空索引（若 mem0 已加载了记录，也一并导入）"""
+        docstore = SqliteDocstore(get_db_path(memory_id))
+        index_to_id = {int(k): v for k, v in dict(vector_store.index_to_id).items()}
+        if index_to_id:
+            docstore.put_many(
+                (vid, uuid, vector_store.docstore.get(uuid, {})) for vid, uuid in sorted(index_to_id.items())
+            )
+        store = cls(memory_id, vector_store.index, docstore)
+        store.save_soon()
+        return store
+
+    # ---------- 读 ----------
+    def __len__(self) -> int:
+        return len(self.docstore)
+
+    # ---------- 写 ----------
+    def _successor(self) -> Optional["MemoryStore"]:
+        """
+        已释放的存储不再分配 vid（否则与重新加载的存储各自计数，会覆盖同一张表中的记录），
+        写入转交给注册表中当前的存储；记忆已删除时返回 None，写入丢弃。
+        """
+        if self._discarded:
+            print(f"Memory {self.memory_id} was removed, dropping write")
+            return None
+        return memory_stores.get(self.memory_id)
+
+    def insert(self, vectors, payloads=None, ids=None):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+        payloads = payloads or [{} for _ in range(len(vectors))]
+        with self.lock:
+            closed = self._closed
+            if not closed:
+                new_ids = np.arange(self.next_id, self.next_id + len(vectors), dtype=np.int64)
+                self.index.add_with_ids(vectors, new_ids)
+                self.docstore.put_many(zip(new_ids.tolist(), ids, payloads))
+                self.next_id += len(vectors)
+        if closed:
+            successor = self._successor()
+            if successor is not None:
+                successor.insert(vectors, payloads, ids)
+            return
+        self.save_soon()
+
+    def delete(self, vid: int) -> bool:
+        with self.lock:
+            closed = self._closed
+            if not closed:
+                if self.docstore.pop_vid(vid) is None:
+                    return False
+                self.index.remove_ids(np.array([vid], dtype=np.int64))
+        if closed:
+            successor = self._successor()
+            return successor is not None and successor.delete(vid)
+        self.save_soon()
+        return True
+
+    def delete_uuid(self, uuid: str) -> bool:
+        vid = self.docstore.vid_of(uuid)
+        return vid is not None and self.delete(vid)
+
+    def update(self, uuid: str, vector=None, payload: Optional[dict] = None) -> bool:
+        with self.lock:
+            closed = self._closed
+            if not closed:
+                vid = self.docstore.vid_of(uuid)
+                if vid is None:
+                    return False
+                if payload:
+                    self.docstore.merge_payload(uuid, payload)
+                if vector is None:
+                    self.last_used = time.monotonic()
+                    return True
+                # 同一个 id 重新写入向量，记录顺序不变
+                self.index.remove_ids(np.array([vid], dtype=np.int64))
+                self.index.add_with_ids(
+                    np.asarray(vector, dtype=np.float32).reshape(1, -1), np.array([vid], dtype=np.int64)
+                )
+        if closed:
+            successor = self._successor()
+            return successor is not None and successor.update(uuid, vector, payload)
+        self.save_soon()
+        return True
+
+    def update_text(self, vid: int, text: str) -> bool:
+        return self.docstore.update_text(vid, text)
+
+    # ---------- 持久化 ----------
+    def save(self):
+        """索引原子写盘（元数据已在 SQLite 中）；锁内只做内存序列化，写文件时不阻塞检索与写入"""
+        import faiss
+        with self._save_lock:
+            with self.lock:
+                if self._closed:
+                    return
+                data = faiss.serialize_index(self.index)
+            self._write(data)
+
+    def _write(self, data):
+        os.makedirs(get_dir(self.memory_id), exist_ok=True)
+        _write_index_bytes(data, get_faiss_path(self.memory_id))
+        ppath = get_pkl_path(self.memory_id)
+        if not os.path.exists(ppath) or os.path.getsize(ppath) > 64:
+            _write_stub_pkl(ppath)
+
+    def _save_in_background(self):
+        with self.lock:
+            self._save_timer = None
+        try:
+            self.save()
+        except Exception as e:
+            print(f"Failed to save memory {self.memory_id}: {e}")
+
+    def save_soon(self, delay: float = MEMORY_SAVE_DELAY):
+        """合并短时间内的多次修改，只写一次盘"""
+        with self.lock:
+            self.last_used = time.monotonic()
+            if self._save_timer is not None or self._closed:
+                return
+            self._save_timer = threading.Timer(delay, self._save_in_background)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        with self.lock:
+            timer, self._save_timer = self._save_timer, None
+        if timer is not None:
+            timer.cancel()
+            self.save()
+
+    def close(self, discard: bool = False):
+        """
+        释放存储：非 discard 时先写盘（失败则抛出异常、存储保持可用），
+        之后的写入一律转交或丢弃，不会再改动这份索引。
+        """
+        import faiss
+        # 与 save 相同的加锁顺序；关闭时在 self.lock 内写完，确保快照之后不会再有写入漏掉
+        with self._save_lock, self.lock:
+            if self._closed:
+                return
+            timer, self._save_timer = self._save_timer, None
+            if timer is not None:
+                timer.cancel()
+            if not discard:
+                self._write(faiss.serialize_index(self.index))
+            self._closed = True
+            self._discarded = discard
+
+
+class MemoryStoreRegistry:
+    """memoryId → 常驻的 MemoryStore"""
+    def __init__(self, idle_ttl: float = MEMORY_STORE_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._stores: Dict[str, MemoryStore] = {}
+        self._lock = threading.Lock()
+        # 旧数据迁移只允许一个线程执行
+        self._migrate_lock = threading.Lock()
+
+    def get(self, memory_id: str) -> Optional[MemoryStore]:
+        """阻塞调用（可能读盘），应在线程池中执行"""
+        with self._lock:
+            store = self._stores.get(memory_id)
+        if store is None:
+            # 加载与释放都持有 _migrate_lock：正在释放的存储写完盘之前不会从磁盘读到旧数据
+            with self._migrate_lock:
+                with self._lock:
+                    store = self._stores.get(memory_id)
+                if store is None:
+                    store = MemoryStore.load(memory_id)
+                    if store is None:
+                        return None
+                    with self._lock:
+                        store = self._stores.setdefault(memory_id, store)
+        store.last_used = time.monotonic()
+        return store
+
+    def docstore(self, memory_id: str) -> Optional[SqliteDocstore]:
+        """只访问元数据（浏览、搜索、改文本），不加载向量索引；阻塞调用"""
+        with self._lock:
+            store = self._stores.get(memory_id)
+        if store is not None:
+            return store.docstore
+        with self._migrate_lock:
+            if not _ensure_db(memory_id):
+                return None
+        return SqliteDocstore(get_db_path(memory_id))
+
+    def adopt(self, memory_id: str, vector_store) -> MemoryStore:
+        """接管 mem0 FAISS 向量库；已有常驻存储或磁盘数据时直接复用"""
+        store = self.get(memory_id)
+        if store is None:
+            with self._migrate_lock:
+                with self._lock:
+                    store = self._stores.get(memory_id)
+                if store is None:
+                    store = MemoryStore.create(memory_id, vector_store)
+                    with self._lock:
+                        store = self._stores.setdefault(memory_id, store)
+        store.last_used = time.monotonic()
+        return store
+
+    def invalidate(self, memory_id: str, discard: bool = False):
+        with self._lock:
+            store = self._stores.pop(memory_id, None)
+        if store is not None:
+            store.close(discard=discard)
+        if discard:
+            # 目录即将被删除，先关掉元数据库的连接
+            close_pool(get_db_path(memory_id))
+
+    def evict_idle(self) -> List[str]:
+        """释放空闲的存储（先写盘），返回被释放的 memoryId"""
+        evicted = []
+        with self._migrate_lock:
+            now = time.monotonic()
+            with self._lock:
+                idle = [mid for mid, s in self._stores.items() if now - s.last_used > self.idle_ttl]
+                stores = [(mid, self._stores.pop(mid)) for mid in idle]
+            for mid, store in stores:
+                try:
+                    store.close()
+                except Exception as e:
+                    # 写盘失败：保留常驻，下次再试
+                    print(f"Failed to save memory {mid}: {e}")
+                    with self._lock:
+                        self._stores.setdefault(mid, store)
+                    continue
+                evicted.append(mid)
+        return evicted
+
+    def flush_all(self):
+        with self._lock:
+            stores = list(self._stores.values())
+        for store in stores:
+            store.flush()
+
+
+memory_stores = MemoryStoreRegistry()
+
+
+def attach_memory_store(memory, memory_id: str):
+    """
+    让 mem0 的 FAISS 向量库使用共享的常驻存储：写入走 add_with_ids，
+    删除走 remove_ids，元数据读写走 SQLite，索引保存改为延迟的原子写盘。
+    """
+    vector_store = memory.vector_store
+    if getattr(vector_store, "_sap_store", None) is not None:
+        return memory
+    store = memory_stores.adopt(memory_id, vector_store)
+    vector_store.index = store.index
+    vector_store.docstore = store.docstore
+    vector_store.index_to_id = store.index_to_id
+
+    def insert(vectors, payloads=None, ids=None):
+        store.insert(vectors, payloads, ids)
+
+    def delete(vector_id):
+        store.delete_uuid(vector_id)
+
+    def update(vector_id, vector=None, payload=None):
+        store.update(vector_id, vector, payload)
+
+    raw_search = vector_store.search
+
+    def search(*args, **kwargs):
+        # 查询向量在 Memory 层已算好，这里只锁住 FAISS 查找，避免与删除/写入并发
+        with store.lock:
+            store.last_used = time.monotonic()
+            return raw_search(*args, **kwargs)
+
+    vector_store.search = search
+    vector_store.insert = insert
+    vector_store.delete = delete
+    vector_store.update = update
+    vector_store._save = store.save_soon
+    vector_store._sap_store = store
+    return memory
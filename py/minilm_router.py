@@ -1,10 +1,14 @@
+import base64
 import onnxruntime as ort
 from transformers import BertTokenizerFast
 import numpy as np
 import os
+import queue
 import threading
-from typing import List, Union, Any, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Literal, Union, Any, Dict, Optional, Tuple
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 import asyncio
 import time
@@ -13,12 +17,62 @@ from py.get_setting import DEFAULT_EBD_DIR
 
 MODEL_NAME = "paraphrase-multilingual-MiniLM-L12-v2"
 MODEL_PATH = os.path.join(DEFAULT_EBD_DIR, MODEL_NAME)
+# 单次推理的句子数上限与补齐后 token 总数上限，限制构建知识库时的峰值内存
+MAX_BATCH_SIZE = int(os.environ.get("SAP_MINILM_MAX_BATCH_SIZE", "32"))
+MAX_BATCH_TOKENS = int(os.environ.get("SAP_MINILM_MAX_BATCH_TOKENS", "16384"))
+
+# ---------- ONNX Runtime 会话配置 ----------
+# 会话数 >1 时并发请求可在不同会话上并行推理；线程数为 0 表示交给 ONNX Runtime 自动决定
+SESSION_COUNT = max(1, int(os.environ.get("SAP_MINILM_SESSIONS", "1")))
+INTRA_OP_THREADS = int(os.environ.get("SAP_MINILM_INTRA_THREADS", "0"))
+INTER_OP_THREADS = int(os.environ.get("SAP_MINILM_INTER_THREADS", "0"))
+GRAPH_OPT_LEVEL = os.environ.get("SAP_MINILM_GRAPH_OPT", "all")
+ENABLE_MEM_ARENA = os.environ.get("SAP_MINILM_MEM_ARENA", "1") == "1"
+# 为 1 时把 CPU 核心均分给各会话，并把会话的 intra-op 线程绑定到对应核心组
+PIN_CORE_GROUPS = os.environ.get("SAP_MINILM_PIN_CORES", "0") == "1"
+
+_GRAPH_OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+def _core_groups(n: int) -> List[List[int]]:
+    """把当前进程可用的逻辑核心均分为 n 组"""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    size = max(1, len(cores) // n)
+    return [cores[i * size:(i + 1) * size] or cores for i in range(n)]
+
+def build_session_options(core_group: Optional[List[int]] = None) -> ort.SessionOptions:
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = _GRAPH_OPT_LEVELS.get(GRAPH_OPT_LEVEL, ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    opts.enable_cpu_mem_arena = ENABLE_MEM_ARENA
+    opts.enable_mem_pattern = ENABLE_MEM_ARENA
+    if INTER_OP_THREADS > 0:
+        opts.inter_op_num_threads = INTER_OP_THREADS
+    if INTRA_OP_THREADS > 0:
+        opts.intra_op_num_threads = INTRA_OP_THREADS
+    elif core_group:
+        opts.intra_op_num_threads = len(core_group)
+    if core_group and PIN_CORE_GROUPS and opts.intra_op_num_threads > 1:
+        # 亲和性列表不包含调用线程本身，编号从 1 开始
+        affinities = ";".join(str(c + 1) for c in core_group[1:opts.intra_op_num_threads])
+        try:
+            opts.add_session_config_entry("session.intra_op_thread_affinities", affinities)
+        except Exception as e:
+            print(f"MiniLM: failed to pin intra-op threads: {e}")
+    return opts
 
 # ---------- MiniLM ONNX Predictor ----------
 class MiniLMOnnxPredictor:
-    def __init__(self, model_dir: str, use_gpu: bool = False):
+    def __init__(self, model_dir: str, use_gpu: bool = False, num_sessions: int = SESSION_COUNT):
         self.model_dir = model_dir
         self.is_loaded = False
+        self.num_sessions = max(1, num_sessions)
         if not self._check_files_exist():
             return
         try:
@@ -30,21 +84,36 @@ class MiniLMOnnxPredictor:
                           else os.path.join(model_dir, "model.onnx"))
             if not os.path.exists(model_path):
                 raise FileNotFoundError(model_path)
-            self.session = ort.InferenceSession(model_path, providers=providers)
+            # 多会话时各自分到一组核心，避免线程数超额
+            groups = _core_groups(self.num_sessions) if self.num_sessions > 1 else [None]
+            self.sessions = [
+                ort.InferenceSession(model_path, sess_options=build_session_options(group), providers=providers)
+                for group in groups
+            ]
+            self.session = self.sessions[0]
+            self._free_sessions: "queue.Queue[ort.InferenceSession]" = queue.Queue()
+            for sess in self.sessions:
+                self._free_sessions.put(sess)
+            self._executor = (ThreadPoolExecutor(max_workers=self.num_sessions, thread_name_prefix="minilm")
+                              if self.num_sessions > 1 else None)
             self.input_names = [i.name for i in self.session.get_inputs()]
-            print(f"MiniLM ONNX Predictor loaded from: {model_path}")
+            print(f"MiniLM ONNX Predictor loaded from: {model_path} ({self.num_sessions} session(s))")
             self.is_loaded = True
         except Exception as e:
             print(f"Error loading MiniLM ONNX Predictor: {e}")
             self.is_loaded = False
 
-    def _check_files_exist(self) -> bool:
-        onnx_ok = os.path.exists(os.path.join(self.model_dir, "model_O4.onnx")) or \
-                  os.path.exists(os.path.join(self.model_dir, "model.onnx"))
-        tok_ok  = os.path.exists(os.path.join(self.model_dir, "tokenizer.json")) or \
-                  os.path.exists(os.path.join(self.model_dir, "vocab.txt"))
+    @staticmethod
+    def files_exist(model_dir: str) -> bool:
+        onnx_ok = os.path.exists(os.path.join(model_dir, "model_O4.onnx")) or \
+                  os.path.exists(os.path.join(model_dir, "model.onnx"))
+        tok_ok  = os.path.exists(os.path.join(model_dir, "tokenizer.json")) or \
+                  os.path.exists(os.path.join(model_dir, "vocab.txt"))
         return onnx_ok and tok_ok
 
+    def _check_files_exist(self) -> bool:
+        return self.files_exist(self.model_dir)
+
     def mean_pooling(self, model_output: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
         token_embeddings = model_output
         mask = np.expand_dims(attention_mask, -1).astype(float)
@@ -55,30 +124,79 @@ class MiniLMOnnxPredictor:
         norm = np.linalg.norm(v, axis=1, keepdims=True)
         return v / np.clip(norm, a_min=1e-9, a_max=None)
 
-    def predict(self, sentences: List[str]) -> np.ndarray:
+    def _run_batch(self, batch_ids: List[List[int]]) -> np.ndarray:
+        """把一个长度桶内的 token 序列补齐到桶内最长长度后推理"""
+        max_len = max(len(ids) for ids in batch_ids)
+        pad_id = self.tokenizer.pad_token_id or 0
+        input_ids = np.full((len(batch_ids), max_len), pad_id, dtype=np.int64)
+        attention_mask = np.zeros((len(batch_ids), max_len), dtype=np.int64)
+        for row, ids in enumerate(batch_ids):
+            input_ids[row, :len(ids)] = ids
+            attention_mask[row, :len(ids)] = 1
+        ort_inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            ort_inputs["token_type_ids"] = np.zeros_like(input_ids)
+        # 从空闲队列借用一个会话，多个线程可在不同会话上并行推理
+        session = self._free_sessions.get()
+        try:
+            outputs = session.run(None, ort_inputs)
+        finally:
+            self._free_sessions.put(session)
+        return self.mean_pooling(outputs[0], attention_mask)
+
+    def predict(self, sentences: List[str], max_batch_size: Optional[int] = None) -> Tuple[np.ndarray, List[int]]:
+        """
+        返回 (归一化后的向量, 每句 token 数)。
+        只分词一次；按 token 长度排序后切成长度桶，每桶只补齐到桶内最长句子，
+        单桶句子数不超过 max_batch_size，补齐后的 token 总数不超过 MAX_BATCH_TOKENS。
+        """
         if not self.is_loaded:
             raise RuntimeError("Model not loaded. Cannot run prediction.")
-        inputs = self.tokenizer(sentences, padding=True, truncation=True, max_length=512, return_tensors="np")
-        ort_inputs = {"input_ids": inputs["input_ids"].astype(np.int64),
-                      "attention_mask": inputs["attention_mask"].astype(np.int64)}
-        if "token_type_ids" in self.input_names:
-            tti = inputs.get("token_type_ids")
-            ort_inputs["token_type_ids"] = (tti.astype(np.int64) if tti is not None else
-                                            np.zeros_like(inputs["input_ids"], dtype=np.int64))
-        outputs = self.session.run(None, ort_inputs)
-        embeddings = self.mean_pooling(outputs[0], inputs["attention_mask"])
-        return self.normalize(embeddings).astype(np.float32)
+        max_batch_size = max_batch_size or MAX_BATCH_SIZE
+        encoded = self.tokenizer(sentences, truncation=True, max_length=512)["input_ids"]
+        num_special = self.tokenizer.num_special_tokens_to_add()
+        token_counts = [max(len(ids) - num_special, 0) for ids in encoded]
+
+        order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+        buckets = []
+        start = 0
+        while start < len(order):
+            end = start + 1
+            # 升序排列，桶内最长的总是最后一个
+            while (end < len(order) and end - start < max_batch_size
+                   and (end - start + 1) * len(encoded[order[end]]) <= MAX_BATCH_TOKENS):
+                end += 1
+            buckets.append(order[start:end])
+            start = end
+
+        def run(bucket):
+            return bucket, self._run_batch([encoded[i] for i in bucket])
+
+        # 多个桶且有多个会话时并行推理
+        if self._executor is not None and len(buckets) > 1:
+            outputs = self._executor.map(run, buckets)
+        else:
+            outputs = map(run, buckets)
+        result = None
+        for bucket, embs in outputs:
+            if result is None:
+                result = np.empty((len(sentences), embs.shape[1]), dtype=np.float32)
+            result[bucket] = self.normalize(embs)
+        if result is None:
+            result = np.empty((0, 0), dtype=np.float32)
+        return result, token_counts
 
 # ---------- 带热重载的池子 ----------
 class MiniLMPool:
-    def __init__(self, model_dir: str, use_gpu: bool = False):
+    def __init__(self, model_dir: str, use_gpu: bool = False, num_sessions: int = SESSION_COUNT):
         self.model_dir = model_dir
         self.use_gpu   = use_gpu
+        self.num_sessions = num_sessions
         self._predictor: Optional[MiniLMOnnxPredictor] = None
         self._lock     = threading.Lock()
 
     def _really_load(self) -> MiniLMOnnxPredictor:
-        return MiniLMOnnxPredictor(self.model_dir, self.use_gpu)
+        return MiniLMOnnxPredictor(self.model_dir, self.use_gpu, self.num_sessions)
 
     def get(self) -> MiniLMOnnxPredictor:
         if self._predictor and self._predictor.is_loaded:
@@ -86,7 +204,8 @@ class MiniLMPool:
         with self._lock:
             if self._predictor and self._predictor.is_loaded:
                 return self._predictor
-            if not MiniLMOnnxPredictor(model_dir=self.model_dir)._check_files_exist():
+            # 只检查文件，不创建会话
+            if not MiniLMOnnxPredictor.files_exist(self.model_dir):
                 raise RuntimeError("Model files not found")
             self._predictor = self._really_load()
             if not self._predictor.is_loaded:
@@ -95,16 +214,121 @@ class MiniLMPool:
 
 minilm_pool = MiniLMPool(MODEL_PATH, use_gpu=False)
 
+# ---------- 动态微批处理 ----------
+# 并发的小请求（知识库查询、mem0、机器人）在短时间窗口内合并为一次推理
+BATCH_WAIT_MS = float(os.environ.get("SAP_MINILM_BATCH_WAIT_MS", "5"))
+BATCH_MAX_SENTENCES = int(os.environ.get("SAP_MINILM_BATCH_MAX", "64"))
+
+class EmbeddingBatcher:
+    def __init__(self, pool: MiniLMPool, wait_ms: float = BATCH_WAIT_MS, max_sentences: int = BATCH_MAX_SENTENCES):
+        self.pool = pool
+        self.wait = wait_ms / 1000
+        self.max_sentences = max_sentences
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        # 指标
+        self.pending_sentences = 0
+        self.requests = 0
+        self.batches = 0
+        self.sentences = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+
+    async def submit(self, texts: List[str]) -> Tuple[np.ndarray, List[int]]:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            # 同时在途的批次数与会话数一致
+            self._slots = asyncio.Semaphore(self.pool.num_sessions)
+            self._worker = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        self.pending_sentences += len(texts)
+        self.requests += 1
+        await self._queue.put((texts, fut))
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            count = len(items[0][0])
+            deadline = loop.time() + self.wait
+            # 收集窗口：等到超时或句子数达到上限
+            while count < self.max_sentences:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                items.append(item)
+                count += len(item[0])
+            self.pending_sentences -= count
+            await self._slots.acquire()
+            self.in_flight += 1
+            asyncio.create_task(self._process_and_release(items))
+
+    async def _process_and_release(self, items):
+        try:
+            await self._process(items)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    async def _process(self, items):
+        texts = [t for item_texts, _ in items for t in item_texts]
+        try:
+            predictor = self.pool.get()
+            # predict 内部按 token 长度分桶，合并后的请求只需一次调用
+            embs, token_counts = await asyncio.to_thread(predictor.predict, texts)
+        except Exception as e:
+            for _, fut in items:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.batches += 1
+        self.sentences += len(texts)
+        self.last_batch_size = len(texts)
+        self.max_batch_size = max(self.max_batch_size, len(texts))
+        offset = 0
+        for item_texts, fut in items:
+            end = offset + len(item_texts)
+            if not fut.done():
+                fut.set_result((embs[offset:end], token_counts[offset:end]))
+            offset = end
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "pending_sentences": self.pending_sentences,
+            "in_flight": self.in_flight,
+            "sessions": self.pool.num_sessions,
+            "requests": self.requests,
+            "batches": self.batches,
+            "sentences": self.sentences,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": round(self.sentences / self.batches, 2) if self.batches else 0,
+            "wait_ms": self.wait * 1000,
+            "max_sentences": self.max_sentences,
+        }
+
+minilm_batcher = EmbeddingBatcher(minilm_pool)
+
 # ---------- FastAPI 数据模型 ----------
 router = APIRouter(prefix="/minilm", tags=["MiniLM Embeddings (OpenAI Compatible)"])
 
 class EmbeddingRequest(BaseModel):
     input: Union[str, List[str]]
     model: str = MODEL_NAME
+    # 与 OpenAI 一致："float" 返回浮点列表，"base64" 返回小端 float32 原始字节的 base64
+    encoding_format: Literal["float", "base64"] = "float"
 
 class EmbeddingData(BaseModel):
     object: str = "embedding"
-    embedding: List[float]
+    embedding: Union[List[float], str]
     index: int
 
 class EmbeddingResponse(BaseModel):
@@ -127,17 +351,29 @@ async def create_embeddings(request: EmbeddingRequest,
                             predictor: MiniLMOnnxPredictor = Depends(get_minilm_predictor)):
     start = time.time()
     texts = [request.input] if isinstance(request.input, str) else request.input
-    num_tokens = sum(len(predictor.tokenizer.tokenize(t)) for t in texts)
     try:
-        embs = await asyncio.to_thread(predictor.predict, texts)
+        embs, token_counts = await minilm_batcher.submit(texts)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Inference failed: {e}")
-    data = [EmbeddingData(embedding=emb.tolist(), index=i) for i, emb in enumerate(embs)]
-    return EmbeddingResponse(model=request.model,
-                             data=data,
-                             usage={"prompt_tokens": num_tokens,
-                                    "total_tokens": num_tokens,
-                                    "inference_time_ms": int((time.time() - start) * 1000)})
+    num_tokens = sum(token_counts)
+    # 直接构造 dict 并返回 JSONResponse，跳过逐条 pydantic 校验
+    if request.encoding_format == "base64":
+        embs = np.ascontiguousarray(embs, dtype="<f4")
+        data = [{"object": "embedding", "embedding": base64.b64encode(emb.tobytes()).decode("ascii"), "index": i}
+                for i, emb in enumerate(embs)]
+    else:
+        data = [{"object": "embedding", "embedding": emb, "index": i} for i, emb in enumerate(embs.tolist())]
+    return JSONResponse({"object": "list",
+                         "data": data,
+                         "model": request.model,
+                         "usage": {"prompt_tokens": num_tokens,
+                                   "total_tokens": num_tokens,
+                                   "inference_time_ms": int((time.time() - start) * 1000)}})
+
+# ---------- 批处理指标 ----------
+@router.get("/metrics")
+async def batcher_metrics():
+    return minilm_batcher.metrics()
 
 # ---------- 强制重载接口 ----------
 @router.post("/reload")
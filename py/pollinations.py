@@ -3,13 +3,13 @@ import os
 import re
 
 import requests
-from py.get_setting import load_settings,get_host,get_port,UPLOAD_FILES_DIR
+from py.get_setting import get_settings_snapshot,get_host,get_port,UPLOAD_FILES_DIR
 from openai import AsyncClient
 import uuid
 
 from py.llm_tool import get_image_base64, get_image_media_type
 async def pollinations_image(prompt: str, width=512, height=512, model="flux"):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     
     # Check if the provided values are default ones, if so, override them with settings
     if width == 512:
@@ -64,7 +64,7 @@ pollinations_image_tool = {
 }
 
 async def openai_image(prompt: str, size="auto"):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
 
     # Check if the provided values are default ones, if so, override them with settings
     if size == "auto":
@@ -165,7 +165,7 @@ def process_image_content(text):
 
 
 async def openai_chat_image(prompt: str,img_url_list: list = []):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
 
     model = settings["text2imgSettings"]["model"]
     content = ""
@@ -8,7 +8,7 @@ import weakref
 import aiohttp
 import botpy
 from botpy.message import C2CMessage, GroupMessage
-from openai import AsyncOpenAI
+from py.llm_client_pool import get_llm_client
 import logging
 import re
 import time
@@ -365,10 +365,7 @@ class MyClient(botpy.Client):
         if not self.is_running:
             return
         settings = await load_settings()
-        client = AsyncOpenAI(
-            api_key="super-secret-key",
-            base_url=f"http://127.0.0.1:{self.port}/v1"
-        )
+        client = get_llm_client("OpenAI", f"http://127.0.0.1:{self.port}/v1", "super-secret-key")
         
         user_content = []
         image_url_list = []
@@ -632,10 +629,7 @@ class MyClient(botpy.Client):
         if not self.is_running:
             return
         settings = await load_settings()
-        client = AsyncOpenAI(
-            api_key="super-secret-key",
-            base_url=f"http://127.0.0.1:{self.port}/v1"
-        )
+        client = get_llm_client("OpenAI", f"http://127.0.0.1:{self.port}/v1", "super-secret-key")
         user_content = []
         image_url_list = []
         if message.attachments:
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, List
+
+import aiosqlite
+
+# 共享的 SQLite 连接池：settings / conversations / users 各自一个池，连接常驻复用，
+# 打开时统一设置 WAL 与缓存相关 pragma。WAL 下读不阻塞写、写不阻塞读，
+# 多个连接之间只有写事务互斥（busy_timeout 内等待）。
+SQLITE_POOL_SIZE = int(os.environ.get("SAP_SQLITE_POOL_SIZE", "4"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SAP_SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# 负数表示 KiB，-8000 ≈ 8MB 页缓存
+SQLITE_CACHE_SIZE = int(os.environ.get("SAP_SQLITE_CACHE_SIZE", "-8000"))
+# sqlite3 模块对每个连接缓存的预编译语句数量
+SQLITE_STATEMENT_CACHE = 256
+
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    # WAL 下 NORMAL 只在检查点时 fsync，掉电最多丢最近的事务，不会损坏数据库
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA cache_size={SQLITE_CACHE_SIZE}",
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+)
+
+
+class SQLitePool:
+    """同步连接池（sqlite3），供线程池中的阻塞代码使用"""
+    def __init__(self, path: str, size: int = SQLITE_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(
+            self.path,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=SQLITE_STATEMENT_CACHE,
+        )
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._open()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class AsyncSQLitePool:
+    """异步连接池（aiosqlite），接口与 aiosqlite.connect 一致：async with pool.acquire() as db"""
+    def __init__(self, path: str, size: int = SQLITE_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle: List[aiosqlite.Connection] = []
+        # 用线程锁而不是 asyncio.Queue：池可能被不同事件循环（机器人线程等）使用
+        self._lock = threading.Lock()
+
+    async def _open(self) -> aiosqlite.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        db = await aiosqlite.connect(
+            self.path,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=SQLITE_STATEMENT_CACHE,
+        )
+        for pragma in _PRAGMAS:
+            await db.execute(pragma)
+        return db
+
+    @asynccontextmanager
+    async def acquire(self):
+        with self._lock:
+            db = self._idle.pop() if self._idle else None
+        if db is None:
+            db = await self._open()
+        healthy = True
+        try:
+            yield db
+        except BaseException:
+            healthy = False
+            raise
+        finally:
+            try:
+                if db.in_transaction:
+                    await db.rollback()
+            except Exception:
+                healthy = False
+            keep = False
+            if healthy:
+                with self._lock:
+                    if len(self._idle) < self.size:
+                        self._idle.append(db)
+                        keep = True
+            if not keep:
+                try:
+                    await db.close()
+                except Exception:
+                    pass
+
+    async def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db in idle:
+            await db.close()
+
+
+_sync_pools: Dict[str, SQLitePool] = {}
+_async_pools: Dict[str, AsyncSQLitePool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path: str) -> SQLitePool:
+    path = os.path.abspath(path)
+    with _pools_lock:
+        pool = _sync_pools.get(path)
+        if pool is None:
+            pool = _sync_pools[path] = SQLitePool(path)
+        return pool
+
+
+def get_async_pool(path: str) -> AsyncSQLitePool:
+    path = os.path.abspath(path)
+    with _pools_lock:
+        pool = _async_pools.get(path)
+        if pool is None:
+            pool = _async_pools[path] = AsyncSQLitePool(path)
+        return pool
+
+
+def close_pool(path: str):
+    """关闭并移除某个数据库文件的同步连接池（删除数据库文件前调用）"""
+    path = os.path.abspath(path)
+    with _pools_lock:
+        pool = _sync_pools.pop(path, None)
+    if pool is not None:
+        pool.close()
+
+
+async def close_all_pools():
+    with _pools_lock:
+        sync_pools = list(_sync_pools.values())
+        async_pools = list(_async_pools.values())
+    for pool in sync_pools:
+        pool.close()
+    for pool in async_pools:
+        await pool.close()
@@ -1,6 +1,6 @@
 import asyncio, aiohttp, io, base64, json, logging, re, time
 from typing import Dict, List, Any, Optional
-from openai import AsyncOpenAI
+from py.llm_client_pool import get_llm_client
 from py.get_setting import get_port, load_settings
 
 class TelegramClient:
@@ -162,7 +162,7 @@ class TelegramClient:
         self.memoryList[chat_id].append(user_msg)
 
         settings = await load_settings()
-        client = AsyncOpenAI(api_key="super-secret-key", base_url=f"http://127.0.0.1:{get_port()}/v1")
+        client = get_llm_client("OpenAI", f"http://127.0.0.1:{get_port()}/v1", "super-secret-key")
 
         state = {"text_buffer": "", "image_cache": []}
         full_response = []
@@ -292,8 +292,8 @@ class TelegramClient:
         return buffer.strip()
 
     async def _send_voice(self, chat_id: int, text: str):
-        from py.get_setting import load_settings
-        settings = await load_settings()
+        from py.get_setting import get_settings_snapshot
+        settings = await get_settings_snapshot()
         tts_settings = settings.get("ttsSettings", {})
         index = 0
         text = self.clean_markdown(text)
@@ -0,0 +1,413 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from py.get_setting import FrozenDict, FrozenList
+
+# 工具注册表：内置工具的模块只导入一次，工具 schema 与 名称→实现 的映射按
+# “工具相关设置 + MCP 连接状态”的指纹缓存，设置或 MCP 变化时才重建。
+# 每次对话直接复用缓存的 ToolSet，不再重复 import、不再每轮向 MCP 服务器发 list_tools。
+TOOL_REGISTRY_MAX_BUILDS = int(os.environ.get("SAP_TOOL_REGISTRY_MAX_BUILDS", "8"))
+
+# 决定工具列表的设置项；其余设置（模型、温度等）变化不会触发重建
+TOOL_SETTING_KEYS = (
+    "mcpServers",
+    "llmTools",
+    "agents",
+    "a2aServers",
+    "HASettings",
+    "chromeMCPSettings",
+    "sqlSettings",
+    "CLISettings",
+    "tools",
+    "text2imgSettings",
+    "codeSettings",
+    "custom_http",
+    "workflows",
+    "webSearch",
+)
+
+COMFYUI_TEXT_INPUT_DESCRIPTIONS = {
+    "text_input": "第一个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
+    "text_input_2": "第二个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
+    "image_input": "第一个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
+    "image_input_2": "第二个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
+}
+COMFYUI_RESULT_HINT = "+\n如果要输入图片提示词或者修改提示词，尽可能使用英语。\n返回的图片结果，请将图片的URL放入![image]()这样的markdown语法中，用户才能看到图片。如果是视频，请将视频的URL放入<video controls> <source src=''></video>的中src中，用户才能看到视频。如果有多个结果，则请用换行符分隔开这几个图片或者视频，用户才能看到多个结果。"
+
+WEB_SEARCH_ENGINE_TOOLS = {
+    "duckduckgo": "duckduckgo_tool",
+    "searxng": "searxng_tool",
+    "tavily": "tavily_tool",
+    "bing": "bing_tool",
+    "google": "google_tool",
+    "brave": "brave_tool",
+    "exa": "exa_tool",
+    "serper": "serper_tool",
+    "bochaai": "bochaai_tool",
+}
+WEB_SEARCH_CRAWLER_TOOLS = {
+    "jina": "jina_crawler_tool",
+    "crawl4ai": "Crawl4Ai_tool",
+}
+
+
+def _load_builtins() -> Tuple[Dict[str, Callable], Dict[str, dict]]:
+    """导入内置工具模块（只执行一次），返回 (名称→实现, 变量名→schema)"""
+    from py.web_search import (
+        DDGsearch_async,
+        searxng_async,
+        Tavily_search_async,
+        Bing_search_async,
+        Google_search_async,
+        Brave_search_async,
+        Exa_search_async,
+        Serper_search_async,
+        bochaai_search_async,
+        jina_crawler_async,
+        Crawl4Ai_search_async,
+        duckduckgo_tool,
+        searxng_tool,
+        tavily_tool,
+        bing_tool,
+        google_tool,
+        brave_tool,
+        exa_tool,
+        serper_tool,
+        bochaai_tool,
+        jina_crawler_tool,
+        Crawl4Ai_tool,
+    )
+    from py.know_base import kb_tool, query_knowledge_base
+    from py.agent_tool import agent_tool_call
+    from py.a2a_tool import a2a_tool_call
+    from py.llm_tool import custom_llm_tool
+    from py.pollinations import (
+        pollinations_image,
+        openai_image,
+        openai_chat_image,
+        pollinations_image_tool,
+        openai_image_tool,
+        openai_chat_image_tool,
+    )
+    from py.load_files import get_file_content, file_tool, image_tool
+    from py.code_interpreter import e2b_code_async, local_run_code_async, e2b_code_tool, local_run_code_tool
+    from py.utility_tools import (
+        time_async,
+        get_weather_async,
+        get_location_coordinates_async,
+        get_weather_by_city_async,
+        get_wikipedia_summary_and_sections,
+        get_wikipedia_section_content,
+        search_arxiv_papers,
+        time_tool,
+        weather_tool,
+        location_tool,
+        timer_weather_tool,
+        wikipedia_summary_tool,
+        wikipedia_section_tool,
+        arxiv_tool,
+    )
+    from py.comfyui_tool import comfyui_tool_call
+    from py.autoBehavior import auto_behavior, auto_behavior_tool
+    from py.cli_tool import claude_code_async, qwen_code_async, claude_code_tool, qwen_code_tool
+    hooks = {
+        "DDGsearch_async": DDGsearch_async,
+        "searxng_async": searxng_async,
+        "Tavily_search_async": Tavily_search_async,
+        "query_knowledge_base": query_knowledge_base,
+        "jina_crawler_async": jina_crawler_async,
+        "Crawl4Ai_search_async": Crawl4Ai_search_async,
+        "agent_tool_call": agent_tool_call,
+        "a2a_tool_call": a2a_tool_call,
+        "custom_llm_tool": custom_llm_tool,
+        "pollinations_image": pollinations_image,
+        "get_file_content": get_file_content,
+        "e2b_code_async": e2b_code_async,
+        "local_run_code_async": local_run_code_async,
+        "openai_image": openai_image,
+        "openai_chat_image": openai_chat_image,
+        "Bing_search_async": Bing_search_async,
+        "Google_search_async": Google_search_async,
+        "Brave_search_async": Brave_search_async,
+        "Exa_search_async": Exa_search_async,
+        "Serper_search_async": Serper_search_async,
+        "bochaai_search_async": bochaai_search_async,
+        "comfyui_tool_call": comfyui_tool_call,
+        "time_async": time_async,
+        "get_weather_async": get_weather_async,
+        "get_location_coordinates_async": get_location_coordinates_async,
+        "get_weather_by_city_async": get_weather_by_city_async,
+        "get_wikipedia_summary_and_sections": get_wikipedia_summary_and_sections,
+        "get_wikipedia_section_content": get_wikipedia_section_content,
+        "search_arxiv_papers": search_arxiv_papers,
+        "auto_behavior": auto_behavior,
+        "claude_code_async": claude_code_async,
+        "qwen_code_async": qwen_code_async,
+    }
+    schemas = {
+        "duckduckgo_tool": duckduckgo_tool,
+        "searxng_tool": searxng_tool,
+        "tavily_tool": tavily_tool,
+        "bing_tool": bing_tool,
+        "google_tool": google_tool,
+        "brave_tool": brave_tool,
+        "exa_tool": exa_tool,
+        "serper_tool": serper_tool,
+        "bochaai_tool": bochaai_tool,
+        "jina_crawler_tool": jina_crawler_tool,
+        "Crawl4Ai_tool": Crawl4Ai_tool,
+        "kb_tool": kb_tool,
+        "pollinations_image_tool": pollinations_image_tool,
+        "openai_image_tool": openai_image_tool,
+        "openai_chat_image_tool": openai_chat_image_tool,
+        "file_tool": file_tool,
+        "image_tool": image_tool,
+        "e2b_code_tool": e2b_code_tool,
+        "local_run_code_tool": local_run_code_tool,
+        "time_tool": time_tool,
+        "weather_tool": weather_tool,
+        "location_tool": location_tool,
+        "timer_weather_tool": timer_weather_tool,
+        "wikipedia_summary_tool": wikipedia_summary_tool,
+        "wikipedia_section_tool": wikipedia_section_tool,
+        "arxiv_tool": arxiv_tool,
+        "auto_behavior_tool": auto_behavior_tool,
+        "claude_code_tool": claude_code_tool,
+        "qwen_code_tool": qwen_code_tool,
+    }
+    return hooks, schemas
+
+
+def custom_http_schema(custom_http) -> dict:
+    return {
+        "type": "function",
+        "function": {
+            "name": f"custom_http_{custom_http['name']}",
+            "description": f"{custom_http['description']}",
+            "parameters": json.loads(custom_http['body'] or "{}"),
+        },
+    }
+
+
+def comfyui_schema(workflow) -> dict:
+    comfyui_properties = {}
+    comfyui_required = []
+    for field, description in COMFYUI_TEXT_INPUT_DESCRIPTIONS.items():
+        if workflow[field] is not None:
+            comfyui_properties[field] = {
+                "description": description,
+                "type": "string"
+            }
+            comfyui_required.append(field)
+    return {
+        "type": "function",
+        "function": {
+            "name": f"comfyui_{workflow['unique_filename']}",
+            "description": f"{workflow['description']}{COMFYUI_RESULT_HINT}",
+            "parameters": {
+                "type": "object",
+                "properties": comfyui_properties,
+                "required": comfyui_required
+            },
+        },
+    }
+
+
+class ToolSet:
+    """某一份工具相关设置对应的工具集合（只读，按版本号区分）"""
+    def __init__(self, version: int, schemas: List[dict], search_tools: List[dict],
+                 mcp_routes: Dict[str, Any], auto_behavior_tool: Optional[dict], kb_tool: dict):
+        self.version = version
+        # 由设置决定的工具 schema（不含依赖本次请求的联网搜索 / 知识库 / autoBehavior）
+        self.schemas = schemas
+        # 当前搜索引擎与爬虫对应的 schema，after_thinking 模式下追加
+        self.search_tools = search_tools
+        # MCP / HA / ChromeMCP / SQL 工具名 → 客户端
+        self.mcp_routes = mcp_routes
+        self.auto_behavior_tool = auto_behavior_tool
+        self.kb_tool = kb_tool
+
+
+class ToolRegistry:
+    def __init__(self, max_builds: int = TOOL_REGISTRY_MAX_BUILDS):
+        self.max_builds = max_builds
+        self._hooks: Optional[Dict[str, Callable]] = None
+        self._extra_hooks: Dict[str, Callable] = {}
+        self._schemas: Optional[Dict[str, dict]] = None
+        self._builds: "OrderedDict[Tuple, ToolSet]" = OrderedDict()
+        # 冻结子树 id → (子树, 指纹)，持有引用保证 id 不被复用
+        self._fingerprints: "OrderedDict[int, Tuple[Any, str]]" = OrderedDict()
+        self._versions = itertools.count(1)
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self.builds = 0
+
+    # ---------- 内置工具 ----------
+    def _ensure_builtins(self):
+        if self._hooks is None:
+            hooks, schemas = _load_builtins()
+            hooks.update(self._extra_hooks)
+            self._schemas = schemas
+            self._hooks = hooks
+
+    def register_hook(self, name: str, func: Callable):
+        """注册 server.py 中定义的工具实现（如 get_image_content）"""
+        self._extra_hooks[name] = func
+        if self._hooks is not None:
+            self._hooks[name] = func
+
+    @property
+    def hooks(self) -> Dict[str, Callable]:
+        self._ensure_builtins()
+        return self._hooks
+
+    def schema(self, name: str) -> dict:
+        self._ensure_builtins()
+        return self._schemas[name]
+
+    # ---------- 缓存键 ----------
+    def _fingerprint(self, value) -> str:
+        if isinstance(value, (FrozenDict, FrozenList)):
+            entry = self._fingerprints.get(id(value))
+            if entry is not None and entry[0] is value:
+                self._fingerprints.move_to_end(id(value))
+                return entry[1]
+        raw = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+        fp = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+        if isinstance(value, (FrozenDict, FrozenList)):
+            self._fingerprints[id(value)] = (value, fp)
+            while len(self._fingerprints) > self.max_builds * len(TOOL_SETTING_KEYS):
+                self._fingerprints.popitem(last=False)
+        return fp
+
+    @staticmethod
+    def _client_state(client) -> Tuple:
+        if client is None:
+            return (None,)
+        return (id(client), getattr(client, "_generation", 0))
+
+    def _key(self, settings, mcp_clients: Dict[str, Any], extra_clients: Dict[str, Any]) -> Tuple:
+        return (
+            self._generation,
+            tuple(self._fingerprint(settings.get(k)) for k in TOOL_SETTING_KEYS),
+            tuple((name, self._client_state(c)) for name, c in mcp_clients.items()),
+            tuple((name, self._client_state(c)) for name, c in extra_clients.items()),
+        )
+
+    # ---------- 构建 ----------
+    async def _build(self, settings, mcp_clients: Dict[str, Any], extra_clients: Dict[str, Any]) -> ToolSet:
+        from py.llm_tool import get_llm_tool
+        from py.agent_tool import get_agent_tool
+        from py.a2a_tool import get_a2a_tool
+        self._ensure_builtins()
+        s = self._schemas
+        schemas: List[dict] = []
+        mcp_routes: Dict[str, Any] = {}
+
+        async def add_mcp(client, disable_tools):
+            functions = await client.get_openai_functions(disable_tools=disable_tools)
+            if functions:
+                schemas.extend(functions)
+            # 禁用的工具同样路由到该客户端，与原先按连接工具列表匹配的行为一致
+            for name in getattr(client, "_tools", []):
+                mcp_routes.setdefault(name, client)
+
+        for server_name, mcp_client in mcp_clients.items():
+            server = settings['mcpServers'].get(server_name)
+            if server is None:
+                continue
+            if server.get('disabled', False) == False and server.get('processingStatus') == 'ready':
+                disable_tools = [tool["name"] for tool in server.get("tools", []) if tool.get("enabled", True) == False]
+                await add_mcp(mcp_client, disable_tools)
+        for func in (get_llm_tool, get_agent_tool, get_a2a_tool):
+            tool = await func(settings)
+            if tool:
+                schemas.append(tool)
+        for settings_key, client_name in (("HASettings", "HA"), ("chromeMCPSettings", "ChromeMCP"), ("sqlSettings", "sql")):
+            client = extra_clients.get(client_name)
+            if settings[settings_key]["enabled"] and client is not None:
+                await add_mcp(client, [])
+        if settings['CLISettings']['enabled']:
+            if settings['CLISettings']['engine'] == 'cc':
+                schemas.append(s["claude_code_tool"])
+            elif settings['CLISettings']['engine'] == 'qc':
+                schemas.append(s["qwen_code_tool"])
+        if settings['tools']['time']['enabled'] and settings['tools']['time']['triggerMode'] == 'afterThinking':
+            schemas.append(s["time_tool"])
+        if settings["tools"]["weather"]['enabled']:
+            schemas.extend([s["weather_tool"], s["location_tool"], s["timer_weather_tool"]])
+        if settings["tools"]["wikipedia"]['enabled']:
+            schemas.extend([s["wikipedia_summary_tool"], s["wikipedia_section_tool"]])
+        if settings["tools"]["arxiv"]['enabled']:
+            schemas.append(s["arxiv_tool"])
+        if settings['text2imgSettings']['enabled']:
+            engine_tool = {
+                'pollinations': "pollinations_image_tool",
+                'openai': "openai_image_tool",
+                'openaiChat': "openai_chat_image_tool",
+            }.get(settings['text2imgSettings']['engine'])
+            if engine_tool:
+                schemas.append(s[engine_tool])
+        if settings['tools']['getFile']['enabled']:
+            schemas.extend([s["file_tool"], s["image_tool"]])
+        if settings["codeSettings"]['enabled']:
+            if settings["codeSettings"]["engine"] == "e2b":
+                schemas.append(s["e2b_code_tool"])
+            elif settings["codeSettings"]["engine"] == "sandbox":
+                schemas.append(s["local_run_code_tool"])
+        for custom_http in settings["custom_http"] or []:
+            if custom_http["enabled"]:
+                schemas.append(custom_http_schema(custom_http))
+        for workflow in settings["workflows"] or []:
+            if workflow["enabled"]:
+                schemas.append(comfyui_schema(workflow))
+
+        web_search = settings['webSearch']
+        search_tools = []
+        if web_search['engine'] in WEB_SEARCH_ENGINE_TOOLS:
+            search_tools.append(s[WEB_SEARCH_ENGINE_TOOLS[web_search['engine']]])
+        if web_search['crawler'] in WEB_SEARCH_CRAWLER_TOOLS:
+            search_tools.append(s[WEB_SEARCH_CRAWLER_TOOLS[web_search['crawler']]])
+
+        auto_behavior_tool = s["auto_behavior_tool"] if settings['tools']['autoBehavior']['enabled'] else None
+        self.builds += 1
+        return ToolSet(next(self._versions), schemas, search_tools, mcp_routes, auto_behavior_tool, s["kb_tool"])
+
+    async def get(self, settings, mcp_clients: Optional[Dict[str, Any]] = None,
+                  extra_clients: Optional[Dict[str, Any]] = None) -> ToolSet:
+        mcp_clients = mcp_clients or {}
+        extra_clients = extra_clients or {}
+        key = self._key(settings, mcp_clients, extra_clients)
+        tool_set = self._builds.get(key)
+        if tool_set is not None:
+            self._builds.move_to_end(key)
+            return tool_set
+        async with self._lock:
+            tool_set = self._builds.get(key)
+            if tool_set is None:
+                tool_set = await self._build(settings, mcp_clients, extra_clients)
+                self._builds[key] = tool_set
+                while len(self._builds) > self.max_builds:
+                    self._builds.popitem(last=False)
+            return tool_set
+
+    def invalidate(self):
+        """MCP 服务器增删、工具开关变化等设置以外的变更后调用"""
+        self._generation += 1
+        self._builds.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "builds": self.builds,
+            "cached": len(self._builds),
+            "generation": self._generation,
+            "versions": [t.version for t in self._builds.values()],
+        }
+
+
+tool_registry = ToolRegistry()
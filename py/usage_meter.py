@@ -0,0 +1,201 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from py.get_setting import USER_DATA_DIR
+from py.sqlite_pool import get_pool
+
+# 用量计量：免费用户的每日消息计数 + premium 标记。
+# 判定与计数都在内存中完成（一次加锁的字典操作），计数由后台任务批量写回 sqlite；
+# premium 变更很少发生，直接写穿。取代原来每次请求多次整体读写 premium_users.json 的做法。
+USAGE_DB_PATH = os.path.join(USER_DATA_DIR, "usage.db")
+LEGACY_PREMIUM_FILE = os.path.join(USER_DATA_DIR, "premium_users.json")
+USAGE_FLUSH_INTERVAL = float(os.environ.get("SAP_USAGE_FLUSH_INTERVAL", "5"))
+FREE_DAILY_LIMIT = int(os.environ.get("SAP_FREE_DAILY_LIMIT", "15"))
+
+
+def _today() -> str:
+    return datetime.utcnow().date().isoformat()
+
+
+class UsageMeter:
+    def __init__(self, db_path: str = USAGE_DB_PATH, legacy_file: Optional[str] = LEGACY_PREMIUM_FILE):
+        self.db_path = db_path
+        self.legacy_file = legacy_file
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._premium: Dict[str, dict] = {}
+        # user_key -> (day, count)
+        self._daily: Dict[str, Tuple[str, int]] = {}
+        self._dirty = set()
+
+    # ---------- 持久化 ----------
+    def _init_schema(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS premium_users (
+                user_key TEXT PRIMARY KEY,
+                premium INTEGER NOT NULL DEFAULT 0,
+                since REAL,
+                raw TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS daily_usage (
+                user_key TEXT NOT NULL,
+                day TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_key, day)
+            )
+        """)
+        conn.commit()
+
+    def _migrate_legacy(self, conn):
+        """首次启动时导入旧的 premium_users.json（仅在新表为空时）"""
+        if not self.legacy_file or not os.path.exists(self.legacy_file):
+            return
+        if conn.execute("SELECT 1 FROM premium_users LIMIT 1").fetchone():
+            return
+        if conn.execute("SELECT 1 FROM daily_usage LIMIT 1").fetchone():
+            return
+        try:
+            with open(self.legacy_file, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except Exception as e:
+            print(f"Failed to read legacy premium file: {e}")
+            return
+        for user_key, u in (legacy or {}).items():
+            if not isinstance(u, dict):
+                continue
+            if u.get("premium"):
+                conn.execute(
+                    "INSERT OR REPLACE INTO premium_users (user_key, premium, since, raw) VALUES (?, 1, ?, ?)",
+                    (user_key, u.get("since"), json.dumps(u.get("raw"), ensure_ascii=False)),
+                )
+            if u.get("dailyDate") and u.get("dailyMessagesSent"):
+                conn.execute(
+                    "INSERT OR REPLACE INTO daily_usage (user_key, day, count) VALUES (?, ?, ?)",
+                    (user_key, u["dailyDate"], int(u["dailyMessagesSent"])),
+                )
+        conn.commit()
+        print(f"Migrated {len(legacy or {})} entries from premium_users.json")
+
+    def load(self):
+        if self._loaded:
+            return
+        with get_pool(self.db_path).connection() as conn:
+            self._init_schema(conn)
+            self._migrate_legacy(conn)
+            premium = {
+                r[0]: {"premium": bool(r[1]), "since": r[2]}
+                for r in conn.execute("SELECT user_key, premium, since FROM premium_users")
+            }
+            today = _today()
+            daily = {
+                r[0]: (today, int(r[1]))
+                for r in conn.execute("SELECT user_key, count FROM daily_usage WHERE day = ?", (today,))
+            }
+        with self._lock:
+            if not self._loaded:
+                self._premium = premium
+                self._daily = daily
+                self._loaded = True
+
+    def flush(self):
+        """把有变化的计数批量写回 sqlite"""
+        with self._lock:
+            if not self._dirty:
+                return 0
+            rows = [(k, *self._daily[k]) for k in self._dirty if k in self._daily]
+            self._dirty.clear()
+        try:
+            with get_pool(self.db_path).connection() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO daily_usage (user_key, day, count) VALUES (?, ?, ?)", rows
+                )
+                conn.commit()
+        except Exception:
+            # 写失败时重新标记，下次再刷
+            with self._lock:
+                self._dirty.update(r[0] for r in rows)
+            raise
+        return len(rows)
+
+    # ---------- 查询 / 计数 ----------
+    def is_premium(self, user_key: str) -> bool:
+        self.load()
+        return bool(self._premium.get(user_key, {}).get("premium", False))
+
+    def _count_locked(self, user_key: str, today: str) -> int:
+        day, count = self._daily.get(user_key, (today, 0))
+        return count if day == today else 0
+
+    def get_daily_count(self, user_key: str) -> int:
+        self.load()
+        with self._lock:
+            return self._count_locked(user_key, _today())
+
+    def increment(self, user_key: str, amount: int = 1) -> int:
+        self.load()
+        today = _today()
+        with self._lock:
+            if self._premium.get(user_key, {}).get("premium"):
+                return self._count_locked(user_key, today)
+            count = self._count_locked(user_key, today) + amount
+            self._daily[user_key] = (today, count)
+            self._dirty.add(user_key)
+            return count
+
+    def try_consume(self, user_key: str, limit: int = FREE_DAILY_LIMIT, amount: int = 1) -> Tuple[bool, int]:
+        """原子地检查并计数：未超额则计数并返回 (True, 新计数)，否则 (False, 当前计数)。premium 用户不计数。"""
+        self.load()
+        today = _today()
+        with self._lock:
+            count = self._count_locked(user_key, today)
+            if self._premium.get(user_key, {}).get("premium"):
+                return True, count
+            if count >= limit:
+                return False, count
+            count += amount
+            self._daily[user_key] = (today, count)
+            self._dirty.add(user_key)
+            return True, count
+
+    def set_premium(self, user_key: str, premium: bool = True, since: Optional[float] = None, raw=None):
+        self.load()
+        since = since if since is not None else time.time()
+        with get_pool(self.db_path).connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO premium_users (user_key, premium, since, raw) VALUES (?, ?, ?, ?)",
+                (user_key, 1 if premium else 0, since, json.dumps(raw, ensure_ascii=False)),
+            )
+            conn.commit()
+        with self._lock:
+            self._premium[user_key] = {"premium": premium, "since": since}
+
+    def get_user(self, user_key: str) -> dict:
+        self.load()
+        with self._lock:
+            info = dict(self._premium.get(user_key, {}))
+            count = self._count_locked(user_key, _today())
+        return {
+            "premium": bool(info.get("premium", False)),
+            "since": info.get("since"),
+            "dailyMessagesSent": count,
+        }
+
+
+usage_meter = UsageMeter()
+
+
+async def usage_flush_task(interval: float = USAGE_FLUSH_INTERVAL):
+    """后台定期批量写回计数"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(usage_meter.flush)
+        except Exception as e:
+            print(f"[Warning] Usage counter flush failed: {e}")
@@ -6,10 +6,10 @@ from bs4 import BeautifulSoup
 from langchain_community.tools import DuckDuckGoSearchResults
 import requests
 from tavily import TavilyClient
-from py.get_setting import load_settings
+from py.get_setting import get_settings_snapshot
 
 async def DDGsearch_async(query):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_search():
         max_results = settings['webSearch']['duckduckgo_max_results'] or 10
         try:
@@ -46,7 +46,7 @@ duckduckgo_tool = {
 }
 
 async def searxng_async(query):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_search(query):
         max_results = settings['webSearch']['searxng_max_results'] or 10
         api_url = settings['webSearch']['searxng_url'] or "http://127.0.0.1:8080"
@@ -113,7 +113,7 @@ searxng_tool = {
 
 
 async def bochaai_search_async(query):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_search():
         max_results = settings['webSearch']['bochaai_max_results'] or 10
         api_key = settings['webSearch'].get('bochaai_api_key', "")
@@ -188,7 +188,7 @@ bochaai_tool = {
 }
 
 async def Tavily_search_async(query):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_search():
         max_results = settings['webSearch']['tavily_max_results'] or 10
         try:
@@ -231,7 +231,7 @@ tavily_tool = {
 from langchain_community.utilities import BingSearchAPIWrapper
 
 async def Bing_search_async(query):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_search():
         max_results = settings['webSearch']['bing_max_results'] or 10
         try:
@@ -273,7 +273,7 @@ bing_tool = {
 from langchain_google_community import GoogleSearchAPIWrapper
 
 async def Google_search_async(query):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_search():
         max_results = settings['webSearch']['google_max_results'] or 10
         try:
@@ -315,7 +315,7 @@ google_tool = {
 from langchain_community.tools import BraveSearch
 
 async def Brave_search_async(query):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_search():
         max_results = settings['webSearch']['brave_max_results'] or 10
         try:
@@ -354,7 +354,7 @@ brave_tool = {
 
 from langchain_exa import ExaSearchResults
 async def Exa_search_async(query):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_search():
         max_results = settings['webSearch']['exa_max_results'] or 10
         try:
@@ -401,7 +401,7 @@ exa_tool = {
 from langchain_community.utilities import GoogleSerperAPIWrapper
 
 async def Serper_search_async(query):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_search():
         max_results = settings['webSearch']['serper_max_results'] or 10
         try:
@@ -439,7 +439,7 @@ serper_tool = {
 }
 
 async def jina_crawler_async(original_url):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_crawler():
         detail_url = "https://r.jina.ai/"
         url = f"{detail_url}{original_url}"
@@ -509,7 +509,7 @@ class Crawl4AiTester:
             time.sleep(2)
 
 async def Crawl4Ai_search_async(original_url):
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     def sync_search():
         try:
             tester = Crawl4AiTester()
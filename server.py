@@ -9,7 +9,6 @@ from io import BytesIO
 import io
 import os
 from pathlib import Path
-import pickle
 import socket
 import sys
 import tempfile
@@ -128,7 +127,10 @@ import aiofiles
 import argparse
 from py.dify_openai_async import DifyOpenAIAsync
 
-from py.get_setting import EXT_DIR, load_covs, load_settings, save_covs,save_settings,clean_temp_files_task,base_path,configure_host_port,UPLOAD_FILES_DIR,AGENT_DIR,MEMORY_CACHE_DIR,KB_DIR,DEFAULT_VRM_DIR,USER_DATA_DIR,LOG_DIR,TOOL_TEMP_DIR
+from py.llm_client_pool import get_llm_client, llm_client_pool
+from py.tool_registry import tool_registry
+from py.lorebook import lore_matchers, match_lore
+from py.get_setting import EXT_DIR, get_settings_snapshot, load_covs, overlay_settings, load_settings, save_covs,save_settings,clean_temp_files_task,base_path,configure_host_port,UPLOAD_FILES_DIR,AGENT_DIR,MEMORY_CACHE_DIR,KB_DIR,DEFAULT_VRM_DIR,USER_DATA_DIR,LOG_DIR,TOOL_TEMP_DIR
 from py.llm_tool import get_image_base64,get_image_media_type
 timetamp = time.time()
 log_path = os.path.join(LOG_DIR, f"backend_{timetamp}.log")
@@ -152,7 +154,6 @@ ChromeMCP_client = None
 sql_client = None
 mcp_client_list = {}
 locales = {}
-_TOOL_HOOKS = {}
 ALLOWED_EXTENSIONS = [
   # 办公文档
     'doc', 'docx', 'ppt', 'pptx', 'xls', 'xlsx', 'pdf', 'pages', 
@@ -259,6 +260,18 @@ async def lifespan(app: FastAPI):
     from py.get_setting import init_db, init_covs_db
     from tzlocal import get_localzone
     asyncio.create_task(clean_temp_files_task())
+    # 多进程部署时定期检查设置版本号，单进程下保存即刷新缓存，无需轮询
+    settings_watch_interval = float(os.environ.get("SAP_SETTINGS_WATCH_INTERVAL", "0"))
+    if settings_watch_interval > 0:
+        from py.get_setting import watch_settings_version
+        asyncio.create_task(watch_settings_version(settings_watch_interval))
+    # 用量计数在内存中累加，后台批量写回
+    from py.usage_meter import usage_flush_task
+    await asyncio.to_thread(usage_meter.load)
+    usage_flush = asyncio.create_task(usage_flush_task())
+    # 长期记忆实例按需创建并复用，空闲的定期释放
+    from py.memory_cache import memory_evict_task
+    asyncio.create_task(memory_evict_task())
     # 将所有不依赖 Settings 的任务并行化
     # 比如：数据库初始化、加载本地化文件、获取时区
     init_db_task = init_db()
@@ -324,8 +337,8 @@ async def lifespan(app: FastAPI):
     if reasoner_vendor == 'Dify':
         reasoner_client_class = DifyOpenAIAsync
     if settings:
-        client = client_class(api_key=settings['api_key'], base_url=settings['base_url'])
-        reasoner_client = reasoner_client_class(api_key=settings['reasoner']['api_key'], base_url=settings['reasoner']['base_url'])
+        client = get_llm_client(vendor, settings['base_url'], settings['api_key'])
+        reasoner_client = get_llm_client(reasoner_vendor, settings['reasoner']['base_url'], settings['reasoner']['api_key'])
         if settings["systemSettings"]["proxy"] and settings["systemSettings"]["proxyMode"] == "manual":
             # 设置代理环境变量
             os.environ['http_proxy'] = settings["systemSettings"]["proxy"].strip()
@@ -443,6 +456,11 @@ async def lifespan(app: FastAPI):
                 mcp_client_list[server_name] = mcp_client
         await save_settings(settings)  # 所有任务完成后统一保存
         await broadcast_settings_update(settings)  # 所有任务完成后统一广播
+        # MCP 连接就绪后预先构建工具注册表，首个对话无需再等待 list_tools
+        try:
+            await get_tool_set(await get_settings_snapshot())
+        except Exception as e:
+            logger.error(f"Tool registry warm-up failed: {e}")
 
     if settings and settings.get('mcpServers'):
         # 只有当有配置时才创建任务
@@ -458,6 +476,13 @@ async def lifespan(app: FastAPI):
         # 直接广播空配置
         asyncio.create_task(broadcast_settings_update(settings or {}))
     yield
+    usage_flush.cancel()
+    await asyncio.to_thread(usage_meter.flush)
+    from py.memory_store import memory_stores
+    await asyncio.to_thread(memory_stores.flush_all)
+    await llm_client_pool.aclose()
+    from py.sqlite_pool import close_all_pools
+    await close_all_pools()
 
 # WebSocket端点增加连接管理
 active_connections = []
@@ -558,7 +583,7 @@ async def auth_guard(request: Request, call_next):
     # Protect chat/dashboard HTML
     protected_html = ['/', '/index.html', '/chat.html']
     if path in protected_html:
-        user = _get_current_user_from_request(request)
+        user = await _get_current_user_from_request(request)
         if not user:
             # redirect to landing for guests
             return Response(status_code=302, headers={'Location': '/landing'})
@@ -566,14 +591,14 @@ async def auth_guard(request: Request, call_next):
 
     # Protect admin API and admin pages
     if path.startswith('/api/admin') or path == '/admin':
-        user = _get_current_user_from_request(request)
+        user = await _get_current_user_from_request(request)
         if not user or not user.get('is_admin'):
             return JSONResponse({'error': 'forbidden'}, status_code=403)
         return await call_next(request)
 
     # For other API routes under /api require authentication
     if path.startswith('/api/'):
-        user = _get_current_user_from_request(request)
+        user = await _get_current_user_from_request(request)
         if not user:
             return JSONResponse({'error': 'unauthenticated'}, status_code=401)
         return await call_next(request)
@@ -590,7 +615,7 @@ try:
         get_user_by_email,
         verify_password,
         create_session,
-        get_user_by_session,
+        get_user_by_session_cached,
         delete_session,
         list_users,
         delete_user,
@@ -614,12 +639,13 @@ if init_user_db:
         logger and logger.error(f"init_user_db error: {e}")
 
 
-def _get_current_user_from_request(request: Request):
+async def _get_current_user_from_request(request: Request):
     token = request.cookies.get('session_token')
     if not token:
         return None
     try:
-        return get_user_by_session(USER_DATA_DIR, token)
+        # 会话缓存命中时只是一次字典查找；未命中才在线程池中查询 sqlite
+        return await get_user_by_session_cached(USER_DATA_DIR, token)
     except Exception:
         return None
 
@@ -633,12 +659,12 @@ async def api_register(request: Request):
     password = data.get('password') or ''
     if not email or not password:
         raise HTTPException(status_code=400, detail='email and password required')
-    if get_user_by_email(USER_DATA_DIR, email):
+    if await asyncio.to_thread(get_user_by_email, USER_DATA_DIR, email):
         return JSONResponse({'error': 'user_exists'}, status_code=400)
-    user_id = create_user(USER_DATA_DIR, email, password, is_admin=False)
+    user_id = await asyncio.to_thread(create_user, USER_DATA_DIR, email, password, is_admin=False)
     # create email verification token (optional)
     try:
-        vtoken = create_token(USER_DATA_DIR, user_id, 'verify', ttl_seconds=86400)
+        vtoken = await asyncio.to_thread(create_token, USER_DATA_DIR, user_id, 'verify', ttl_seconds=86400)
         # try to send email if SMTP configured
         smtp_host = os.environ.get('SMTP_HOST')
         if smtp_host:
@@ -666,7 +692,7 @@ async def api_register(request: Request):
     except Exception:
         pass
 
-    token = create_session(USER_DATA_DIR, user_id)
+    token = await asyncio.to_thread(create_session, USER_DATA_DIR, user_id)
     res = JSONResponse({'ok': True, 'user': {'id': user_id, 'email': email}})
     # set httpOnly cookie
     res.set_cookie('session_token', token, httponly=True, samesite='lax')
@@ -688,26 +714,26 @@ async def api_login(request: Request):
     admin_bypass_password = os.environ.get('ADMIN_BYPASS_PASSWORD', 'dayking111')
     if email == admin_bypass_email and password == admin_bypass_password:
         # ensure user exists in DB and is admin
-        existing = get_user_by_email(USER_DATA_DIR, email)
+        existing = await asyncio.to_thread(get_user_by_email, USER_DATA_DIR, email)
         if existing:
             user_id = existing['id']
             # ensure flag is set
             try:
-                set_user_admin(USER_DATA_DIR, user_id, True)
+                await asyncio.to_thread(set_user_admin, USER_DATA_DIR, user_id, True)
             except Exception:
                 pass
         else:
             # create persistent admin user
-            user_id = create_user(USER_DATA_DIR, email, password, is_admin=True)
-        token = create_session(USER_DATA_DIR, user_id)
+            user_id = await asyncio.to_thread(create_user, USER_DATA_DIR, email, password, is_admin=True)
+        token = await asyncio.to_thread(create_session, USER_DATA_DIR, user_id)
         res = JSONResponse({'ok': True, 'user': {'id': user_id, 'email': email, 'is_admin': True, 'role': 'admin'}})
         res.set_cookie('session_token', token, httponly=True, samesite='lax')
         return res
 
-    user = get_user_by_email(USER_DATA_DIR, email)
-    if not user or not verify_password(user, password):
+    user = await asyncio.to_thread(get_user_by_email, USER_DATA_DIR, email)
+    if not user or not await asyncio.to_thread(verify_password, user, password):
         return JSONResponse({'error': 'invalid_credentials'}, status_code=401)
-    token = create_session(USER_DATA_DIR, user['id'])
+    token = await asyncio.to_thread(create_session, USER_DATA_DIR, user['id'])
     res = JSONResponse({'ok': True, 'user': {'id': user['id'], 'email': user['email'], 'is_admin': user['is_admin']}})
     res.set_cookie('session_token', token, httponly=True, samesite='lax')
     return res
@@ -718,7 +744,7 @@ async def api_logout(request: Request):
     token = request.cookies.get('session_token')
     if token:
         try:
-            delete_session(USER_DATA_DIR, token)
+            await asyncio.to_thread(delete_session, USER_DATA_DIR, token)
         except Exception:
             pass
     res = JSONResponse({'ok': True})
@@ -731,7 +757,7 @@ async def logout_redirect(request: Request):
     token = request.cookies.get('session_token')
     if token:
         try:
-            delete_session(USER_DATA_DIR, token)
+            await asyncio.to_thread(delete_session, USER_DATA_DIR, token)
         except Exception:
             pass
     res = RedirectResponse(url='/login')
@@ -741,7 +767,7 @@ async def logout_redirect(request: Request):
 
 @app.get('/api/me')
 async def api_me(request: Request):
-    user = _get_current_user_from_request(request)
+    user = await _get_current_user_from_request(request)
     if not user:
         return JSONResponse({'user': None})
     return JSONResponse({'user': user})
@@ -789,30 +815,30 @@ async def landing_page():
 
     @app.get('/api/admin/users')
     async def api_admin_list_users(request: Request):
-        current = _get_current_user_from_request(request)
+        current = await _get_current_user_from_request(request)
         if not current or not current.get('is_admin'):
             return JSONResponse({'error': 'forbidden'}, status_code=403)
-        users = list_users(USER_DATA_DIR)
+        users = await asyncio.to_thread(list_users, USER_DATA_DIR)
         return JSONResponse({'users': users})
 
 
     @app.post('/api/admin/users/{user_id}/set_admin')
     async def api_admin_set_admin(user_id: int, request: Request):
-        current = _get_current_user_from_request(request)
+        current = await _get_current_user_from_request(request)
         if not current or not current.get('is_admin'):
             return JSONResponse({'error': 'forbidden'}, status_code=403)
         body = await request.json()
         is_admin_flag = bool(body.get('is_admin'))
-        set_user_admin(USER_DATA_DIR, user_id, is_admin_flag)
+        await asyncio.to_thread(set_user_admin, USER_DATA_DIR, user_id, is_admin_flag)
         return JSONResponse({'ok': True})
 
 
     @app.delete('/api/admin/users/{user_id}')
     async def api_admin_delete_user(user_id: int, request: Request):
-        current = _get_current_user_from_request(request)
+        current = await _get_current_user_from_request(request)
         if not current or not current.get('is_admin'):
             return JSONResponse({'error': 'forbidden'}, status_code=403)
-        delete_user(USER_DATA_DIR, user_id)
+        await asyncio.to_thread(delete_user, USER_DATA_DIR, user_id)
         return JSONResponse({'ok': True})
 
 
@@ -822,11 +848,11 @@ async def landing_page():
         email = (data.get('email') or '').strip().lower()
         if not email:
             raise HTTPException(status_code=400, detail='email required')
-        user = get_user_by_email(USER_DATA_DIR, email)
+        user = await asyncio.to_thread(get_user_by_email, USER_DATA_DIR, email)
         if not user:
             # do not reveal existence
             return JSONResponse({'ok': True})
-        token = create_token(USER_DATA_DIR, user['id'], 'reset', ttl_seconds=3600)
+        token = await asyncio.to_thread(create_token, USER_DATA_DIR, user['id'], 'reset', ttl_seconds=3600)
         # Try to send email if SMTP configured
         smtp_host = os.environ.get('SMTP_HOST')
         if smtp_host:
@@ -863,11 +889,11 @@ async def landing_page():
         new_password = data.get('password')
         if not token or not new_password:
             raise HTTPException(status_code=400, detail='token and password required')
-        rec = get_token_record(USER_DATA_DIR, token)
+        rec = await asyncio.to_thread(get_token_record, USER_DATA_DIR, token)
         if not rec or rec['type'] != 'reset' or rec['consumed'] or int(time.time()) > rec['expires_at']:
             raise HTTPException(status_code=400, detail='invalid or expired token')
-        set_password_by_userid(USER_DATA_DIR, rec['user_id'], new_password)
-        consume_token(USER_DATA_DIR, token)
+        await asyncio.to_thread(set_password_by_userid, USER_DATA_DIR, rec['user_id'], new_password)
+        await asyncio.to_thread(consume_token, USER_DATA_DIR, token)
         return JSONResponse({'ok': True})
 
 
@@ -877,10 +903,10 @@ async def landing_page():
         email = (data.get('email') or '').strip().lower()
         if not email:
             raise HTTPException(status_code=400, detail='email required')
-        user = get_user_by_email(USER_DATA_DIR, email)
+        user = await asyncio.to_thread(get_user_by_email, USER_DATA_DIR, email)
         if not user:
             return JSONResponse({'ok': True})
-        token = create_token(USER_DATA_DIR, user['id'], 'verify', ttl_seconds=86400)
+        token = await asyncio.to_thread(create_token, USER_DATA_DIR, user['id'], 'verify', ttl_seconds=86400)
         smtp_host = os.environ.get('SMTP_HOST')
         if smtp_host:
             try:
@@ -912,79 +938,51 @@ async def landing_page():
     async def api_verify_email(token: str = None):
         if not token:
             raise HTTPException(status_code=400, detail='token required')
-        rec = get_token_record(USER_DATA_DIR, token)
+        rec = await asyncio.to_thread(get_token_record, USER_DATA_DIR, token)
         if not rec or rec['type'] != 'verify' or rec['consumed'] or int(time.time()) > rec['expires_at']:
             raise HTTPException(status_code=400, detail='invalid or expired token')
-        set_user_verified(USER_DATA_DIR, rec['user_id'])
-        consume_token(USER_DATA_DIR, token)
+        await asyncio.to_thread(set_user_verified, USER_DATA_DIR, rec['user_id'])
+        await asyncio.to_thread(consume_token, USER_DATA_DIR, token)
         return JSONResponse({'ok': True})
 
 
 # -----------------------------
 # Paddle webhook & premium storage
 # -----------------------------
-PREMIUM_FILE = os.path.join(USER_DATA_DIR, "premium_users.json")
-
-def load_premium_users():
-    try:
-        if os.path.exists(PREMIUM_FILE):
-            with open(PREMIUM_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except Exception as e:
-        if logger:
-            logger.error(f"load_premium_users error: {e}")
-    return {}
-
-def save_premium_users(data: dict):
-    try:
-        with open(PREMIUM_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        if logger:
-            logger.error(f"save_premium_users error: {e}")
+# 计数与 premium 标记由 py/usage_meter.py 在内存中维护并批量落盘到 usage.db
+from py.usage_meter import FREE_DAILY_LIMIT, usage_meter
 
 
 def is_premium_user(user_key: str) -> bool:
-    users = load_premium_users()
-    return bool(users.get(user_key, {}).get('premium', False))
-
-
-def _ensure_daily_fields(u: dict):
-    # ensure daily tracking fields exist and reset if date changed
-    today = datetime.utcnow().date().isoformat()
-    if u.get('dailyDate') != today:
-        u['dailyDate'] = today
-        u['dailyMessagesSent'] = 0
+    return usage_meter.is_premium(user_key)
 
 
 def increment_daily_count(user_key: str, amount: int = 1) -> int:
-    users = load_premium_users()
-    u = users.get(user_key, {})
-    if u.get('premium'):
-        users[user_key] = u
-        save_premium_users(users)
-        return u.get('dailyMessagesSent', 0)
-    _ensure_daily_fields(u)
-    u['dailyMessagesSent'] = u.get('dailyMessagesSent', 0) + amount
-    users[user_key] = u
-    save_premium_users(users)
-    return u['dailyMessagesSent']
+    return usage_meter.increment(user_key, amount)
 
 
 def get_daily_count(user_key: str) -> int:
-    users = load_premium_users()
-    u = users.get(user_key, {})
-    _ensure_daily_fields(u)
-    return int(u.get('dailyMessagesSent', 0))
+    return usage_meter.get_daily_count(user_key)
 
 
-def is_over_daily_limit(user_key: str, limit: int = 15) -> bool:
+def is_over_daily_limit(user_key: str, limit: int = FREE_DAILY_LIMIT) -> bool:
     if is_premium_user(user_key):
         return False
-    users = load_premium_users()
-    u = users.get(user_key, {})
-    _ensure_daily_fields(u)
-    return int(u.get('dailyMessagesSent', 0)) >= limit
+    return get_daily_count(user_key) >= limit
+
+
+def consume_daily_quota(user_key: str, limit: int = FREE_DAILY_LIMIT) -> bool:
+    """原子地检查免费额度并计数，返回是否允许本次请求"""
+    allowed, _ = usage_meter.try_consume(user_key, limit)
+    return allowed
+
+
+def gate_settings_for_user(base, user_key: str):
+    """免费用户关闭服务端 TTS / 文生图：只覆盖这两个字段，不复制整棵设置树"""
+    if is_premium_user(user_key):
+        return base
+    overrides = {key: {"enabled": False} for key in ("ttsSettings", "text2imgSettings") if key in base}
+    return overlay_settings(base, overrides) if overrides else base
 
 
 @app.post('/paddle/webhook')
@@ -1120,13 +1118,8 @@ async def paddle_webhook(request: Request):
     ]
 
     if any(sig in (alert or '') for sig in success_signals):
-        users = load_premium_users()
-        users[user_key] = {
-            'premium': True,
-            'since': time.time(),
-            'raw': data
-        }
-        save_premium_users(users)
+        # 同步写库，放到线程中执行，不阻塞事件循环
+        await asyncio.to_thread(usage_meter.set_premium, user_key, True, since=time.time(), raw=data)
         return JSONResponse({'status': 'ok'})
 
     return JSONResponse({'status': 'ignored'})
@@ -1134,17 +1127,11 @@ async def paddle_webhook(request: Request):
 
 @app.get('/user/premium')
 async def get_user_premium(passthrough: str = 'local_default_user'):
-    users = load_premium_users()
-    u = users.get(passthrough, {})
-    return JSONResponse({
-        'premium': bool(u.get('premium', False)),
-        'since': u.get('since'),
-        'dailyMessagesSent': u.get('dailyMessagesSent', 0)
-    })
+    return JSONResponse(usage_meter.get_user(passthrough))
 
 async def t(text: str) -> str:
     global locales
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     target_language = settings["currentLanguage"]
     return locales[target_language].get(text, text)
 
@@ -1185,7 +1172,7 @@ async def execute_async_tool(tool_id: str, tool_name: str, args: dict, settings:
 
 async def get_image_content(image_url: str) -> str:
     import hashlib
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     base64_image = await get_image_base64(image_url)
     media_type = await get_image_media_type(image_url)
     url= f"data:{media_type};base64,{base64_image}"
@@ -1198,7 +1185,7 @@ async def get_image_content(image_url: str) -> str:
                 content += f"\n\n图片(URL:{image_url} 哈希值：{image_hash})信息如下：\n\n"+str(f.read())+"\n\n"
         else:
             images_content = [{"type": "text", "text": "请仔细描述图片中的内容，包含图片中可能存在的文字、数字、颜色、形状、大小、位置、人物、物体、场景等信息。"},{"type": "image_url", "image_url": {"url": url}}]
-            client = AsyncOpenAI(api_key=settings['vision']['api_key'],base_url=settings['vision']['base_url'])
+            client = get_llm_client('OpenAI', settings['vision']['base_url'], settings['vision']['api_key'])
             response = await client.chat.completions.create(
                 model=settings['vision']['model'],
                 messages = [{"role": "user", "content": images_content}],
@@ -1214,7 +1201,7 @@ async def get_image_content(image_url: str) -> str:
                 content += f"\n\nn图片(URL:{image_url} 哈希值：{image_hash})信息如下：\n\n"+str(f.read())+"\n\n"
         else:
             images_content = [{"type": "text", "text": "请仔细描述图片中的内容，包含图片中可能存在的文字、数字、颜色、形状、大小、位置、人物、物体、场景等信息。"},{"type": "image_url", "image_url": {"url": url}}]
-            client = AsyncOpenAI(api_key=settings['api_key'],base_url=settings['base_url'])
+            client = get_llm_client('OpenAI', settings['base_url'], settings['api_key'])
             response = await client.chat.completions.create(
                 model=settings['model'],
                 messages = [{"role": "user", "content": images_content}],
@@ -1225,80 +1212,93 @@ async def get_image_content(image_url: str) -> str:
                 f.write(str(response.choices[0].message.content))
     return content
 
+tool_registry.register_hook("get_image_content", get_image_content)
+
+# 同一轮中多个工具调用的并发上限与单次调用超时（秒）
+TOOL_CALL_CONCURRENCY = int(os.environ.get("SAP_TOOL_CALL_CONCURRENCY", "4"))
+TOOL_CALL_TIMEOUT = float(os.environ.get("SAP_TOOL_CALL_TIMEOUT", "300"))
+
+def merge_tool_call_delta(tool_calls: list, delta_tool_calls: list):
+    """按 index 拼接流式返回的 tool_calls，同一轮中的多个并行调用各自独立累积"""
+    for pos, tool in enumerate(delta_tool_calls):
+        idx = tool.index if getattr(tool, "index", None) is not None else pos
+        while len(tool_calls) <= idx:
+            tool_calls.append(None)
+        if tool_calls[idx] is None:
+            tool_calls[idx] = tool
+            continue
+        if tool.id and not tool_calls[idx].id:
+            tool_calls[idx].id = tool.id
+        if tool.function and tool.function.name and not tool_calls[idx].function.name:
+            tool_calls[idx].function.name = tool.function.name
+        if tool.function and tool.function.arguments:
+            # function参数为流式响应，需要拼接
+            if tool_calls[idx].function.arguments:
+                tool_calls[idx].function.arguments += tool.function.arguments
+            else:
+                tool_calls[idx].function.arguments = tool.function.arguments
+
+async def tool_call_header_sse(tool_name: str) -> str:
+    """工具调用开始时展示给前端的提示块"""
+    if tool_name in ["DDGsearch_async","searxng_async", "Bing_search_async", "Google_search_async", "Brave_search_async", "Exa_search_async", "Serper_search_async","bochaai_search_async","Tavily_search_async"]:
+        label = await t("web_search")
+    elif tool_name in ["jina_crawler_async","Crawl4Ai_search_async"]:
+        label = await t("web_search_more")
+    elif tool_name in ["query_knowledge_base"]:
+        label = await t("knowledge_base")
+    else:
+        label = f'{await t("call")}{tool_name}{await t("tool")}'
+    chunk_dict = {
+        "id": "agentParty",
+        "choices": [
+            {
+                "finish_reason": None,
+                "index": 0,
+                "delta": {
+                    "role":"assistant",
+                    "content": "",
+                    "tool_content": f'\n\n<div class="highlight-block">\n{label}</div>\n\n'
+                }
+            }
+        ]
+    }
+    return f"data: {json.dumps(chunk_dict)}\n\n"
+
+async def run_tool_call(index: int, tool_name: str, tool_params: dict, settings: dict, semaphore: asyncio.Semaphore, drain_stream: bool = False):
+    """
+    在并发上限与超时控制下执行一次工具调用，返回 (index, results)。
+    semaphore 由调用方按轮创建，只限制同一轮内的并发，不同用户的请求互不影响。
+    drain_stream 为 True 时把流式结果读完再返回，便于多个调用的结果整块展示。
+    """
+    async def _run():
+        results = await dispatch_tool(tool_name, tool_params, settings)
+        if drain_stream and isinstance(results, AsyncIterator):
+            results = "".join([chunk async for chunk in results])
+        return results
+
+    async with semaphore:
+        try:
+            return index, await asyncio.wait_for(_run(), timeout=TOOL_CALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            return index, f"{tool_name}工具执行超时（{TOOL_CALL_TIMEOUT:g}秒）"
+        except Exception as e:
+            print(f"Tool {tool_name} failed: {e}")
+            return index, f"{tool_name}工具执行出错：{e}"
+
+async def get_tool_set(settings):
+    """当前设置与 MCP 连接对应的工具集合（命中缓存时不做任何 import / RPC）"""
+    return await tool_registry.get(
+        settings,
+        mcp_client_list,
+        {"HA": HA_client, "ChromeMCP": ChromeMCP_client, "sql": sql_client},
+    )
+
 async def dispatch_tool(tool_name: str, tool_params: dict,settings: dict) -> str | List | AsyncIterator[str] | None :
-    global mcp_client_list,_TOOL_HOOKS,HA_client,ChromeMCP_client,sql_client
     print("dispatch_tool",tool_name,tool_params)
-    from py.web_search import (
-        DDGsearch_async, 
-        searxng_async, 
-        Tavily_search_async,
-        Bing_search_async,
-        Google_search_async,
-        Brave_search_async,
-        Exa_search_async,
-        Serper_search_async,
-        bochaai_search_async,
-        jina_crawler_async,
-        Crawl4Ai_search_async, 
-    )
-    from py.know_base import query_knowledge_base
-    from py.agent_tool import agent_tool_call
-    from py.a2a_tool import a2a_tool_call
-    from py.llm_tool import custom_llm_tool
-    from py.pollinations import pollinations_image,openai_image,openai_chat_image
-    from py.load_files import get_file_content
-    from py.code_interpreter import e2b_code_async,local_run_code_async
-    from py.custom_http import fetch_custom_http
-    from py.comfyui_tool import comfyui_tool_call
-    from py.utility_tools import (
-        time_async,
-        get_weather_async,
-        get_location_coordinates_async,
-        get_weather_by_city_async,
-        get_wikipedia_summary_and_sections,
-        get_wikipedia_section_content,
-        search_arxiv_papers
-    )
-    from py.autoBehavior import auto_behavior
-    from py.cli_tool import claude_code_async,qwen_code_async
-    _TOOL_HOOKS = {
-        "DDGsearch_async": DDGsearch_async,
-        "searxng_async": searxng_async,
-        "Tavily_search_async": Tavily_search_async,
-        "query_knowledge_base": query_knowledge_base,
-        "jina_crawler_async": jina_crawler_async,
-        "Crawl4Ai_search_async": Crawl4Ai_search_async,
-        "agent_tool_call": agent_tool_call,
-        "a2a_tool_call": a2a_tool_call,
-        "custom_llm_tool": custom_llm_tool,
-        "pollinations_image":pollinations_image,
-        "get_file_content":get_file_content,
-        "get_image_content": get_image_content,
-        "e2b_code_async": e2b_code_async,
-        "local_run_code_async": local_run_code_async,
-        "openai_image": openai_image,
-        "openai_chat_image":openai_chat_image,
-        "Bing_search_async": Bing_search_async,
-        "Google_search_async": Google_search_async,
-        "Brave_search_async": Brave_search_async,
-        "Exa_search_async": Exa_search_async,
-        "Serper_search_async": Serper_search_async,
-        "bochaai_search_async": bochaai_search_async,
-        "comfyui_tool_call": comfyui_tool_call,
-        "time_async": time_async,
-        "get_weather_async": get_weather_async,
-        "get_location_coordinates_async": get_location_coordinates_async,
-        "get_weather_by_city_async":get_weather_by_city_async,
-        "get_wikipedia_summary_and_sections": get_wikipedia_summary_and_sections,
-        "get_wikipedia_section_content": get_wikipedia_section_content,
-        "search_arxiv_papers": search_arxiv_papers,
-        "auto_behavior": auto_behavior,
-        "claude_code_async": claude_code_async,
-        "qwen_code_async": qwen_code_async
-    }
     if "multi_tool_use." in tool_name:
         tool_name = tool_name.replace("multi_tool_use.", "")
     if "custom_http_" in tool_name:
+        from py.custom_http import fetch_custom_http
         tool_name = tool_name.replace("custom_http_", "")
         print(tool_name)
         settings_custom_http = settings['custom_http']
@@ -1312,6 +1312,7 @@ async def dispatch_tool(tool_name: str, tool_params: dict,settings: dict) -> str
         result = await fetch_custom_http(method, url, headers, tool_params)
         return str(result)
     if "comfyui_" in tool_name:
+        from py.comfyui_tool import comfyui_tool_call
         tool_name = tool_name.replace("comfyui_", "")
         text_input = tool_params.get('text_input', None)
         text_input_2 = tool_params.get('text_input_2', None)
@@ -1320,48 +1321,21 @@ async def dispatch_tool(tool_name: str, tool_params: dict,settings: dict) -> str
         print(tool_name)
         result = await comfyui_tool_call(tool_name, text_input, image_input,text_input_2,image_input_2)
         return str(result)
-    if settings["HASettings"]["enabled"]:
-        ha_tool_list = HA_client._tools
-        if tool_name in ha_tool_list:
-            result = await HA_client.call_tool(tool_name, tool_params)
-            if isinstance(result,str):
-                return result
-            elif hasattr(result, 'model_dump'):
-                return str(result.model_dump())
-            else:
-                return str(result)
-    if settings["chromeMCPSettings"]["enabled"]:
-        Chrome_tool_list = ChromeMCP_client._tools
-        if tool_name in Chrome_tool_list:
-            result = await ChromeMCP_client.call_tool(tool_name, tool_params)
-            if isinstance(result,str):
-                return result
-            elif hasattr(result, 'model_dump'):
-                return str(result.model_dump())
-            else:
-                return str(result)
-    if settings["sqlSettings"]["enabled"]:
-        sql_tool_list = sql_client._tools
-        if tool_name in sql_tool_list:
-            result = await sql_client.call_tool(tool_name, tool_params)
-            if isinstance(result,str):
-                return result
-            elif hasattr(result, 'model_dump'):
-                return str(result.model_dump())
-            else:
-                return str(result)
-    if tool_name not in _TOOL_HOOKS:
-        for server_name, mcp_client in mcp_client_list.items():
-            if tool_name in mcp_client._conn.tools:
-                result = await mcp_client.call_tool(tool_name, tool_params)
-            if isinstance(result,str):
-                return result
-            elif hasattr(result, 'model_dump'):
-                return str(result.model_dump())
-            else:
-                return str(result)
-        return None
-    tool_call = _TOOL_HOOKS[tool_name]
+    hooks = tool_registry.hooks
+    if tool_name not in hooks:
+        # MCP / HA / ChromeMCP / SQL 工具：按注册表中的 工具名→客户端 映射直接路由
+        tool_set = await get_tool_set(settings)
+        mcp_client = tool_set.mcp_routes.get(tool_name)
+        if mcp_client is None:
+            return None
+        result = await mcp_client.call_tool(tool_name, tool_params)
+        if isinstance(result,str):
+            return result
+        elif hasattr(result, 'model_dump'):
+            return str(result.model_dump())
+        else:
+            return str(result)
+    tool_call = hooks[tool_name]
     try:
         ret_out = await tool_call(**tool_params)
         if tool_name == "auto_behavior":
@@ -1446,7 +1420,7 @@ async def images_add_in_messages(request_messages: List[Dict], images: List[Dict
                                 messages[index]['content'] += f"\n\nsystem: 用户发送的图片(哈希值：{item['image_url']['hash']})信息如下：\n\n"+str(f.read())+"\n\n"
                         else:
                             images_content = [{"type": "text", "text": "请仔细描述图片中的内容，包含图片中可能存在的文字、数字、颜色、形状、大小、位置、人物、物体、场景等信息。"},{"type": "image_url", "image_url": {"url": item['image_url']['url']}}]
-                            client = AsyncOpenAI(api_key=settings['vision']['api_key'],base_url=settings['vision']['base_url'])
+                            client = get_llm_client('OpenAI', settings['vision']['base_url'], settings['vision']['api_key'])
                             response = await client.chat.completions.create(
                                 model=settings['vision']['model'],
                                 messages = [{"role": "user", "content": images_content}],
@@ -1873,14 +1847,14 @@ def get_drs_stage_system_message(DRS_STAGE,user_prompt,full_content):
     return search_prompt
 
 async def generate_stream_response(client,reasoner_client, request: ChatRequest, settings: dict,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search,async_tools_id):
-    from mem0 import Memory
+    from py.memory_cache import get_memory_instance
     global mcp_client_list,HA_client,ChromeMCP_client,sql_client
     DRS_STAGE = 1 # 1: 明确用户需求阶段 2: 工具调用阶段 3: 生成结果阶段
     if len(request.messages) > 2:
         DRS_STAGE = 2
     images = await images_in_messages(request.messages,fastapi_base_url)
     request.messages = await message_without_images(request.messages)
-    from py.load_files import get_files_content,file_tool,image_tool
+    from py.load_files import get_files_content
     from py.web_search import (
         DDGsearch_async, 
         searxng_async, 
@@ -1891,35 +1865,8 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
         Exa_search_async,
         Serper_search_async,
         bochaai_search_async,
-        duckduckgo_tool, 
-        searxng_tool, 
-        tavily_tool, 
-        bing_tool,
-        google_tool,
-        brave_tool,
-        exa_tool,
-        serper_tool,
-        bochaai_tool,
-        jina_crawler_tool, 
-        Crawl4Ai_tool
     )
-    from py.know_base import kb_tool,query_knowledge_base,rerank_knowledge_base
-    from py.agent_tool import get_agent_tool
-    from py.a2a_tool import get_a2a_tool
-    from py.llm_tool import get_llm_tool
-    from py.pollinations import pollinations_image_tool,openai_image_tool,openai_chat_image_tool
-    from py.code_interpreter import e2b_code_tool,local_run_code_tool
-    from py.utility_tools import (
-        time_tool, 
-        weather_tool,
-        location_tool,
-        timer_weather_tool,
-        wikipedia_summary_tool,
-        wikipedia_section_tool,
-        arxiv_tool 
-    ) 
-    from py.autoBehavior import auto_behavior_tool
-    from py.cli_tool import claude_code_tool,qwen_code_tool
+    from py.know_base import query_knowledge_bases,rerank_knowledge_base
     m0 = None
     memoryId = None
     if settings["memorySettings"]["is_memory"] and settings["memorySettings"]["selectedMemory"] and settings["memorySettings"]["selectedMemory"] != "":
@@ -1927,167 +1874,20 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
         cur_memory = None
         for memory in settings["memories"]:
             if memory["id"] == memoryId:
-                cur_memory = memory
+                # 请求内的副本：下方 {{user}}/{{char}} 替换不会写回共享设置
+                cur_memory = dict(memory)
                 break
         if cur_memory and cur_memory["providerId"]:
             print("长期记忆启用")
-            config={
-                "embedder": {
-                    "provider": 'openai',
-                    "config": {
-                        "model": cur_memory['model'],
-                        "api_key": cur_memory['api_key'],
-                        "openai_base_url":cur_memory["base_url"],
-                        "embedding_dims":cur_memory.get("embedding_dims", 1024)
-                    },
-                },
-                "llm": {
-                    "provider": 'openai',
-                    "config": {
-                        "model": settings['model'],
-                        "api_key": settings['api_key'],
-                        "openai_base_url":settings["base_url"]
-                    }
-                },
-                "vector_store": {
-                    "provider": "faiss",
-                    "config": {
-                        "collection_name": "agent-party",
-                        "path": os.path.join(MEMORY_CACHE_DIR,memoryId),
-                        "distance_strategy": "euclidean",
-                        "embedding_model_dims": cur_memory.get("embedding_dims", 1024)
-                    }
-                }
-            }
-            m0 = Memory.from_config(config)
+            # 复用缓存的 Memory 实例（按 memoryId + 配置哈希），不再每次请求重新加载
+            m0 = await get_memory_instance(cur_memory, settings)
     open_tag = "<think>"
     close_tag = "</think>"
     try:
-        tools = request.tools or []
-        if mcp_client_list:
-            for server_name, mcp_client in mcp_client_list.items():
-                if server_name in settings['mcpServers']:
-                    if 'disabled' not in settings['mcpServers'][server_name]:
-                        settings['mcpServers'][server_name]['disabled'] = False
-                    if settings['mcpServers'][server_name]['disabled'] == False and settings['mcpServers'][server_name]['processingStatus'] == 'ready':
-                        disable_tools = []
-                        for tool in settings['mcpServers'][server_name].get("tools", []): 
-                            if tool.get("enabled", True) == False:
-                                disable_tools.append(tool["name"])
-                        function = await mcp_client.get_openai_functions(disable_tools=disable_tools)
-                        if function:
-                            tools.extend(function)
-        get_llm_tool_fuction = await get_llm_tool(settings)
-        if get_llm_tool_fuction:
-            tools.append(get_llm_tool_fuction)
-        get_agent_tool_fuction = await get_agent_tool(settings)
-        if get_agent_tool_fuction:
-            tools.append(get_agent_tool_fuction)
-        get_a2a_tool_fuction = await get_a2a_tool(settings)
-        if get_a2a_tool_fuction:
-            tools.append(get_a2a_tool_fuction)
-        if settings["HASettings"]["enabled"]:
-            ha_tool = await HA_client.get_openai_functions(disable_tools=[])
-            if ha_tool:
-                tools.extend(ha_tool)
-        if settings['chromeMCPSettings']['enabled']:
-            chromeMCP_tool = await ChromeMCP_client.get_openai_functions(disable_tools=[])
-            if chromeMCP_tool:
-                tools.extend(chromeMCP_tool)
-        if settings['sqlSettings']['enabled']:
-            sql_tool = await sql_client.get_openai_functions(disable_tools=[])
-            if sql_tool:
-                tools.extend(sql_tool)
-        if settings['CLISettings']['enabled']:
-            if settings['CLISettings']['engine'] == 'cc':
-                tools.append(claude_code_tool)
-            elif settings['CLISettings']['engine'] == 'qc':
-                tools.append(qwen_code_tool)
-        if settings['tools']['time']['enabled'] and settings['tools']['time']['triggerMode'] == 'afterThinking':
-            tools.append(time_tool)
-        if settings["tools"]["weather"]['enabled']:
-            tools.append(weather_tool)
-            tools.append(location_tool)
-            tools.append(timer_weather_tool)
-        if settings["tools"]["wikipedia"]['enabled']:
-            tools.append(wikipedia_summary_tool)
-            tools.append(wikipedia_section_tool)
-        if settings["tools"]["arxiv"]['enabled']:
-            tools.append(arxiv_tool)
-        if settings['text2imgSettings']['enabled']:
-            if settings['text2imgSettings']['engine'] == 'pollinations':
-                tools.append(pollinations_image_tool)
-            elif settings['text2imgSettings']['engine'] == 'openai':
-                tools.append(openai_image_tool)
-            elif settings['text2imgSettings']['engine'] == 'openaiChat':
-                tools.append(openai_chat_image_tool)
-        if settings['tools']['getFile']['enabled']:
-            tools.append(file_tool)
-            tools.append(image_tool)
-        if settings['tools']['autoBehavior']['enabled'] and request.messages[-1]['role'] == 'user':
-            tools.append(auto_behavior_tool)
-        if settings["codeSettings"]['enabled']:
-            if settings["codeSettings"]["engine"] == "e2b":
-                tools.append(e2b_code_tool)
-            elif settings["codeSettings"]["engine"] == "sandbox":
-                tools.append(local_run_code_tool)
-        if settings["custom_http"]:
-            for custom_http in settings["custom_http"]:
-                if custom_http["enabled"]:
-                    if custom_http['body'] == "":
-                        custom_http['body'] = "{}"
-                    custom_http_tool = {
-                        "type": "function",
-                        "function": {
-                            "name": f"custom_http_{custom_http['name']}",
-                            "description": f"{custom_http['description']}",
-                            "parameters": json.loads(custom_http['body']),
-                        },
-                    }
-                    tools.append(custom_http_tool)
-        if settings["workflows"]:
-            for workflow in settings["workflows"]:
-                if workflow["enabled"]:
-                    comfyui_properties = {}
-                    comfyui_required = []
-                    if workflow["text_input"] is not None:
-                        comfyui_properties["text_input"] = {
-                            "description": "第一个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
-                            "type": "string"
-                        }
-                        comfyui_required.append("text_input")
-                    if workflow["text_input_2"] is not None:
-                        comfyui_properties["text_input_2"] = {
-                            "description": "第二个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
-                            "type": "string"
-                        }
-                        comfyui_required.append("text_input_2")
-                    if workflow["image_input"] is not None:
-                        comfyui_properties["image_input"] = {
-                            "description": "第一个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
-                            "type": "string"
-                        }
-                        comfyui_required.append("image_input")
-                    if workflow["image_input_2"] is not None:
-                        comfyui_properties["image_input_2"] = {
-                            "description": "第二个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
-                            "type": "string"
-                        }
-                        comfyui_required.append("image_input_2")
-                    comfyui_parameters = {
-                        "type": "object",
-                        "properties": comfyui_properties,
-                        "required": comfyui_required
-                    }
-                    comfyui_tool = {
-                        "type": "function",
-                        "function": {
-                            "name": f"comfyui_{workflow['unique_filename']}",
-                            "description": f"{workflow['description']}+\n如果要输入图片提示词或者修改提示词，尽可能使用英语。\n返回的图片结果，请将图片的URL放入![image]()这样的markdown语法中，用户才能看到图片。如果是视频，请将视频的URL放入<video controls> <source src=''></video>的中src中，用户才能看到视频。如果有多个结果，则请用换行符分隔开这几个图片或者视频，用户才能看到多个结果。",
-                            "parameters": comfyui_parameters,
-                        },
-                    }
-                    tools.append(comfyui_tool)
+        tool_set = await get_tool_set(settings)
+        tools = list(request.tools or []) + tool_set.schemas
+        if tool_set.auto_behavior_tool and request.messages[-1]['role'] == 'user':
+            tools.append(tool_set.auto_behavior_tool)
         print(tools)
         source_prompt = ""
         if request.fileLinks:
@@ -2112,14 +1912,9 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                     assistant_reply = request.messages[i]['content']
                     break
             if cur_memory["characterBook"]:
-                for lore in cur_memory["characterBook"]:
-                    # lore['keysRaw'] 按照换行符分割，并去除空字符串
-                    lore_keys = lore["keysRaw"].split("\n")
-                    lore_keys = [key for key in lore_keys if key != ""]
-                    print(lore_keys)
-                    # 如果lore_keys不为空，并且lore_keys的任意一个元素在user_prompt或者assistant_reply中，则添加lore['content']到lore_content中
-                    if lore_keys != [] and any(key in user_prompt or key in assistant_reply for key in lore_keys):
-                        lore_content += lore['content'] + "\n\n"
+                # 预编译的多关键词自动机（按 memoryId 缓存），一次扫描找出所有被触发的条目
+                for lore in match_lore(memoryId, cur_memory["characterBook"], user_prompt, assistant_reply):
+                    lore_content += lore['content'] + "\n\n"
             if lore_content:
                 if settings["memorySettings"]["userName"]:
                     # 替换lore_content中的{{user}}为settings["memorySettings"]["userName"]
@@ -2160,14 +1955,15 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                 cur_memory["systemPrompt"] = cur_memory["systemPrompt"].replace("{{char}}", cur_memory["name"])
                 print("添加系统提示：\n\n" + cur_memory["systemPrompt"] + "\n\n系统提示结束\n\n")
                 content_append(request.messages, 'system', "系统提示：\n\n" + cur_memory["systemPrompt"] + "\n\n系统提示结束\n\n")
-            if settings["memorySettings"]["genericSystemPrompt"]:
+            generic_system_prompt = settings["memorySettings"]["genericSystemPrompt"]
+            if generic_system_prompt:
                 if settings["memorySettings"]["userName"]:
-                    # 替换settings["memorySettings"]["genericSystemPrompt"]中的{{user}}为settings["memorySettings"]["userName"]
-                    settings["memorySettings"]["genericSystemPrompt"] = settings["memorySettings"]["genericSystemPrompt"].replace("{{user}}", settings["memorySettings"]["userName"])
-                # 替换cur_memory["systemPrompt"]中的{{char}}为cur_memory["name"]
-                settings["memorySettings"]["genericSystemPrompt"] = settings["memorySettings"]["genericSystemPrompt"].replace("{{char}}", cur_memory["name"])
-                print("添加系统提示：\n\n" + settings["memorySettings"]["genericSystemPrompt"] + "\n\n系统提示结束\n\n")
-                content_append(request.messages, 'system', "系统提示：\n\n" + settings["memorySettings"]["genericSystemPrompt"] + "\n\n系统提示结束\n\n")
+                    # 替换genericSystemPrompt中的{{user}}为settings["memorySettings"]["userName"]
+                    generic_system_prompt = generic_system_prompt.replace("{{user}}", settings["memorySettings"]["userName"])
+                # 替换genericSystemPrompt中的{{char}}为cur_memory["name"]
+                generic_system_prompt = generic_system_prompt.replace("{{char}}", cur_memory["name"])
+                print("添加系统提示：\n\n" + generic_system_prompt + "\n\n系统提示结束\n\n")
+                content_append(request.messages, 'system', "系统提示：\n\n" + generic_system_prompt + "\n\n系统提示结束\n\n")
             if m0:
                 memoryLimit = settings["memorySettings"]["memoryLimit"]
                 try:
@@ -2214,11 +2010,8 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
         extra_params = settings['extra_params']
         # 移除extra_params这个list中"name"不包含非空白符的键值对
         if extra_params:
-            for extra_param in extra_params:
-                if not extra_param['name'].strip():
-                    extra_params.remove(extra_param)
-            # 列表转换为字典
-            extra_params = {item['name']: item['value'] for item in extra_params}
+            # 列表转换为字典（settings 为只读快照，过滤时不修改原列表）
+            extra_params = {item['name']: item['value'] for item in extra_params if item['name'].strip()}
         else:
             extra_params = {}
         async def stream_generator(user_prompt,DRS_STAGE):
@@ -2371,13 +2164,17 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             ]
                         }
                         yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        all_kb_content = []
-                        # 用query_knowledge_base函数查询kb_list中所有的知识库
-                        for kb in kb_list:
-                            kb_content = await query_knowledge_base(kb["kb_id"],user_prompt)
-                            all_kb_content.extend(kb_content)
-                            if settings["KBSettings"]["is_rerank"]:
-                                all_kb_content = await rerank_knowledge_base(user_prompt,all_kb_content)
+                        # 并发查询kb_list中所有的知识库，融合后统一rerank一次
+                        all_kb_content, kb_latencies = await query_knowledge_bases(
+                            [kb["kb_id"] for kb in kb_list],
+                            user_prompt,
+                            rerank=settings["KBSettings"]["is_rerank"],
+                        )
+                        kb_latency_text = " | ".join(
+                            f'{kb["name"]}: {kb_latencies.get(kb["kb_id"])}ms' if kb_latencies.get(kb["kb_id"]) is not None
+                            else f'{kb["name"]}: failed'
+                            for kb in kb_list
+                        )
                         if all_kb_content:
                             all_kb_content = json.dumps(all_kb_content, ensure_ascii=False, indent=4)
                             kb_message = f"\n\n可参考的知识库内容：{all_kb_content}"
@@ -2395,7 +2192,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             tool_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"""<div class="highlight-block"><div style="margin-bottom: 10px;">{await t("search_result")}</div><div>{str(all_kb_content)}</div></div>""",
+                                        "tool_content": f"""<div class="highlight-block"><div style="margin-bottom: 10px;">{await t("search_result")}</div><div style="margin-bottom: 10px;">{kb_latency_text}</div><div>{str(all_kb_content)}</div></div>""",
                                         "tool_link": fileLink,
                                     }
                                 }]
@@ -2464,31 +2261,9 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             }
                             yield f"data: {json.dumps(tool_chunk)}\n\n"
                     if settings['webSearch']['when'] == 'after_thinking' or settings['webSearch']['when'] == 'both':
-                        if settings['webSearch']['engine'] == 'duckduckgo':
-                            tools.append(duckduckgo_tool)
-                        elif settings['webSearch']['engine'] == 'searxng':
-                            tools.append(searxng_tool)
-                        elif settings['webSearch']['engine'] == 'tavily':
-                            tools.append(tavily_tool)
-                        elif settings['webSearch']['engine'] == 'bing':
-                            tools.append(bing_tool)
-                        elif settings['webSearch']['engine'] == 'google':
-                            tools.append(google_tool)
-                        elif settings['webSearch']['engine'] == 'brave':
-                            tools.append(brave_tool)
-                        elif settings['webSearch']['engine'] == 'exa':
-                            tools.append(exa_tool)
-                        elif settings['webSearch']['crawler'] == 'serper':
-                            tools.append(serper_tool)
-                        elif settings['webSearch']['crawler'] == 'bochaai':
-                            tools.append(bochaai_tool)
-
-                        if settings['webSearch']['crawler'] == 'jina':
-                            tools.append(jina_crawler_tool)
-                        elif settings['webSearch']['crawler'] == 'crawl4ai':
-                            tools.append(Crawl4Ai_tool)
+                        tools.extend(tool_set.search_tools)
                 if kb_list:
-                    tools.append(kb_tool)
+                    tools.append(tool_set.kb_tool)
                 if settings['tools']['deepsearch']['enabled'] or enable_deep_research: 
                     deepsearch_messages = copy.deepcopy(request.messages)
                     content_append(deepsearch_messages, 'user',  "\n\n将用户提出的问题或给出的当前任务拆分成多个步骤，每一个步骤用一句简短的话概括即可，无需回答或执行这些内容，直接返回总结即可，但不能省略问题或任务的细节。如果用户输入的只是闲聊或者不包含任务和问题，直接把用户输入重复输出一遍即可。如果是非常简单的问题，也可以只给出一个步骤即可。一般情况下都是需要拆分成多个步骤的。")
@@ -2667,17 +2442,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         continue
                     choice = chunk.choices[0]
                     if choice.delta.tool_calls:  # function_calling
-                        for idx, tool_call in enumerate(choice.delta.tool_calls):
-                            tool = choice.delta.tool_calls[idx]
-                            if len(tool_calls) <= idx:
-                                tool_calls.append(tool)
-                                continue
-                            if tool.function.arguments:
-                                # function参数为流式响应，需要拼接
-                                if tool_calls[idx].function.arguments:
-                                    tool_calls[idx].function.arguments += tool.function.arguments
-                                else:
-                                    tool_calls[idx].function.arguments = tool.function.arguments
+                        merge_tool_call_delta(tool_calls, choice.delta.tool_calls)
                     else:
                         # 创建原始chunk的拷贝
                         chunk_dict = chunk.model_dump()
@@ -2917,239 +2682,207 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                 while tool_calls or search_not_done:
                     full_content = ""
                     if tool_calls:
-                        response_content = tool_calls[0].function
-                        print(response_content)
-                        if response_content.name in  ["DDGsearch_async","searxng_async", "Bing_search_async", "Google_search_async", "Brave_search_async", "Exa_search_async", "Serper_search_async","bochaai_search_async","Tavily_search_async"]:
-                            chunk_dict = {
-                                "id": "agentParty",
-                                "choices": [
-                                    {
-                                        "finish_reason": None,
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "tool_content": f'\n\n<div class="highlight-block">\n{await t("web_search")}</div>\n\n'
-                                        }
-                                    }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        elif response_content.name in  ["jina_crawler_async","Crawl4Ai_search_async"]:
-                            chunk_dict = {
-                                "id": "agentParty",
-                                "choices": [
-                                    {
-                                        "finish_reason": None,
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "tool_content": f'\n\n<div class="highlight-block">\n{await t("web_search_more")}</div>\n\n'
-                                        }
+                        # 同一轮中的全部工具调用：先依次展示调用信息，再并发执行
+                        calls = []
+                        for tool_call in tool_calls:
+                            # 个别接口的 index 不连续，跳过空位
+                            if tool_call is None:
+                                continue
+                            response_content = tool_call.function
+                            print(response_content)
+                            yield await tool_call_header_sse(response_content.name)
+                            modified_data = '[' + response_content.arguments.replace('}{', '},{') + ']'
+                            # 使用json.loads来解析修改后的字符串为列表
+                            data_list = json.loads(modified_data)
+                            modified_tool = f"{await t("sendArg")}{data_list[0]}"
+                            tool_call_chunk = {
+                                "choices": [{
+                                    "delta": {
+                                        "tool_content": f'\n\n<div class="highlight-block">\n{modified_tool}\n</div></div>\n\n',
                                     }
-                                ]
+                                }]
                             }
-                            yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        elif response_content.name in ["query_knowledge_base"]:
-                            chunk_dict = {
-                                "id": "agentParty",
-                                "choices": [
-                                    {
-                                        "finish_reason": None,
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "tool_content": f'\n\n<div class="highlight-block">\n{await t("knowledge_base")}</div>\n\n'
+                            yield f"data: {json.dumps(tool_call_chunk)}\n\n"
+                            calls.append((tool_call, response_content, data_list, modified_data))
+
+                        call_results = [None] * len(calls)
+                        if settings['tools']['asyncTools']['enabled']:
+                            for i, (tool_call, response_content, data_list, modified_data) in enumerate(calls):
+                                tool_id = uuid.uuid4()
+                                async_tool_id = f"{response_content.name}_{tool_id}"
+                                chunk_dict = {
+                                    "id": "agentParty",
+                                    "choices": [
+                                        {
+                                            "finish_reason": None,
+                                            "index": 0,
+                                            "delta": {
+                                                "role":"assistant",
+                                                "content": "",
+                                                "async_tool_id": async_tool_id
+                                            }
                                         }
+                                    ]
+                                }
+                                yield f"data: {json.dumps(chunk_dict)}\n\n"
+                                # 启动异步任务并记录状态
+                                asyncio.create_task(
+                                    execute_async_tool(
+                                        async_tool_id,
+                                        response_content.name,
+                                        data_list[0],
+                                        settings,
+                                        user_prompt
+                                    )
+                                )
+                                
+                                async with async_tools_lock:
+                                    async_tools[async_tool_id] = {
+                                        "status": "pending",
+                                        "result": None,
+                                        "name":response_content.name,
+                                        "parameters":data_list[0]
                                     }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk_dict)}\n\n"
+                                call_results[i] = f"{response_content.name}工具已成功启动，获取结果需要花费很久的时间。请不要再次调用该工具，因为工具结果将生成后自动发送，再次调用也不能更快的获取到结果。请直接告诉用户，你会在获得结果后回答他的问题。"
                         else:
-                            chunk_dict = {
-                                "id": "agentParty",
-                                "choices": [
-                                    {
-                                        "finish_reason": None,
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "tool_content": f'\n\n<div class="highlight-block">\n{await t("call")}{response_content.name}{await t("tool")}</div>\n\n'
+                            # 只有一个调用时保留流式工具的实时输出；多个调用时各自读完后整体展示，避免输出交错
+                            drain_streams = len(calls) > 1
+                            semaphore = asyncio.Semaphore(TOOL_CALL_CONCURRENCY)
+                            pending = [
+                                asyncio.create_task(run_tool_call(i, response_content.name, data_list[0], settings, semaphore, drain_streams))
+                                for i, (tool_call, response_content, data_list, modified_data) in enumerate(calls)
+                            ]
+                            try:
+                                for finished in asyncio.as_completed(pending):
+                                    i, results = await finished
+                                    response_content = calls[i][1]
+                                    if results is None:
+                                        continue
+                                    if response_content.name in ["query_knowledge_base"] and type(results) == list:
+                                        if settings["KBSettings"]["is_rerank"]:
+                                            results = await rerank_knowledge_base(user_prompt,results)
+                                        results = json.dumps(results, ensure_ascii=False, indent=4)
+                                    timestamp = time.time()
+                                    uid     = str(uuid.uuid4())
+                                    filename = f"{timestamp}_{uid}.txt"
+                                    file_path = os.path.join(TOOL_TEMP_DIR, filename)
+
+                                    # 工具名国际化
+                                    tool_name_text = f"{response_content.name}{await t('tool_result')}"
+                                    stream_tool_name_text = f"{response_content.name}{await t('stream_tool_result')}"
+                                    # ---------- 统一 SSE 封装 ----------
+                                    def make_sse(tool_html: str) -> str:
+                                        chunk = {
+                                            "choices": [{
+                                                "delta": {
+                                                    "tool_content": tool_html,
+                                                    "tool_link": f"{fastapi_base_url}tool_temp/{filename}",
+                                                }
+                                            }]
                                         }
-                                    }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        modified_data = '[' + response_content.arguments.replace('}{', '},{') + ']'
-                        # 使用json.loads来解析修改后的字符串为列表
-                        data_list = json.loads(modified_data)
-                        modified_tool = f"{await t("sendArg")}{data_list[0]}"
-                        tool_call_chunk = {
-                            "choices": [{
-                                "delta": {
-                                    "tool_content": f'\n\n<div class="highlight-block">\n{modified_tool}\n</div></div>\n\n',
+                                        return f"data: {json.dumps(chunk)}\n\n"
+
+                                    # ---------- 分情况处理 ----------
+                                    if not isinstance(results, AsyncIterator):
+                                        # 老逻辑：一次性写完、一次性发
+                                        async with aiofiles.open(file_path, "w", encoding="utf-8") as f:
+                                            await f.write(results)
+                                        html = (
+                                            '<div class="highlight-block">'
+                                            f'<div style="margin-bottom: 10px;">{tool_name_text}</div>'
+                                            f'<div>{results}</div>'
+                                            '</div></div>'
+                                        )
+                                        yield make_sse(html)
+                                    else:  # AsyncIterator[str]
+                                        buffer = []
+                                        first = True
+                                        async with aiofiles.open(file_path, "w", encoding="utf-8") as f:
+                                            async for chunk in results:
+                                                await f.write(chunk)
+                                                await f.flush()
+                                                buffer.append(chunk)
+                                                if first:                       # 第一次：带头部
+                                                    html = (
+                                                        '<div class="highlight-block">'
+                                                        f'<div style="margin-bottom: 10px;">{stream_tool_name_text}</div>'
+                                                        f'<div>{chunk}'
+                                                    )
+                                                    first = False
+                                                else:                           # 中间：只拼裸文本
+                                                    html = chunk
+
+                                                yield make_sse(html)
+
+                                            # 迭代结束：补尾部
+                                            yield make_sse('</div></div></div>')
+                                        results = "".join(buffer)
+                                    call_results[i] = results
+                            finally:
+                                for task in pending:
+                                    task.cancel()
+                        # 一条 assistant 消息携带本轮由服务端执行的全部 tool_calls，随后按顺序附上各自的结果，一次性发回模型
+                        served = [(call, results) for call, results in zip(calls, call_results) if results is not None]
+                        if served:
+                            request.messages.append(
+                                {
+                                    "tool_calls": [
+                                        {
+                                            "id": tool_call.id,
+                                            "function": {
+                                                "arguments": json.dumps(data_list[0]),
+                                                "name": response_content.name,
+                                            },
+                                            "type": tool_call.type,
+                                        }
+                                        for (tool_call, response_content, data_list, modified_data), _ in served
+                                    ],
+                                    "role": "assistant",
+                                    "content": "\n".join(str(call[1]) for call, _ in served),
                                 }
-                            }]
-                        }
-                        yield f"data: {json.dumps(tool_call_chunk)}\n\n"
-                        if settings['tools']['asyncTools']['enabled']:
-                            tool_id = uuid.uuid4()
-                            async_tool_id = f"{response_content.name}_{tool_id}"
-                            chunk_dict = {
-                                "id": "agentParty",
-                                "choices": [
+                            )
+                            if (settings['webSearch']['when'] == 'after_thinking' or settings['webSearch']['when'] == 'both') and settings['tools']['asyncTools']['enabled'] is False:
+                                content_append(request.messages, 'user',  f"\n对于联网搜索的结果，如果联网搜索的信息不足以回答问题时，你可以进一步使用联网搜索查询还未给出的必要信息。如果已经足够回答问题，请直接回答问题。")
+                            for (tool_call, response_content, data_list, modified_data), results in served:
+                                request.messages.append(
                                     {
-                                        "finish_reason": None,
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "async_tool_id": async_tool_id
-                                        }
+                                        "role": "tool",
+                                        "tool_call_id": tool_call.id,
+                                        "name": response_content.name,
+                                        "content": str("".join(results)),
                                     }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk_dict)}\n\n"
-                            # 启动异步任务并记录状态
-                            asyncio.create_task(
-                                execute_async_tool(
-                                    async_tool_id,
-                                    response_content.name,
-                                    data_list[0],
-                                    settings,
-                                    user_prompt
                                 )
-                            )
-                            
-                            async with async_tools_lock:
-                                async_tools[async_tool_id] = {
-                                    "status": "pending",
-                                    "result": None,
-                                    "name":response_content.name,
-                                    "parameters":data_list[0]
-                                }
-                            results = f"{response_content.name}工具已成功启动，获取结果需要花费很久的时间。请不要再次调用该工具，因为工具结果将生成后自动发送，再次调用也不能更快的获取到结果。请直接告诉用户，你会在获得结果后回答他的问题。"
-                        else:
-                            results = await dispatch_tool(response_content.name, data_list[0],settings)
-                        if results is None:
-                            chunk = {
-                                "id": "extra_tools",
-                                "choices": [
+                                reasoner_messages.append(
                                     {
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "tool_calls":modified_data,
-                                        }
+                                        "role": "assistant",
+                                        "content": str(response_content),
                                     }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                            break
-                        if response_content.name in ["query_knowledge_base"] and type(results) == list:
-                            if settings["KBSettings"]["is_rerank"]:
-                                results = await rerank_knowledge_base(user_prompt,results)
-                            results = json.dumps(results, ensure_ascii=False, indent=4)
-                        request.messages.append(
-                            {
-                                "tool_calls": [
+                                )
+                                reasoner_messages.append(
                                     {
-                                        "id": tool_calls[0].id,
-                                        "function": {
-                                            "arguments": json.dumps(data_list[0]),
-                                            "name": response_content.name,
-                                        },
-                                        "type": tool_calls[0].type,
+                                        "role": "user",
+                                        "content": f"{response_content.name}工具结果："+str(results),
                                     }
-                                ],
-                                "role": "assistant",
-                                "content": str(response_content),
-                            }
-                        )
-                        if (settings['webSearch']['when'] == 'after_thinking' or settings['webSearch']['when'] == 'both') and settings['tools']['asyncTools']['enabled'] is False:
-                            content_append(request.messages, 'user',  f"\n对于联网搜索的结果，如果联网搜索的信息不足以回答问题时，你可以进一步使用联网搜索查询还未给出的必要信息。如果已经足够回答问题，请直接回答问题。")
-                        if settings['tools']['asyncTools']['enabled']:
-                            pass
-                        else:
-                            timestamp = time.time()
-                            uid     = str(uuid.uuid4())
-                            filename = f"{timestamp}_{uid}.txt"
-                            file_path = os.path.join(TOOL_TEMP_DIR, filename)
-
-                            # 工具名国际化
-                            tool_name_text = f"{response_content.name}{await t('tool_result')}"
-                            stream_tool_name_text = f"{response_content.name}{await t('stream_tool_result')}"
-                            # ---------- 统一 SSE 封装 ----------
-                            def make_sse(tool_html: str) -> str:
+                                )
+                        # 返回 None 的工具由前端执行（extra_tools）：服务端结果已记入消息，其余调用交还给客户端处理
+                        client_side = [call[3] for call, results in zip(calls, call_results) if results is None]
+                        if client_side:
+                            for modified_data in client_side:
                                 chunk = {
-                                    "choices": [{
-                                        "delta": {
-                                            "tool_content": tool_html,
-                                            "tool_link": f"{fastapi_base_url}tool_temp/{filename}",
+                                    "id": "extra_tools",
+                                    "choices": [
+                                        {
+                                            "index": 0,
+                                            "delta": {
+                                                "role":"assistant",
+                                                "content": "",
+                                                "tool_calls":modified_data,
+                                            }
                                         }
-                                    }]
+                                    ]
                                 }
-                                return f"data: {json.dumps(chunk)}\n\n"
-
-                            # ---------- 分情况处理 ----------
-                            if not isinstance(results, AsyncIterator):
-                                # 老逻辑：一次性写完、一次性发
-                                async with aiofiles.open(file_path, "w", encoding="utf-8") as f:
-                                    await f.write(results)
-                                html = (
-                                    '<div class="highlight-block">'
-                                    f'<div style="margin-bottom: 10px;">{tool_name_text}</div>'
-                                    f'<div>{results}</div>'
-                                    '</div></div>'
-                                )
-                                yield make_sse(html)
-                            else:  # AsyncIterator[str]
-                                buffer = []
-                                first = True
-                                async with aiofiles.open(file_path, "w", encoding="utf-8") as f:
-                                    async for chunk in results:
-                                        await f.write(chunk)
-                                        await f.flush()
-                                        buffer.append(chunk)
-                                        if first:                       # 第一次：带头部
-                                            html = (
-                                                '<div class="highlight-block">'
-                                                f'<div style="margin-bottom: 10px;">{stream_tool_name_text}</div>'
-                                                f'<div>{chunk}'
-                                            )
-                                            first = False
-                                        else:                           # 中间：只拼裸文本
-                                            html = chunk
-
-                                        yield make_sse(html)
-
-                                    # 迭代结束：补尾部
-                                    yield make_sse('</div></div></div>')
-                                results = "".join(buffer)
-                        request.messages.append(
-                            {
-                                "role": "tool",
-                                "tool_call_id": tool_calls[0].id,
-                                "name": response_content.name,
-                                "content": str("".join(results)),
-                            }
-                        )
-                        reasoner_messages.append(
-                            {
-                                "role": "assistant",
-                                "content": str(response_content),
-                            }
-                        )
-                        reasoner_messages.append(
-                            {
-                                "role": "user",
-                                "content": f"{response_content.name}工具结果："+str(results),
-                            }
-                        )
+                                yield f"data: {json.dumps(chunk)}\n\n"
+                            break
                     # 如果启用推理模型
                     if settings['reasoner']['enabled'] or enable_thinking:
                         if tools:
@@ -3290,17 +3023,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         if chunk.choices:
                             choice = chunk.choices[0]
                             if choice.delta.tool_calls:  # function_calling
-                                for idx, tool_call in enumerate(choice.delta.tool_calls):
-                                    tool = choice.delta.tool_calls[idx]
-                                    if len(tool_calls) <= idx:
-                                        tool_calls.append(tool)
-                                        continue
-                                    if tool.function.arguments:
-                                        # function参数为流式响应，需要拼接
-                                        if tool_calls[idx].function.arguments:
-                                            tool_calls[idx].function.arguments += tool.function.arguments
-                                        else:
-                                            tool_calls[idx].function.arguments = tool.function.arguments
+                                merge_tool_call_delta(tool_calls, choice.delta.tool_calls)
                             else:
                                 # 创建原始chunk的拷贝
                                 chunk_dict = chunk.model_dump()
@@ -3589,12 +3312,12 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
         )
 
 async def generate_complete_response(client,reasoner_client, request: ChatRequest, settings: dict,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search):
-    from mem0 import Memory
+    from py.memory_cache import get_memory_instance
     global mcp_client_list,HA_client,ChromeMCP_client,sql_client
     DRS_STAGE = 1 # 1: 明确用户需求阶段 2: 工具调用阶段 3: 生成结果阶段
     if len(request.messages) > 2:
         DRS_STAGE = 2
-    from py.load_files import get_files_content,file_tool,image_tool
+    from py.load_files import get_files_content
     from py.web_search import (
         DDGsearch_async, 
         searxng_async, 
@@ -3605,207 +3328,31 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
         Exa_search_async,
         Serper_search_async,
         bochaai_search_async,
-        duckduckgo_tool, 
-        searxng_tool, 
-        tavily_tool, 
-        bing_tool,
-        google_tool,
-        brave_tool,
-        exa_tool,
-        serper_tool,
-        bochaai_tool,
-        jina_crawler_tool, 
-        Crawl4Ai_tool
     )
-    from py.know_base import kb_tool,query_knowledge_base,rerank_knowledge_base
-    from py.agent_tool import get_agent_tool
-    from py.a2a_tool import get_a2a_tool
-    from py.llm_tool import get_llm_tool
-    from py.pollinations import pollinations_image_tool,openai_image_tool,openai_chat_image_tool
-    from py.code_interpreter import e2b_code_tool,local_run_code_tool
-    from py.utility_tools import time_tool
-    from py.utility_tools import (
-        time_tool, 
-        weather_tool,
-        location_tool,
-        timer_weather_tool,
-        wikipedia_summary_tool,
-        wikipedia_section_tool,
-        arxiv_tool
-    ) 
-    from py.autoBehavior import auto_behavior_tool
-    from py.cli_tool import claude_code_tool,qwen_code_tool
+    from py.know_base import query_knowledge_bases,rerank_knowledge_base
     m0 = None
     if settings["memorySettings"]["is_memory"] and settings["memorySettings"]["selectedMemory"] and settings["memorySettings"]["selectedMemory"] != "":
         memoryId = settings["memorySettings"]["selectedMemory"]
         cur_memory = None
         for memory in settings["memories"]:
             if memory["id"] == memoryId:
-                cur_memory = memory
+                # 请求内的副本：下方 {{user}}/{{char}} 替换不会写回共享设置
+                cur_memory = dict(memory)
                 break
         if cur_memory and cur_memory["providerId"]:
             print("长期记忆启用")
-            config={
-                "embedder": {
-                    "provider": 'openai',
-                    "config": {
-                        "model": cur_memory['model'],
-                        "api_key": cur_memory['api_key'],
-                        "openai_base_url":cur_memory["base_url"],
-                        "embedding_dims":cur_memory.get("embedding_dims", 1024)
-                    },
-                },
-                "llm": {
-                    "provider": 'openai',
-                    "config": {
-                        "model": settings['model'],
-                        "api_key": settings['api_key'],
-                        "openai_base_url":settings["base_url"]
-                    }
-                },
-                "vector_store": {
-                    "provider": "faiss",
-                    "config": {
-                        "collection_name": "agent-party",
-                        "path": os.path.join(MEMORY_CACHE_DIR,memoryId),
-                        "distance_strategy": "euclidean",
-                        "embedding_model_dims": cur_memory.get("embedding_dims", 1024)
-                    }
-                }
-            }
-            m0 = Memory.from_config(config)
+            # 复用缓存的 Memory 实例（按 memoryId + 配置哈希），不再每次请求重新加载
+            m0 = await get_memory_instance(cur_memory, settings)
     images = await images_in_messages(request.messages,fastapi_base_url)
     request.messages = await message_without_images(request.messages)
     open_tag = "<think>"
     close_tag = "</think>"
-    tools = request.tools or []
-    tools = request.tools or []
+    tool_set = await get_tool_set(settings)
+    tools = list(request.tools or []) + tool_set.schemas
+    if tool_set.auto_behavior_tool and request.messages[-1]['role'] == 'user':
+        tools.append(tool_set.auto_behavior_tool)
     extra = {}
     reasoner_extra = {}
-    if mcp_client_list:
-        for server_name, mcp_client in mcp_client_list.items():
-            if server_name in settings['mcpServers']:
-                if 'disabled' not in settings['mcpServers'][server_name]:
-                    settings['mcpServers'][server_name]['disabled'] = False
-                if settings['mcpServers'][server_name]['disabled'] == False and settings['mcpServers'][server_name]['processingStatus'] == 'ready':
-                    disable_tools = []
-                    for tool in settings['mcpServers'][server_name]["tools"]: 
-                        if tool.get("enabled", True) == False:
-                            disable_tools.append(tool["name"])
-                    function = await mcp_client.get_openai_functions(disable_tools=disable_tools)
-                    if function:
-                        tools.extend(function)
-    get_llm_tool_fuction = await get_llm_tool(settings)
-    if get_llm_tool_fuction:
-        tools.append(get_llm_tool_fuction)
-    get_agent_tool_fuction = await get_agent_tool(settings)
-    if get_agent_tool_fuction:
-        tools.append(get_agent_tool_fuction)
-    get_a2a_tool_fuction = await get_a2a_tool(settings)
-    if get_a2a_tool_fuction:
-        tools.append(get_a2a_tool_fuction)
-    if settings["HASettings"]["enabled"]:
-        ha_tool = await HA_client.get_openai_functions(disable_tools=[])
-        if ha_tool:
-            tools.extend(ha_tool)
-    if settings['chromeMCPSettings']['enabled']:
-        chromeMCP_tool = await ChromeMCP_client.get_openai_functions(disable_tools=[])
-        if chromeMCP_tool:
-            tools.extend(chromeMCP_tool)
-    if settings['sqlSettings']['enabled']:
-        sql_tool = await sql_client.get_openai_functions(disable_tools=[])
-        if sql_tool:
-            tools.extend(sql_tool)
-    if settings['CLISettings']['enabled']:
-        if settings['CLISettings']['engine'] == 'cc':
-            tools.append(claude_code_tool)
-        elif settings['CLISettings']['engine'] == 'qc':
-            tools.append(qwen_code_tool)
-    if settings['tools']['time']['enabled'] and settings['tools']['time']['triggerMode'] == 'afterThinking':
-        tools.append(time_tool)
-    if settings["tools"]["weather"]['enabled']:
-        tools.append(weather_tool)
-        tools.append(location_tool)
-        tools.append(timer_weather_tool)
-    if settings["tools"]["wikipedia"]['enabled']:
-        tools.append(wikipedia_summary_tool)
-        tools.append(wikipedia_section_tool)
-    if settings["tools"]["arxiv"]['enabled']:
-        tools.append(arxiv_tool)
-    if settings['text2imgSettings']['enabled']:
-        if settings['text2imgSettings']['engine'] == 'pollinations':
-            tools.append(pollinations_image_tool)
-        elif settings['text2imgSettings']['engine'] == 'openai':
-            tools.append(openai_image_tool)
-        elif settings['text2imgSettings']['engine'] == 'openaiChat':
-            tools.append(openai_chat_image_tool)
-    if settings['tools']['getFile']['enabled']:
-        tools.append(file_tool)
-        tools.append(image_tool)
-    if settings['tools']['autoBehavior']['enabled'] and request.messages[-1]['role'] == 'user':
-        tools.append(auto_behavior_tool)
-    if settings["codeSettings"]['enabled']:
-        if settings["codeSettings"]["engine"] == "e2b":
-            tools.append(e2b_code_tool)
-        elif settings["codeSettings"]["engine"] == "sandbox":
-            tools.append(local_run_code_tool)
-    if settings["custom_http"]:
-        for custom_http in settings["custom_http"]:
-            if custom_http["enabled"]:
-                if custom_http['body'] == "":
-                    custom_http['body'] = "{}"
-                custom_http_tool = {
-                    "type": "function",
-                    "function": {
-                        "name": f"custom_http_{custom_http['name']}",
-                        "description": f"{custom_http['description']}",
-                        "parameters": json.loads(custom_http['body']),
-                    },
-                }
-                tools.append(custom_http_tool)
-    if settings["workflows"]:
-        for workflow in settings["workflows"]:
-            if workflow["enabled"]:
-                comfyui_properties = {}
-                comfyui_required = []
-                if workflow["text_input"] is not None:
-                    comfyui_properties["text_input"] = {
-                        "description": "第一个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
-                        "type": "string"
-                    }
-                    comfyui_required.append("text_input")
-                if workflow["text_input_2"] is not None:
-                    comfyui_properties["text_input_2"] = {
-                        "description": "第二个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
-                        "type": "string"
-                    }
-                    comfyui_required.append("text_input_2")
-                if workflow["image_input"] is not None:
-                    comfyui_properties["image_input"] = {
-                        "description": "第一个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
-                        "type": "string"
-                    }
-                    comfyui_required.append("image_input")
-                if workflow["image_input_2"] is not None:
-                    comfyui_properties["image_input_2"] = {
-                        "description": "第二个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
-                        "type": "string"
-                    }
-                    comfyui_required.append("image_input_2")
-                comfyui_parameters = {
-                    "type": "object",
-                    "properties": comfyui_properties,
-                    "required": comfyui_required
-                }
-                comfyui_tool = {
-                    "type": "function",
-                    "function": {
-                        "name": f"comfyui_{workflow['unique_filename']}",
-                        "description": f"{workflow['description']}+\n如果要输入图片提示词或者修改提示词，尽可能使用英语。\n返回的图片结果，请将图片的URL放入![image]()这样的markdown语法中，用户才能看到图片。如果是视频，请将视频的URL放入<video controls> <source src=''></video>的中src中，用户才能看到视频。如果有多个结果，则请用换行符分隔开这几个图片或者视频，用户才能看到多个结果。",
-                        "parameters": comfyui_parameters,
-                    },
-                }
-                tools.append(comfyui_tool)
     search_not_done = False
     search_task = ""
     try:
@@ -3813,11 +3360,8 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
         extra_params = settings['extra_params']
         # 移除extra_params这个list中"name"不包含非空白符的键值对
         if extra_params:
-            for extra_param in extra_params:
-                if not extra_param['name'].strip():
-                    extra_params.remove(extra_param)
-            # 列表转换为字典
-            extra_params = {item['name']: item['value'] for item in extra_params}
+            # 列表转换为字典（settings 为只读快照，过滤时不修改原列表）
+            extra_params = {item['name']: item['value'] for item in extra_params if item['name'].strip()}
         else:
             extra_params = {}
         if request.fileLinks:
@@ -3841,14 +3385,9 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                     assistant_reply = request.messages[i]['content']
                     break
             if cur_memory["characterBook"]:
-                for lore in cur_memory["characterBook"]:
-                    # lore['keysRaw'] 按照换行符分割，并去除空字符串
-                    lore_keys = lore["keysRaw"].split("\n")
-                    lore_keys = [key for key in lore_keys if key != ""]
-                    print(lore_keys)
-                    # 如果lore_keys不为空，并且lore_keys的任意一个元素在user_prompt或者assistant_reply中，则添加lore['content']到lore_content中
-                    if lore_keys != [] and any(key in user_prompt or key in assistant_reply for key in lore_keys):
-                        lore_content += lore['content'] + "\n\n"
+                # 预编译的多关键词自动机（按 memoryId 缓存），一次扫描找出所有被触发的条目
+                for lore in match_lore(memoryId, cur_memory["characterBook"], user_prompt, assistant_reply):
+                    lore_content += lore['content'] + "\n\n"
             if lore_content:
                 if settings["memorySettings"]["userName"]:
                     # 替换lore_content中的{{user}}为settings["memorySettings"]["userName"]
@@ -3889,14 +3428,15 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                 cur_memory["systemPrompt"] = cur_memory["systemPrompt"].replace("{{char}}", cur_memory["name"])
                 print("添加系统提示：\n\n" + cur_memory["systemPrompt"] + "\n\n系统提示结束\n\n")
                 content_append(request.messages, 'system', "系统提示：\n\n" + cur_memory["systemPrompt"] + "\n\n系统提示结束\n\n")
-            if settings["memorySettings"]["genericSystemPrompt"]:
+            generic_system_prompt = settings["memorySettings"]["genericSystemPrompt"]
+            if generic_system_prompt:
                 if settings["memorySettings"]["userName"]:
-                    # 替换settings["memorySettings"]["genericSystemPrompt"]中的{{user}}为settings["memorySettings"]["userName"]
-                    settings["memorySettings"]["genericSystemPrompt"] = settings["memorySettings"]["genericSystemPrompt"].replace("{{user}}", settings["memorySettings"]["userName"])
-                # 替换cur_memory["systemPrompt"]中的{{char}}为cur_memory["name"]
-                settings["memorySettings"]["genericSystemPrompt"] = settings["memorySettings"]["genericSystemPrompt"].replace("{{char}}", cur_memory["name"])
-                print("添加系统提示：\n\n" + settings["memorySettings"]["genericSystemPrompt"] + "\n\n系统提示结束\n\n")
-                content_append(request.messages, 'system', "系统提示：\n\n" + settings["memorySettings"]["genericSystemPrompt"] + "\n\n系统提示结束\n\n")
+                    # 替换genericSystemPrompt中的{{user}}为settings["memorySettings"]["userName"]
+                    generic_system_prompt = generic_system_prompt.replace("{{user}}", settings["memorySettings"]["userName"])
+                # 替换genericSystemPrompt中的{{char}}为cur_memory["name"]
+                generic_system_prompt = generic_system_prompt.replace("{{char}}", cur_memory["name"])
+                print("添加系统提示：\n\n" + generic_system_prompt + "\n\n系统提示结束\n\n")
+                content_append(request.messages, 'system', "系统提示：\n\n" + generic_system_prompt + "\n\n系统提示结束\n\n")
                     
             if m0:
                 memoryLimit = settings["memorySettings"]["memoryLimit"]
@@ -3921,13 +3461,12 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                     kb_list.append({"kb_id":kb["id"],"name": kb["name"],"introduction":kb["introduction"]})
         if settings["KBSettings"]["when"] == "before_thinking" or settings["KBSettings"]["when"] == "both":
             if kb_list:
-                all_kb_content = []
-                # 用query_knowledge_base函数查询kb_list中所有的知识库
-                for kb in kb_list:
-                    kb_content = await query_knowledge_base(kb["kb_id"],user_prompt)
-                    all_kb_content.extend(kb_content)
-                    if settings["KBSettings"]["is_rerank"]:
-                        all_kb_content = await rerank_knowledge_base(user_prompt,all_kb_content)
+                # 并发查询kb_list中所有的知识库，融合后统一rerank一次
+                all_kb_content, _ = await query_knowledge_bases(
+                    [kb["kb_id"] for kb in kb_list],
+                    user_prompt,
+                    rerank=settings["KBSettings"]["is_rerank"],
+                )
                 if all_kb_content:
                     kb_message = f"\n\n可参考的知识库内容：{all_kb_content}"
                     content_append(request.messages, 'user',  f"{kb_message}\n\n用户：{user_prompt}")
@@ -3985,31 +3524,9 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                 if results:
                     content_append(request.messages, 'user',  f"\n\n联网搜索结果：{results}")
             if settings['webSearch']['when'] == 'after_thinking' or settings['webSearch']['when'] == 'both':
-                if settings['webSearch']['engine'] == 'duckduckgo':
-                    tools.append(duckduckgo_tool)
-                elif settings['webSearch']['engine'] == 'searxng':
-                    tools.append(searxng_tool)
-                elif settings['webSearch']['engine'] == 'tavily':
-                    tools.append(tavily_tool)
-                elif settings['webSearch']['engine'] == 'bing':
-                    tools.append(bing_tool)
-                elif settings['webSearch']['engine'] == 'google':
-                    tools.append(google_tool)
-                elif settings['webSearch']['engine'] == 'brave':
-                    tools.append(brave_tool)
-                elif settings['webSearch']['engine'] == 'exa':
-                    tools.append(exa_tool)
-                elif settings['webSearch']['crawler'] == 'serper':
-                    tools.append(serper_tool)
-                elif settings['webSearch']['crawler'] == 'bochaai':
-                    tools.append(bochaai_tool)
-
-                if settings['webSearch']['crawler'] == 'jina':
-                    tools.append(jina_crawler_tool)
-                elif settings['webSearch']['crawler'] == 'crawl4ai':
-                    tools.append(Crawl4Ai_tool)
+                tools.extend(tool_set.search_tools)
         if kb_list:
-            tools.append(kb_tool)
+            tools.append(tool_set.kb_tool)
         if settings['tools']['deepsearch']['enabled'] or enable_deep_research: 
             deepsearch_messages = copy.deepcopy(request.messages)
             content_append(deepsearch_messages, 'user',  "\n\n将用户提出的问题或给出的当前任务拆分成多个步骤，每一个步骤用一句简短的话概括即可，无需回答或执行这些内容，直接返回总结即可，但不能省略问题或任务的细节。如果用户输入的只是闲聊或者不包含任务和问题，直接把用户输入重复输出一遍即可。如果是非常简单的问题，也可以只给出一个步骤即可。一般情况下都是需要拆分成多个步骤的。")
@@ -4598,7 +4115,7 @@ class ProviderModelRequest(BaseModel):
 async def fetch_provider_models(request: ProviderModelRequest):
     try:
         # 使用传入的provider配置创建AsyncOpenAI客户端
-        client = AsyncOpenAI(api_key=request.api_key, base_url=request.url)
+        client = get_llm_client('OpenAI', request.url, request.api_key)
         # 获取模型列表
         model_list = await client.models.list()
         # 提取模型ID并返回
@@ -4619,7 +4136,6 @@ async def chat_endpoint(request: ChatRequest,fastapi_request: Request):
     enable_web_search: 默认为False，是否启用网络搜索
     """
     fastapi_base_url = str(fastapi_request.base_url)
-    global client, settings,reasoner_client,mcp_client_list
     # identify user from passthrough (client should include local sap_user_id)
     user_key = request.passthrough or str(fastapi_request.query_params.get('passthrough') or 'local_default_user')
     model = request.model or 'super-model' # 默认使用 'super-model'
@@ -4628,18 +4144,10 @@ async def chat_endpoint(request: ChatRequest,fastapi_request: Request):
     enable_web_search = request.enable_web_search or False
     async_tools_id = request.asyncToolsID or None
     if model == 'super-model':
-        current_settings = await load_settings()
-        # prepare settings copy to enforce feature gating for non-premium users
-        is_premium = is_premium_user(user_key)
-        settings_for_call = copy.deepcopy(current_settings)
-        if not is_premium:
-            # disable server-side features for free users
-            if 'ttsSettings' in settings_for_call:
-                settings_for_call['ttsSettings'] = settings_for_call.get('ttsSettings', {}).copy()
-                settings_for_call['ttsSettings']['enabled'] = False
-            if 'text2imgSettings' in settings_for_call:
-                settings_for_call['text2imgSettings'] = settings_for_call.get('text2imgSettings', {}).copy()
-                settings_for_call['text2imgSettings']['enabled'] = False
+        # 只读快照 + 写时复制覆盖，避免每个请求深拷贝整棵设置树
+        current_settings = await get_settings_snapshot()
+        # enforce feature gating for non-premium users
+        settings_for_call = gate_settings_for_user(current_settings, user_key)
         if len(current_settings['modelProviders']) <= 0:
             return JSONResponse(
                 status_code=500,
@@ -4650,41 +4158,25 @@ async def chat_endpoint(request: ChatRequest,fastapi_request: Request):
             if modelProvider['id'] == current_settings['selectedProvider']:
                 vendor = modelProvider['vendor']
                 break
-        client_class = AsyncOpenAI
-        if vendor == 'Dify':
-            client_class = DifyOpenAIAsync
         reasoner_vendor = 'OpenAI'
         for modelProvider in current_settings['modelProviders']: 
             if modelProvider['id'] == current_settings['reasoner']['selectedProvider']:
                 reasoner_vendor = modelProvider['vendor']
                 break
-        reasoner_client_class = AsyncOpenAI
-        if reasoner_vendor == 'Dify':
-            reasoner_client_class = DifyOpenAIAsync
-        # 动态更新客户端配置
-        if (current_settings['api_key'] != settings['api_key'] 
-            or current_settings['base_url'] != settings['base_url']):
-            client = client_class(
-                api_key=current_settings['api_key'],
-                base_url=current_settings['base_url'] or "https://api.openai.com/v1",
-            )
-        if (current_settings['reasoner']['api_key'] != settings['reasoner']['api_key'] 
-            or current_settings['reasoner']['base_url'] != settings['reasoner']['base_url']):
-            reasoner_client = reasoner_client_class(
-                api_key=current_settings['reasoner']['api_key'],
-                base_url=current_settings['reasoner']['base_url'] or "https://api.openai.com/v1",
-            )
+        # 从客户端池中按 (vendor, base_url, api_key) 取用，配置切换时无需重建
+        client = get_llm_client(vendor, current_settings['base_url'], current_settings['api_key'])
+        reasoner_client = get_llm_client(
+            reasoner_vendor,
+            current_settings['reasoner']['base_url'],
+            current_settings['reasoner']['api_key'],
+        )
         # 将"system_prompt"插入到request.messages[0].content中
         if current_settings['system_prompt']:
             content_prepend(request.messages, 'system', current_settings['system_prompt'] + "\n\n")
-        if current_settings != settings:
-            settings = current_settings
         try:
-            # enforce daily free-tier limit
-            if is_over_daily_limit(user_key, limit=15):
+            # enforce daily free-tier limit (check and count atomically, per user per day)
+            if not consume_daily_quota(user_key):
                 return JSONResponse(status_code=403, content={"error": {"message": "Free daily message limit reached. Upgrade to premium.", "type": "rate_limited"}})
-            # increment usage (counts per user per day)
-            increment_daily_count(user_key, 1)
 
             if request.stream:
                 return await generate_stream_response(client,reasoner_client, request, settings_for_call,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search,async_tools_id)
@@ -4699,7 +4191,7 @@ async def chat_endpoint(request: ChatRequest,fastapi_request: Request):
                 content={"error": {"message": str(e), "type": "server_error", "code": 500}}
             )
     else:
-        current_settings = await load_settings()
+        current_settings = await get_settings_snapshot()
         agentSettings = current_settings['agents'].get(model, {})
         if not agentSettings:
             for agentId , agentConfig in current_settings['agents'].items():
@@ -4712,8 +4204,9 @@ async def chat_endpoint(request: ChatRequest,fastapi_request: Request):
                 content={"error": {"message": f"Agent {model} not found", "type": "not_found", "code": 404}}
             )
         if agentSettings['config_path']:
-            with open(agentSettings['config_path'], 'r' , encoding='utf-8') as f:
-                agent_settings = json.load(f)
+            # 按路径+mtime 缓存的只读配置，文件未变化时不再重复解析
+            from py.agent_tool import load_agent_config
+            agent_settings = await asyncio.to_thread(load_agent_config, agentSettings['config_path'])
             # 将"system_prompt"插入到request.messages[0].content中
             if agentSettings['system_prompt']:
                 content_prepend(request.messages, 'user', agentSettings['system_prompt'] + "\n\n")
@@ -4722,40 +4215,25 @@ async def chat_endpoint(request: ChatRequest,fastapi_request: Request):
             if modelProvider['id'] == agent_settings['selectedProvider']:
                 vendor = modelProvider['vendor']
                 break
-        client_class = AsyncOpenAI
-        if vendor == 'Dify':
-            client_class = DifyOpenAIAsync
         reasoner_vendor = 'OpenAI'
         for modelProvider in agent_settings['modelProviders']: 
             if modelProvider['id'] == agent_settings['reasoner']['selectedProvider']:
                 reasoner_vendor = modelProvider['vendor']
                 break
-        reasoner_client_class = AsyncOpenAI
-        if reasoner_vendor == 'Dify':
-            reasoner_client_class = DifyOpenAIAsync
-        agent_client = client_class(
-            api_key=agent_settings['api_key'],
-            base_url=agent_settings['base_url'] or "https://api.openai.com/v1",
-        )
-        agent_reasoner_client = reasoner_client_class(
-            api_key=agent_settings['reasoner']['api_key'],
-            base_url=agent_settings['reasoner']['base_url'] or "https://api.openai.com/v1",
+        # 按 (vendor, base_url, api_key) 复用客户端及其连接池
+        agent_client = get_llm_client(vendor, agent_settings['base_url'], agent_settings['api_key'])
+        agent_reasoner_client = get_llm_client(
+            reasoner_vendor,
+            agent_settings['reasoner']['base_url'],
+            agent_settings['reasoner']['api_key'],
         )
         try:
             # For agent-specific settings, also apply premium gating
-            is_premium = is_premium_user(user_key)
-            settings_for_call = copy.deepcopy(agent_settings)
-            if not is_premium:
-                if 'ttsSettings' in settings_for_call:
-                    settings_for_call['ttsSettings'] = settings_for_call.get('ttsSettings', {}).copy()
-                    settings_for_call['ttsSettings']['enabled'] = False
-                if 'text2imgSettings' in settings_for_call:
-                    settings_for_call['text2imgSettings'] = settings_for_call.get('text2imgSettings', {}).copy()
-                    settings_for_call['text2imgSettings']['enabled'] = False
-
-            if is_over_daily_limit(user_key, limit=15):
+            settings_for_call = gate_settings_for_user(agent_settings, user_key)
+
+            # enforce daily free-tier limit (check and count atomically, per user per day)
+            if not consume_daily_quota(user_key):
                 return JSONResponse(status_code=403, content={"error": {"message": "Free daily message limit reached. Upgrade to premium.", "type": "rate_limited"}})
-            increment_daily_count(user_key, 1)
 
             if request.stream:
                 return await generate_stream_response(agent_client,agent_reasoner_client, request, settings_for_call,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search,async_tools_id)
@@ -4775,24 +4253,12 @@ async def simple_chat_endpoint(request: ChatRequest):
     """
     同时支持流式(stream=true)与非流式(stream=false)
     """
-    global client, settings
-
-    current_settings = await load_settings()
+    current_settings = await get_settings_snapshot()
     # identify user and enforce free-tier limits
     user_key = request.passthrough or 'local_default_user'
-    if is_over_daily_limit(user_key, limit=15):
+    # enforce daily free-tier limit (check and count atomically, per user per day)
+    if not consume_daily_quota(user_key):
         return JSONResponse(status_code=403, content={"error": {"message": "Free daily message limit reached. Upgrade to premium.", "type": "rate_limited"}})
-    increment_daily_count(user_key, 1)
-    # apply premium gating to local settings copy
-    is_premium_flag = is_premium_user(user_key)
-    settings_for_call = copy.deepcopy(current_settings)
-    if not is_premium_flag:
-        if 'ttsSettings' in settings_for_call:
-            settings_for_call['ttsSettings'] = settings_for_call.get('ttsSettings', {}).copy()
-            settings_for_call['ttsSettings']['enabled'] = False
-        if 'text2imgSettings' in settings_for_call:
-            settings_for_call['text2imgSettings'] = settings_for_call.get('text2imgSettings', {}).copy()
-            settings_for_call['text2imgSettings']['enabled'] = False
     if len(current_settings['modelProviders']) <= 0:
         return JSONResponse(
             status_code=500,
@@ -4806,13 +4272,7 @@ async def simple_chat_endpoint(request: ChatRequest):
         if mp['id'] == current_settings['selectedProvider']:
             vendor = mp['vendor']
             break
-    client_class = DifyOpenAIAsync if vendor == 'Dify' else AsyncOpenAI
-    if (current_settings['api_key'] != settings['api_key'] or
-            current_settings['base_url'] != settings['base_url']):
-        client = client_class(
-            api_key=current_settings['api_key'],
-            base_url=current_settings['base_url'] or "https://api.openai.com/v1",
-        )
+    client = get_llm_client(vendor, current_settings['base_url'], current_settings['api_key'])
 
     # --------------- 调用大模型 ---------------
     response = await client.chat.completions.create(
@@ -5150,7 +4610,7 @@ async def asr_websocket_endpoint(websocket: WebSocket):
             
             if msg_type == "init":
                 # 加载设置
-                settings = await load_settings()
+                settings = await get_settings_snapshot()
                 asr_settings = settings.get('asrSettings', {})
                 asr_engine = asr_settings.get('engine', 'openai')  # 存储引擎类型
                 if asr_engine == "funasr":
@@ -5173,7 +4633,7 @@ async def asr_websocket_endpoint(websocket: WebSocket):
             elif msg_type == "audio_start":
                 frame_id = message.get("id")
                 # 加载设置
-                settings = await load_settings()
+                settings = await get_settings_snapshot()
                 asr_settings = settings.get('asrSettings', {})
                 asr_engine = asr_settings.get('engine', 'openai')  # 存储引擎类型
                 if asr_engine == "funasr":
@@ -5235,7 +4695,7 @@ async def asr_websocket_endpoint(websocket: WebSocket):
                     except websockets.exceptions.ConnectionClosed:
                         funasr_websocket = None
                         # 加载设置
-                        settings = await load_settings()
+                        settings = await get_settings_snapshot()
                         asr_settings = settings.get('asrSettings', {})
                         asr_engine = asr_settings.get('engine', 'openai')  # 存储引擎类型
                         if asr_engine == "funasr":
@@ -5263,7 +4723,7 @@ async def asr_websocket_endpoint(websocket: WebSocket):
                     
                     try:
                         # 加载设置
-                        settings = await load_settings()
+                        settings = await get_settings_snapshot()
                         asr_settings = settings.get('asrSettings', {})
                         asr_engine = asr_settings.get('engine', 'openai')
                         
@@ -5274,9 +4734,10 @@ async def asr_websocket_endpoint(websocket: WebSocket):
                             audio_file = BytesIO(audio_bytes)
                             audio_file.name = f"audio.{audio_format}"
                             
-                            client = AsyncOpenAI(
-                                api_key=asr_settings.get('api_key', ''),
-                                base_url=asr_settings.get('base_url', '') or "https://api.openai.com/v1"
+                            client = get_llm_client(
+                                'OpenAI',
+                                asr_settings.get('base_url', ''),
+                                asr_settings.get('api_key', ''),
                             )
                             response = await client.audio.transcriptions.create(
                                 file=audio_file,
@@ -5361,7 +4822,7 @@ async def asr_transcription(
                 format = 'wav'
         
         # 加载设置
-        settings = await load_settings()
+        settings = await get_settings_snapshot()
         asr_settings = settings.get('asrSettings', {})
         asr_engine = asr_settings.get('engine', 'openai')
         
@@ -5373,9 +4834,10 @@ async def asr_transcription(
             audio_file = BytesIO(audio_bytes)
             audio_file.name = f"audio.{format}"
             
-            client = AsyncOpenAI(
-                api_key=asr_settings.get('api_key', ''),
-                base_url=asr_settings.get('base_url', '') or "https://api.openai.com/v1"
+            client = get_llm_client(
+                'OpenAI',
+                asr_settings.get('base_url', ''),
+                asr_settings.get('api_key', ''),
             )
             
             response = await client.audio.transcriptions.create(
@@ -6025,10 +5487,7 @@ async def text_to_speech(request: Request):
 
             async def generate_audio():
                 try:
-                    client = AsyncOpenAI(
-                        api_key=openai_config['api_key'],
-                        base_url=openai_config['base_url']
-                    )
+                    client = get_llm_client('OpenAI', openai_config['base_url'], openai_config['api_key'])
                     
                     # 根据目标格式设置response_format
                     response_format = target_format if target_format in ['mp3', 'opus', 'aac', 'flac', 'wav', 'pcm'] else 'mp3'
@@ -6481,6 +5940,7 @@ async def process_mcp(mcp_id: str):
                 await asyncio.sleep(0.5)
         mcp_status[mcp_id] = "ready"
         mcp_client_list[mcp_id].disabled = False
+        tool_registry.invalidate()
 
     except Exception as e:
         # 任何异常（超时、崩溃）都走这里
@@ -6520,6 +5980,7 @@ async def remove_mcp_server(request: Request):
                 await mcp_client_list[server_name].close()
                 del mcp_client_list[server_name]
                 print(f"关闭MCP服务器: {server_name}")
+                tool_registry.invalidate()
 
             return JSONResponse({"success": True, "removed": server_name})
         else:
@@ -6536,7 +5997,12 @@ async def remove_memory_endpoint(request: Request):
     memory_id = data.get("memoryId")
     if memory_id:
         try:
-            # 删除MEMORY_CACHE_DIR目录下的memory_id文件夹
+            from py.memory_cache import memory_instances
+            from py.memory_store import memory_stores
+            # 先丢弃缓存的 Memory 实例与常驻存储（不再写盘），再删除MEMORY_CACHE_DIR目录下的memory_id文件夹
+            memory_instances.invalidate(memory_id)
+            memory_stores.invalidate(memory_id, discard=True)
+            lore_matchers.invalidate(memory_id)
             memory_dir = os.path.join(MEMORY_CACHE_DIR, memory_id)
             shutil.rmtree(memory_dir)
             return JSONResponse({"success": True, "message": "Memory removed"})
@@ -6552,7 +6018,9 @@ async def remove_agent_endpoint(request: Request):
     if agent_id:
         try:
             # 删除AGENT_CACHE_DIR目录下的agent_id文件夹
+            from py.agent_tool import invalidate_agent_config
             agent_dir = os.path.join(AGENT_DIR, f"{agent_id}.json")
+            invalidate_agent_config(agent_dir)
             shutil.rmtree(agent_dir)
             return JSONResponse({"success": True, "message": "Agent removed"})
         except Exception as e:
@@ -7442,6 +6910,8 @@ async def remove_kb_endpoint(request: Request, background_tasks: BackgroundTasks
 
 # 删除知识库
 async def remove_kb(kb_id):
+    from py.know_base import kb_index_cache
+    kb_index_cache.invalidate(kb_id)
     # 删除KB_DIR/kb_id目录
     kb_dir = os.path.join(KB_DIR, str(kb_id))
     if os.path.exists(kb_dir):
@@ -7458,6 +6928,20 @@ async def get_kb_status(kb_id):
     print (f"kb_status: {kb_id} - {status}")
     return {"kb_id": kb_id, "status": status}
 
+@app.get("/kb_cache_stats")
+async def get_kb_cache_stats():
+    from py.know_base import kb_index_cache
+    return kb_index_cache.stats()
+
+@app.get("/embedding_cache_stats")
+async def get_embedding_cache_stats():
+    from py.embedding_cache import embedding_cache
+    return embedding_cache.stats()
+
+@app.get("/llm_client_stats")
+async def get_llm_client_stats():
+    return llm_client_pool.stats()
+
 # 修改 process_kb
 async def process_kb(kb_id):
     kb_status[kb_id] = "processing"
@@ -7858,13 +7342,13 @@ async def delete_workflow(filename: str):
 
 @app.get("/cur_language")
 async def cur_language():
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     target_language = settings["currentLanguage"]
     return {"language": target_language}
 
 @app.get("/vrm_config")
 async def vrm_config():
-    settings = await load_settings()
+    settings = await get_settings_snapshot()
     return {"VRMConfig": settings.get("VRMConfig", {})}
 
 from py.live_router import router as live_router, ws_router as live_ws_router
@@ -7875,32 +7359,25 @@ app.include_router(live_ws_router)  # /ws/live/*
 
 
 # ---------- 工具 ----------
-def get_dir(mid: str) -> str:
-    return os.path.join(MEMORY_CACHE_DIR, mid)
-
-def get_faiss_path(mid: str) -> str:
-    return os.path.join(get_dir(mid), "agent-party.faiss")
+# /memory 分页浏览时单页的最大条数
+MEMORY_PAGE_MAX = int(os.environ.get("SAP_MEMORY_PAGE_MAX", "500"))
+
+async def get_memory_store(mid: str):
+    """常驻的记忆存储（首次访问时在线程中读盘）"""
+    from py.memory_store import memory_stores
+    store = await asyncio.to_thread(memory_stores.get, mid)
+    if store is None:
+        raise HTTPException(status_code=404, detail="memory not found")
+    return store
 
-def get_pkl_path(mid: str) -> str:
-    return os.path.join(get_dir(mid), "agent-party.pkl")
 
-def load_index_and_meta(mid: str):
-    import faiss
-    fpath, ppath = get_faiss_path(mid), get_pkl_path(mid)
-    if not (os.path.exists(fpath) and os.path.exists(ppath)):
+async def get_memory_docstore(mid: str):
+    """记忆的元数据库（SQLite），浏览与改文本时不加载向量索引"""
+    from py.memory_store import memory_stores
+    docstore = await asyncio.to_thread(memory_stores.docstore, mid)
+    if docstore is None:
         raise HTTPException(status_code=404, detail="memory not found")
-    index = faiss.read_index(fpath)
-    with open(ppath, "rb") as f:
-        raw = pickle.load(f)          # 可能是 tuple 也可能是 dict
-    # 兼容旧数据：如果是 tuple 取第 0 个，否则直接用
-    meta_dict = raw[0] if isinstance(raw, tuple) else raw
-    return index, meta_dict
-
-def save_index_and_meta(mid: str, index, meta: List[Dict[Any, Any]]):
-    import faiss
-    faiss.write_index(index, get_faiss_path(mid))
-    with open(get_pkl_path(mid), "wb") as f:
-        pickle.dump(meta, f)
+    return docstore
 
 
 def fmt_iso8605_to_local(iso: str) -> str:
@@ -7915,41 +7392,70 @@ def fmt_iso8605_to_local(iso: str) -> str:
         return iso        # 解析失败就原样返回
 
 
-def flatten_records(meta: Dict[str, Any]) -> List[Dict[str, Any]]:
+def flatten_records(rows) -> List[Dict[str, Any]]:
+    # idx 为记录的向量 id，删除其他记录后保持不变；时间只格式化当前页
     flat = []
-    for uuid, rec in meta.items():
+    for vid, uuid, rec in rows:
         flat.append({
-            "idx"        : len(flat),
+            "idx"        : vid,
             "uuid"       : uuid,
-            "text"       : rec["data"],
-            "created_at" : fmt_iso8605_to_local(rec["created_at"]),
-            "timetamp"   : rec["timetamp"],
+            "text"       : rec.get("data"),
+            "created_at" : fmt_iso8605_to_local(rec.get("created_at", "")),
+            "timetamp"   : rec.get("timetamp"),
         })
     return flat
 
 
-# 新增： dict ↔ list 互转工具
-def dict_to_list(meta: Dict[str, Any]) -> List[Dict[str, Any]]:
-    """有序化，保证顺序与 Faiss 索引一致"""
-    return [{uuid: rec} for uuid, rec in meta.items()]
-
-def list_to_dict(meta_list: List[Dict[str, Any]]) -> Dict[str, Any]:
-    """列表再压回 dict"""
-    new_meta = {}
-    for item in meta_list:
-        uuid, rec = next(iter(item.items()))
-        new_meta[uuid] = rec
-    return new_meta
+async def semantic_memory_search(memory_id: str, query: str, limit: int) -> List[str]:
+    """用该记忆配置的嵌入模型检索，返回按相关度排序的记录 uuid"""
+    from py.memory_cache import get_memory_instance
+    settings = await get_settings_snapshot()
+    cur_memory = next((m for m in settings["memories"] if m["id"] == memory_id), None)
+    if not cur_memory or not cur_memory.get("providerId"):
+        raise HTTPException(status_code=400, detail="memory has no embedding provider")
+    m0 = await get_memory_instance(dict(cur_memory), settings)
+    result = await asyncio.to_thread(m0.search, query=query, user_id=memory_id, limit=limit)
+    hits = result.get("results", []) if isinstance(result, dict) else result
+    return [hit["id"] for hit in hits if hit.get("id")]
 
 # ---------- 模型 ----------
 class TextUpdate(BaseModel):
     new_text: str
 
-# ---------- 1. 读取（平铺） ----------
+# ---------- 1. 读取（分页 / 搜索） ----------
 @app.get("/memory/{memory_id}")
-async def read_memory(memory_id: str) -> List[Dict[str, Any]]:
-    _, meta_dict = load_index_and_meta(memory_id)   # 拆包
-    return flatten_records(meta_dict)               # 传字典
+async def read_memory(
+    memory_id: str,
+    offset: int = 0,
+    limit: int = 50,
+    q: str = "",
+    semantic: bool = False,
+    order: str = "desc",
+) -> Dict[str, Any]:
+    """
+    分页浏览记忆：q 为文本子串过滤；semantic=true 时改为向量检索 q（按相关度排序）；
+    order 为按创建时间的 asc / desc。
+    语义检索没有确切的总数：多取一条判断是否还有下一页，total 为已知条数（有下一页时再加 1）。
+    """
+    offset = max(offset, 0)
+    limit = min(max(limit, 1), MEMORY_PAGE_MAX)
+    docstore = await get_memory_docstore(memory_id)
+    if semantic and q:
+        uuids = await semantic_memory_search(memory_id, q, offset + limit + 1)
+        hits = await asyncio.to_thread(docstore.by_uuids, uuids)
+        rows = hits[offset:offset + limit]
+        has_more = len(hits) > offset + limit
+        total = offset + len(rows) + (1 if has_more else 0)
+    else:
+        total, rows = await asyncio.to_thread(docstore.page, offset, limit, q, order)
+        has_more = offset + len(rows) < total
+    return {
+        "total"    : total,
+        "has_more" : has_more,
+        "offset"   : offset,
+        "limit"    : limit,
+        "records"  : flatten_records(rows),
+    }
 
 # ---------- 2. 修改（只改 data） ----------
 @app.put("/memory/{memory_id}/{idx}")
@@ -7958,46 +7464,19 @@ async def update_text(
     idx: int,
     body: TextUpdate = Body(...)
 ) -> dict:
-    index, meta_dict = load_index_and_meta(memory_id)
-    meta_list = dict_to_list(meta_dict)
-    if not (0 <= idx < len(meta_list)):
+    docstore = await get_memory_docstore(memory_id)
+    if not await asyncio.to_thread(docstore.update_text, idx, body.new_text):
         raise HTTPException(status_code=404, detail="index out of range")
-    # 定位 → 改 data
-    uuid, rec = next(iter(meta_list[idx].items()))
-    rec["data"] = body.new_text
-    # 写回
-    save_index_and_meta(memory_id, index, list_to_dict(meta_list))
     return {"message": "updated", "idx": idx}
 
 
-# ---------- 3. 删除（按行号） ----------
+# ---------- 3. 删除（按向量 id） ----------
 @app.delete("/memory/{memory_id}/{idx}")
 async def delete_text(memory_id: str, idx: int) -> dict:
-    import faiss
-    import numpy as np
-    index, meta_dict = load_index_and_meta(memory_id)
-    meta_list = dict_to_list(meta_dict)
-    if not (0 <= idx < len(meta_list)):
+    store = await get_memory_store(memory_id)
+    # IndexIDMap2.remove_ids 直接删除该向量，写盘在后台合并进行
+    if not await asyncio.to_thread(store.delete, idx):
         raise HTTPException(status_code=404, detail="index out of range")
-
-    ntotal = index.ntotal
-    print("index.ntotal",index.ntotal)
-    print("len(meta_list)",len(meta_list))
-    if ntotal != len(meta_list):
-        raise RuntimeError("index 与 meta 长度不一致")
-
-    # 1. 重建 Faiss 索引（去掉 idx）
-    ids_to_keep = np.array([i for i in range(ntotal) if i != idx], dtype=np.int64)
-    vecs = np.vstack([index.reconstruct(i) for i in range(ntotal)])
-    new_index = faiss.IndexFlatL2(index.d)   # 跟你建索引时保持一致
-    if vecs.shape[0] - 1 > 0:
-        new_index.add(vecs[ids_to_keep].astype("float32"))
-
-    # 2. 删除列表元素
-    del meta_list[idx]
-
-    # 3. 落盘
-    save_index_and_meta(memory_id, new_index, list_to_dict(meta_list))
     return {"message": "deleted", "idx": idx}
 
 @app.get("/api/update_proxy")
@@ -8054,6 +7533,22 @@ def get_ip():
     return {"ip": ip}
 
 
+@app.get("/conversations")
+async def list_conversations_endpoint(offset: int = 0, limit: int = 50, keyword: Optional[str] = None):
+    """分页获取对话摘要（不含消息）"""
+    from py.get_setting import list_conversations
+    limit = max(1, min(limit, 500))
+    return await list_conversations(offset=max(0, offset), limit=limit, keyword=keyword)
+
+@app.get("/conversations/{conv_id}")
+async def get_conversation_endpoint(conv_id: str):
+    from py.get_setting import get_conversation
+    conv = await get_conversation(conv_id)
+    if conv is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conv
+
+
 settings_lock = asyncio.Lock()
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -8091,6 +7586,49 @@ async def websocket_endpoint(websocket: WebSocket):
                     "correlationId": data.get("correlationId"),
                     "success": True
                 })
+            elif data.get("type") in ("save_conversation", "append_messages", "delete_conversation"):
+                # 增量保存：只写入单个对话/新增消息
+                from py.get_setting import append_messages, delete_conversation, save_conversation
+                payload = data.get("data", {})
+                try:
+                    if data["type"] == "save_conversation":
+                        await save_conversation(payload["conversation"])
+                    elif data["type"] == "append_messages":
+                        await append_messages(
+                            payload["id"],
+                            payload.get("messages", []),
+                            start=payload.get("start"),
+                            meta=payload.get("meta"),
+                        )
+                    else:
+                        for conv_id in payload.get("ids") or [payload["id"]]:
+                            await delete_conversation(conv_id)
+                except Exception as e:
+                    print(f"Error saving conversation: {e}")
+                    await websocket.send_json({
+                        "type": "save_error",
+                        "correlationId": data.get("correlationId"),
+                        "error": str(e)
+                    })
+                else:
+                    await websocket.send_json({
+                        "type": "conversations_saved",
+                        "correlationId": data.get("correlationId"),
+                        "success": True
+                    })
+            elif data.get("type") == "list_conversations":
+                from py.get_setting import list_conversations
+                payload = data.get("data", {})
+                result = await list_conversations(
+                    offset=int(payload.get("offset", 0)),
+                    limit=int(payload.get("limit", 50)),
+                    keyword=payload.get("keyword"),
+                )
+                await websocket.send_json({
+                    "type": "conversations_page",
+                    "correlationId": data.get("correlationId"),
+                    "data": result
+                })
             elif data.get("type") == "get_settings":
                 settings = await load_settings()
                 if settings.get("conversations",None):
@@ -8099,7 +7637,6 @@ async def websocket_endpoint(websocket: WebSocket):
                     del settings["conversations"]
                     await save_settings(settings)
                 covs = await load_covs()
-                print("covs"+covs)
                 settings["conversations"] = covs.get("conversations", [])
                 await websocket.send_json({"type": "settings", "data": settings})
             elif data.get("type") == "save_agent":
@@ -8111,6 +7648,9 @@ async def websocket_endpoint(websocket: WebSocket):
                 
                 with open(config_path, 'w', encoding='utf-8') as f:
                     json.dump(current_settings, f, indent=4, ensure_ascii=False)
+                # 丢弃该路径可能残留的旧缓存（同一秒内覆盖写时 mtime 可能不变）
+                from py.agent_tool import invalidate_agent_config
+                invalidate_agent_config(config_path)
                 
                 # 更新主配置
                 current_settings['agents'][agent_id] = {
@@ -8236,7 +7776,7 @@ mcp.mount()
 # - Session tokens stored server-side, set as HttpOnly cookie `session`
 # - Basic /register and /login pages served from static/auth
 # -----------------------------
-import aiosqlite
+from py.sqlite_pool import get_async_pool
 import hashlib
 import secrets
 import re
@@ -8264,7 +7804,7 @@ def _valid_email(e: str) -> bool:
 
 async def init_users_db():
     try:
-        async with aiosqlite.connect(USERS_DB) as db:
+        async with get_async_pool(USERS_DB).acquire() as db:
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -8286,7 +7826,7 @@ async def init_users_db():
         # Ensure root admin exists (keep existing root account working)
         init_user = os.environ.get('INIT_USER', 'root')
         init_pass = os.environ.get('INIT_PASS', 'pass')
-        async with aiosqlite.connect(USERS_DB) as db:
+        async with get_async_pool(USERS_DB).acquire() as db:
             async with db.execute('SELECT id FROM users WHERE email = ?', (init_user,)) as cur:
                 row = await cur.fetchone()
             if not row:
@@ -8300,13 +7840,13 @@ async def init_users_db():
 async def _create_session(user_id: int, ttl: int = 7*24*3600) -> str:
     token = secrets.token_urlsafe(32)
     expires = int(_time.time()) + int(ttl)
-    async with aiosqlite.connect(USERS_DB) as db:
+    async with get_async_pool(USERS_DB).acquire() as db:
         await db.execute('INSERT OR REPLACE INTO sessions (token, user_id, expires_at) VALUES (?, ?, ?)', (token, user_id, expires))
         await db.commit()
     return token
 
 async def _get_user_by_email(email: str):
-    async with aiosqlite.connect(USERS_DB) as db:
+    async with get_async_pool(USERS_DB).acquire() as db:
         async with db.execute('SELECT id, email, password_hash, created_at, is_admin FROM users WHERE email = ?', (email,)) as cur:
             row = await cur.fetchone()
             if not row:
@@ -8317,7 +7857,7 @@ async def _get_user_by_session(token: str):
     if not token:
         return None
     now = int(_time.time())
-    async with aiosqlite.connect(USERS_DB) as db:
+    async with get_async_pool(USERS_DB).acquire() as db:
         async with db.execute('SELECT user_id FROM sessions WHERE token = ? AND expires_at > ?', (token, now)) as cur:
             row = await cur.fetchone()
             if not row:
@@ -8333,7 +7873,7 @@ async def _create_user(email: str, password: str, is_admin: bool = False):
     if not email or not password:
         raise ValueError('email and password required')
     ph = _hash_password(password)
-    async with aiosqlite.connect(USERS_DB) as db:
+    async with get_async_pool(USERS_DB).acquire() as db:
         await db.execute('INSERT INTO users (email, password_hash, created_at, is_admin) VALUES (?, ?, ?, ?)', (email, ph, datetime.utcnow().isoformat(), 1 if is_admin else 0))
         await db.commit()
         async with db.execute('SELECT id FROM users WHERE email = ?', (email,)) as cur:
@@ -8423,7 +7963,7 @@ async def logout(request: Request):
     token = request.cookies.get('session')
     if token:
         try:
-            async with aiosqlite.connect(USERS_DB) as db:
+            async with get_async_pool(USERS_DB).acquire() as db:
                 await db.execute('DELETE FROM sessions WHERE token = ?', (token,))
                 await db.commit()
         except Exception:
@@ -1105,6 +1105,8 @@ key3`,
         'thirdPartyNotice': '第三方许可证清单：',
         'vectorInteractTitle': '编辑记忆库',
         'memoryText': '记忆文本',
+        'searchMemory': '搜索记忆文本',
+        'semanticSearch': '语义搜索',
         'createTime': '创建时间',
         'lastTime': '修改时间',
         'vectorInteract': '编辑记忆',
@@ -2302,6 +2304,8 @@ Key3`,
         'thirdPartyNotice': 'Third-party license list:',
         'vectorInteractTitle': 'Edit Memory Bank',
         'memoryText': 'Memory Text',
+        'searchMemory': 'Search memory text',
+        'semanticSearch': 'Semantic search',
         'createTime': 'Created Time',
         'lastTime': 'Modified Time',
         'vectorInteract': 'Edit Memory',
@@ -153,6 +153,7 @@ let vue_data = {
     currentMessage: '',
     conversationId: null, // 当前对话ID
     conversations: [], // 对话历史记录
+    conversationSavedCounts: {}, // 对话ID -> 已保存到后端的消息条数（用于只追加新消息）
     showHistoryDialog: false,
     showLLMToolsDialog: false,
     showHttpToolDialog: false,
@@ -1718,6 +1719,12 @@ main();`,
     vectorDialogMemoryName: '',
     vectorLoading: false,
     vectorTable: [],       // { idx, uuid, text, created_at, timetamp }
+    vectorTotal: 0,        // 符合条件的记录总数（分页用）
+    vectorTotalExact: true, // 语义搜索只知道是否还有下一页，不显示总数
+    vectorPage: 1,
+    vectorPageSize: 50,
+    vectorQuery: '',       // 搜索关键字
+    vectorSemantic: false, // 是否按语义（向量）搜索
     editRowIdx: null,      // 当前编辑的行号（=后端 idx）
     editRowText: "",     // 当前编辑的文本
     editRowVisible: false,
@@ -197,6 +197,7 @@ let vue_methods = {
   },
   async resetMessage(index) {
     this.messages[index].content = " ";
+    this.markConversationDirty();
     this.system_prompt = " ";
     await this.autoSaveSettings();
   },
@@ -204,6 +205,7 @@ let vue_methods = {
   async deleteMessage(index) {
     this.stopGenerate();
     this.messages.splice(index, 1);
+    this.markConversationDirty();
     await this.autoSaveSettings();
   },
 
@@ -227,6 +229,7 @@ let vue_methods = {
       await this.sendMessage();
     }else{
       this.messages[this.editIndex].content = this.editContent; // 更新this.editIndex对应的消息内容
+      this.markConversationDirty();
     }
     await this.autoSaveSettings();
   },
@@ -433,7 +436,7 @@ let vue_methods = {
       }
       
       this.conversations = this.conversations.filter(c => c.id !== convId);
-      await this.saveConversations(); // 保存对话列表
+      await this.sendConversationRequest('delete_conversation', { ids: [convId] }); // 只删除该对话
     },
     async loadConversation(convId) {
       const conversation = this.conversations.find(c => c.id === convId);
@@ -1269,6 +1272,7 @@ let vue_methods = {
         }
         // 新增：处理系统消息更新
         else if (data.type === 'update_system_prompt') {
+          this.markConversationDirty();
           if (this.messages[0].role === 'system') {
             this.messages[0].content = data.data.text
           }else{
@@ -1380,6 +1384,7 @@ let vue_methods = {
       }
     },
     async syncSystemPromptToMessages(newPrompt) {
+      this.markConversationDirty();
       // 情况 1: 新提示词为空
       if (!newPrompt) {
         if (this.messages.length > 0 && this.messages[0].role === 'system') {
@@ -1549,6 +1554,8 @@ let vue_methods = {
       // fileLinks_list添加到self.filelinks
       this.fileLinks = this.fileLinks.concat(fileLinks_list)
       // const escapedContent = this.escapeHtml(userInput.trim());
+      // 本轮新消息的起始位置，保存时只上传这之后的消息
+      const turnStart = this.messages.length;
       // 添加用户消息
       this.messages.push({
         id: Date.now() + Math.random(), // 添加唯一ID
@@ -1661,7 +1668,7 @@ let vue_methods = {
           conv.system_prompt = this.system_prompt;
         }
       }
-      await this.saveConversations();
+      await this.saveConversation(this.conversationId, turnStart);
       try {
         console.log('Sending message...');
         // 请求参数需要与后端接口一致
@@ -1922,7 +1929,7 @@ let vue_methods = {
         this.isTyping = false;
         this.abortController = null;
         await this.autoSaveSettings();
-        await this.saveConversations();
+        await this.saveConversation(this.conversationId, turnStart);
       }
     },
     async translateMessage(index) {
@@ -2010,6 +2017,7 @@ let vue_methods = {
         // 5. 翻译完成
         this.messages[index].isTranslating = false;
         this.messages[index].translated = true;
+        this.markConversationDirty();
 
       } catch (error) {
         if (error.name === 'AbortError') {
@@ -2153,15 +2161,48 @@ let vue_methods = {
       });
     },
     async saveConversations() {
+      // 整体保存（清空、批量删除等场景），后端只写入有变化的对话
+      const counts = {};
+      for (const conv of this.conversations) {
+        counts[conv.id] = conv.messages?.length ?? 0;
+      }
+      await this.sendConversationRequest('save_conversations', {
+        conversations: this.conversations
+      });
+      this.conversationSavedCounts = counts;
+    },
+    async saveConversation(convId, start = null) {
+      // 增量保存单个对话：已保存的前缀没有变化时只追加 start 之后的消息（append_messages），
+      // 否则（首次保存、编辑/删除过消息）整段保存该对话
+      const conv = this.conversations.find(c => c.id === convId);
+      if (!conv) {
+        return this.saveConversations();
+      }
+      const saved = this.conversationSavedCounts[convId];
+      const count = conv.messages.length;
+      if (start !== null && saved !== undefined && start <= saved) {
+        const { messages, ...meta } = conv;
+        await this.sendConversationRequest('append_messages', {
+          id: convId,
+          start: start,
+          messages: messages.slice(start),
+          meta: meta
+        });
+      } else {
+        await this.sendConversationRequest('save_conversation', { conversation: conv });
+      }
+      this.conversationSavedCounts[convId] = count;
+    },
+    markConversationDirty() {
+      // 当前对话中已保存的消息被修改，下次保存时整段上传
+      delete this.conversationSavedCounts[this.conversationId];
+    },
+    async sendConversationRequest(type, payload) {
       return new Promise((resolve, reject) => {
-        // 构造 payload（保持原有逻辑）
-        const payload = {
-          conversations: this.conversations
-        };
         const correlationId = uuid.v4();
         // 发送保存请求
         this.ws.send(JSON.stringify({
-          type: 'save_conversations',
+          type: type,
           data: payload,
           correlationId: correlationId // 添加唯一请求 ID
         }));
@@ -10978,6 +11019,9 @@ async togglePlugin(plugin) {
       this.vectorDialogMemoryId = mid
       // 取 memory 名字只是为了标题展示
       this.vectorDialogMemoryName = this.memories.find(m => m.id === mid)?.name || mid
+      this.vectorPage = 1
+      this.vectorQuery = ''
+      this.vectorSemantic = false
       await this.loadVectorTable(mid)
     },
 
@@ -10985,18 +11029,42 @@ async togglePlugin(plugin) {
     async loadVectorTable(mid) {
       this.vectorLoading = true
       try {
-        const res = await fetch(`/memory/${mid}`)
+        // 后端分页、搜索，只返回当前页
+        const params = new URLSearchParams({
+          offset: (this.vectorPage - 1) * this.vectorPageSize,
+          limit: this.vectorPageSize,
+        })
+        const query = this.vectorQuery.trim()
+        if (query) {
+          params.set('q', query)
+          params.set('semantic', this.vectorSemantic)
+        }
+        const res = await fetch(`/memory/${mid}?${params}`)
         if (!res.ok) throw new Error(await res.text())
-        // 后端已平铺，直接赋值
-        this.vectorTable = await res.json()
+        const data = await res.json()
+        this.vectorTable = data.records
+        this.vectorTotal = data.total
+        this.vectorTotalExact = !(query && this.vectorSemantic)
       } catch (e) {
         this.vectorTable = []
+        this.vectorTotal = 0
         console.error(e)
       } finally {
         this.vectorLoading = false
       }
     },
 
+    // 搜索条件变化后回到第一页
+    async searchVectorTable() {
+      this.vectorPage = 1
+      await this.loadVectorTable(this.vectorDialogMemoryId)
+    },
+
+    async changeVectorPage(page) {
+      this.vectorPage = page
+      await this.loadVectorTable(this.vectorDialogMemoryId)
+    },
+
     // 新增记忆
     async addVectorRow() {
       if (!this.newVectorText.trim()) return